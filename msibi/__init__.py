@@ -1,6 +1,8 @@
 from .state import State
 from .forces import Pair, Bond, Angle, Dihedral
 from .optimize import MSIBI
+from .schemes import IBI, IMC, AndersonAcceleration
+from .schedules import GeometricSchedule, AdaptiveSchedule
 #from .potentials import *
 #from .potentials import quadratic_spring, mie, lennard_jones, pair_tail_correction 
 from .__version__ import __version__
@@ -14,5 +16,10 @@ __all__ = [
     "Bond",
     "Angle",
     "Dihedral",
+    "IBI",
+    "IMC",
+    "AndersonAcceleration",
+    "GeometricSchedule",
+    "AdaptiveSchedule",
     "utils"
 ]
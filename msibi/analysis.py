@@ -0,0 +1,1071 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+
+# The hoomd neighbor list exclusions that Topology.excluded_pairs can
+# reproduce, and the positions in each group of the excluded particles.
+PAIR_EXCLUSIONS = {
+    "bond": ("bonds", 0, 1),
+    "angle": ("angles", 0, 2),
+    "dihedral": ("dihedrals", 0, 3),
+}
+
+
+class Topology(object):
+    """
+    Particle types and bonded groups of a system.
+
+    These do not change along a trajectory, so they are found once and
+    reused for every frame. Bond, angle and dihedral groups are indexed
+    by type name, giving the particle indices of every group of that type.
+
+    Parameters
+    ----------
+    frame : gsd.hoomd.Frame or hoomd.Snapshot, required
+        A frame holding the system's topology.
+
+    """
+
+    def __init__(self, frame):
+        self.N = int(frame.particles.N)
+        self.types = list(frame.particles.types)
+        self.typeid = np.array(frame.particles.typeid)
+        self.bond_group = np.array(frame.bonds.group, dtype=int).reshape(-1, 2)
+        self.bonds = _index_groups(frame.bonds)
+        self.angles = _index_groups(frame.angles)
+        self.dihedrals = _index_groups(frame.dihedrals)
+        self._molecules = None
+        self._excluded_pairs = dict()
+
+    @classmethod
+    def from_gsd(cls, gsd_file: str):
+        """Create the Topology from the first frame of a GSD file."""
+        import gsd.hoomd
+
+        with gsd.hoomd.open(gsd_file, "r") as traj:
+            return cls(traj[0])
+
+    @property
+    def molecules(self) -> np.ndarray:
+        """The molecule index of each particle. See molecule_ids."""
+        if self._molecules is None:
+            self._molecules = molecule_ids(self.N, self.bond_group)
+        return self._molecules
+
+    def excluded_pairs(self, exclusions: list) -> np.ndarray:
+        """Keys of the particle pairs left out by a hoomd neighbor list.
+
+        Each pair of particles i < j has the key i * N + j.
+
+        Parameters
+        ----------
+        exclusions : list of str, required
+            The exclusions of the neighbor list. Only those in
+            msibi.analysis.PAIR_EXCLUSIONS are supported.
+
+        Returns
+        -------
+        np.ndarray
+            The sorted keys of every excluded pair.
+
+        """
+        key = tuple(sorted(set(exclusions)))
+        if key not in self._excluded_pairs:
+            unsupported = [name for name in key if name not in PAIR_EXCLUSIONS]
+            if unsupported:
+                raise ValueError(
+                    f"The neighbor list exclusions {unsupported} are not "
+                    f"supported. Supported exclusions are "
+                    f"{list(PAIR_EXCLUSIONS)}."
+                )
+            pairs = [np.zeros((0, 2), dtype=int)]
+            for name in key:
+                kind, first, last = PAIR_EXCLUSIONS[name]
+                for group in getattr(self, kind).values():
+                    pairs.append(group[:, [first, last]])
+            pairs = np.sort(np.concatenate(pairs), axis=1)
+            self._excluded_pairs[key] = np.unique(
+                pairs[:, 0] * self.N + pairs[:, 1]
+            )
+        return self._excluded_pairs[key]
+
+    def group(self, kind: str, types: tuple) -> np.ndarray:
+        """Particle indices of every bond, angle or dihedral of a type.
+
+        Parameters
+        ----------
+        kind : str, required
+            One of "bonds", "angles" or "dihedrals".
+        types : tuple of str, required
+            The particle types of the group. The reverse order is also matched.
+
+        """
+        groups = getattr(self, kind)
+        names = ["-".join(types), "-".join(types[::-1])]
+        found = [groups[name] for name in set(names) if name in groups]
+        if not found:
+            raise ValueError(
+                f"Type {names[0]} was not found in the {kind} of the frame. "
+                f"Available types are {list(groups)}."
+            )
+        return np.concatenate(found)
+
+
+class Histogram(object):
+    """
+    Base class for accumulating a structural distribution.
+    Don't call this class directly, instead use
+    msibi.analysis.BondHistogram, msibi.analysis.AngleHistogram,
+    msibi.analysis.DihedralHistogram and msibi.analysis.PairHistogram.
+
+    Frames are added as stacked position and box arrays, so that every
+    frame is handled in one batched operation. Single frames can be
+    gsd.hoomd.Frame objects read from a trajectory, or hoomd.Snapshot
+    objects taken from a running simulation.
+
+    Parameters
+    ----------
+    x_min : float, required
+        Lower bound of the histogram range.
+    x_max : float, required
+        Upper bound of the histogram range.
+    bins : int, required
+        Number of histogram bins.
+
+    """
+
+    def __init__(self, x_min: float, x_max: float, bins: int):
+        self.x_min = x_min
+        self.x_max = x_max
+        self.bins = bins
+        self.edges = np.linspace(x_min, x_max, bins + 1)
+        self.counts = np.zeros(bins)
+        self.n_frames = 0
+        self._count_sum = None
+        self._count_products = None
+        self._fluctuation_frames = 0
+        self._recorded_counts = None
+
+    @property
+    def bin_centers(self) -> np.ndarray:
+        """The center of each histogram bin."""
+        return self.edges[:-1] + np.diff(self.edges) / 2
+
+    @property
+    def parameters(self) -> dict:
+        """The settings that define this histogram."""
+        return {
+            "histogram": self.__class__.__name__,
+            "types": list(self.types),
+            "x_min": float(self.x_min),
+            "x_max": float(self.x_max),
+            "bins": int(self.bins),
+        }
+
+    def add_frame(self, frame, topology: Topology=None) -> None:
+        """Add the samples from a single frame to the histogram.
+
+        Parameters
+        ----------
+        frame : gsd.hoomd.Frame or hoomd.Snapshot, required
+            The frame to sample.
+        topology : msibi.analysis.Topology, optional
+            The frame's topology. It is found from the frame if not given.
+
+        """
+        if topology is None:
+            topology = Topology(frame)
+        self.add_frames(
+            positions=np.asarray(frame.particles.position)[None],
+            boxes=np.asarray(frame.configuration.box)[None],
+            topology=topology
+        )
+
+    def add_frames(
+            self,
+            positions: np.ndarray,
+            boxes: np.ndarray,
+            topology: Topology
+    ) -> None:
+        """Add the samples from a stack of frames to the histogram.
+
+        Parameters
+        ----------
+        positions : np.ndarray, shape=(n_frames, N, 3), required
+            Particle positions of each frame.
+        boxes : np.ndarray, shape=(n_frames, 6), required
+            Box parameters of each frame.
+        topology : msibi.analysis.Topology, required
+            The topology shared by every frame.
+
+        """
+        samples = self._samples(positions, boxes, topology)
+        if not (self.records_fluctuations or self.records_frames):
+            counts, _ = np.histogram(
+                samples, bins=self.bins, range=(self.x_min, self.x_max)
+            )
+            self.counts += counts
+            self.n_frames += len(positions)
+            return
+        frame_counts = np.stack([
+            np.histogram(
+                frame_samples, bins=self.bins, range=(self.x_min, self.x_max)
+            )[0]
+            for frame_samples in samples.reshape(len(positions), -1)
+        ])
+        self.counts += frame_counts.sum(axis=0)
+        self.n_frames += len(positions)
+        self._add_frame_counts(frame_counts)
+
+    def distribution(self, weights: np.ndarray=None) -> np.ndarray:
+        """The normalized distribution with shape (bins, 2).
+
+        The first column holds the bin centers, and the second column holds
+        the bin heights normalized so that they sum to one.
+
+        Parameters
+        ----------
+        weights : np.ndarray, shape=(n_frames,), optional, default None
+            If given, the distribution is the weighted average over frames.
+            The per-frame counts must have been recorded,
+            see msibi.analysis.Histogram.record_frames.
+
+        """
+        counts = self._weighted_counts(weights)
+        heights = counts * self._scale(counts)
+        return np.stack((self.bin_centers, heights)).T
+
+    @property
+    def records_frames(self) -> bool:
+        """True if the counts of every frame are kept."""
+        return self._recorded_counts is not None
+
+    def record_frames(self) -> None:
+        """Also keep the bin counts of every frame.
+
+        They are needed to reweight the distribution, see
+        msibi.analysis.Histogram.distribution.
+        It must be called before any frames are added.
+        """
+        if self.n_frames > 0:
+            raise RuntimeError(
+                "Frames must be recorded before frames are added."
+            )
+        self._recorded_counts = []
+
+    def frame_counts(self) -> np.ndarray:
+        """The bin counts of every frame, with shape (n_frames, bins)."""
+        if not self.records_frames:
+            raise RuntimeError(
+                "Frames were not recorded for this histogram. "
+                "See msibi.analysis.Histogram.record_frames."
+            )
+        if not self._recorded_counts:
+            return np.zeros((0, self.bins))
+        if len(self._recorded_counts) > 1:
+            self._recorded_counts = [np.concatenate(self._recorded_counts)]
+        return self._recorded_counts[0]
+
+    def energy_change(self, delta_potential: np.ndarray) -> np.ndarray:
+        """The change of each frame's energy if the potential changes.
+
+        Every sample is given the change of the potential in its bin.
+        Pair histograms recording energy counts use those instead of the
+        counts of the distribution, see PairHistogram.record_frames.
+
+        Parameters
+        ----------
+        delta_potential : np.ndarray, shape=(bins,), required
+            The change of the potential in each bin.
+
+        Returns
+        -------
+        np.ndarray, shape=(n_frames,)
+
+        """
+        delta_potential = np.asarray(delta_potential, dtype=float)
+        delta_potential = np.where(
+            np.isfinite(delta_potential), delta_potential, 0
+        )
+        return self._energy_counts() @ delta_potential / self._multiplicity
+
+    @property
+    def records_fluctuations(self) -> bool:
+        """True if the covariance of per-frame counts is accumulated."""
+        return self._count_products is not None
+
+    def record_fluctuations(self) -> None:
+        """Also accumulate the covariance of the counts of each frame.
+
+        This is needed to find the response of the distribution to changes
+        of the potential, see msibi.analysis.Histogram.response.
+        It must be called before any frames are added.
+        """
+        if self.n_frames > 0:
+            raise RuntimeError(
+                "Fluctuations must be recorded before frames are added."
+            )
+        self._count_sum = np.zeros(self.bins)
+        self._count_products = np.zeros((self.bins, self.bins))
+
+    def count_covariance(self, weights: np.ndarray=None) -> np.ndarray:
+        """The covariance matrix of the per-frame bin counts.
+
+        If weights are given, the weighted covariance is found from
+        the recorded counts of every frame.
+        """
+        if weights is not None:
+            frame_counts = self.frame_counts()
+            weights = np.asarray(weights) / np.sum(weights)
+            mean = weights @ frame_counts
+            weighted = frame_counts * weights[:, None]
+            return weighted.T @ frame_counts - np.outer(mean, mean)
+        if not self.records_fluctuations:
+            raise RuntimeError(
+                "Fluctuations were not recorded for this histogram. "
+                "See msibi.analysis.Histogram.record_fluctuations."
+            )
+        n = max(self._fluctuation_frames, 1)
+        mean = self._count_sum / n
+        return self._count_products / n - np.outer(mean, mean)
+
+    def response(self, kT: float, weights: np.ndarray=None) -> np.ndarray:
+        """The linear response of the distribution to the potential.
+
+        Element [k, j] is the derivative of the distribution in bin k with
+        respect to the potential energy in bin j, found from the
+        fluctuations of the per-frame counts:
+        dP_k/dU_j = -(<n_k n_j> - <n_k><n_j>) / kT
+
+        Parameters
+        ----------
+        kT : float, required
+            The kT of the sampled state.
+        weights : np.ndarray, shape=(n_frames,), optional, default None
+            If given, the response of the weighted distribution.
+
+        """
+        counts = self._weighted_counts(weights)
+        covariance = self.count_covariance(weights) / self._multiplicity
+        return -self.n_frames * self._scale(counts)[:, None] * covariance / kT
+
+    @property
+    def _multiplicity(self) -> int:
+        """The number of times each interaction is counted."""
+        return 1
+
+    def _energy_counts(self) -> np.ndarray:
+        """The per-frame counts of the interactions that feel the
+        potential, shape (n_frames, bins).
+        """
+        return self.frame_counts()
+
+    def _scale(self, counts: np.ndarray=None) -> np.ndarray:
+        """The factor of each bin converting counts into the distribution."""
+        if counts is None:
+            counts = self.counts
+        return np.full(self.bins, 1 / np.sum(counts))
+
+    def _weighted_counts(self, weights: np.ndarray=None) -> np.ndarray:
+        """The total counts, or the weighted counts scaled to n_frames."""
+        if weights is None:
+            return self.counts
+        weights = np.asarray(weights) / np.sum(weights)
+        return self.n_frames * (weights @ self.frame_counts())
+
+    def _add_frame_counts(self, frame_counts: np.ndarray) -> None:
+        """Add the counts of a stack of frames, shape (n_frames, bins)."""
+        if self.records_frames:
+            self._recorded_counts.append(frame_counts)
+        if self.records_fluctuations:
+            self._count_sum += frame_counts.sum(axis=0)
+            self._count_products += frame_counts.T @ frame_counts
+            self._fluctuation_frames += len(frame_counts)
+
+    def _samples(
+            self,
+            positions: np.ndarray,
+            boxes: np.ndarray,
+            topology: Topology
+    ) -> np.ndarray:
+        raise NotImplementedError
+
+
+class BondHistogram(Histogram):
+    """Accumulates a bond length distribution.
+
+    Parameters
+    ----------
+    type1, type2 : str, required
+        Particle types of the bond.
+        Bonds listed in either order in the frame are included.
+
+    """
+
+    def __init__(
+            self,
+            type1: str,
+            type2: str,
+            x_min: float,
+            x_max: float,
+            bins: int
+    ):
+        self.types = (type1, type2)
+        super(BondHistogram, self).__init__(x_min, x_max, bins)
+
+    def _samples(self, positions, boxes, topology) -> np.ndarray:
+        group = topology.group("bonds", self.types)
+        return bond_lengths(
+            positions[:, group[:, 0]], positions[:, group[:, 1]], boxes
+        )
+
+
+class AngleHistogram(Histogram):
+    """Accumulates a bond angle distribution, in radians.
+
+    Parameters
+    ----------
+    type1, type2, type3 : str, required
+        Particle types of the angle.
+        Angles listed in either order in the frame are included.
+
+    """
+
+    def __init__(
+            self,
+            type1: str,
+            type2: str,
+            type3: str,
+            x_min: float,
+            x_max: float,
+            bins: int
+    ):
+        self.types = (type1, type2, type3)
+        super(AngleHistogram, self).__init__(x_min, x_max, bins)
+
+    def _samples(self, positions, boxes, topology) -> np.ndarray:
+        group = topology.group("angles", self.types)
+        return bond_angles(
+            positions[:, group[:, 0]],
+            positions[:, group[:, 1]],
+            positions[:, group[:, 2]],
+            boxes
+        )
+
+
+class DihedralHistogram(Histogram):
+    """Accumulates a dihedral angle distribution, in radians.
+
+    Parameters
+    ----------
+    type1, type2, type3, type4 : str, required
+        Particle types of the dihedral.
+        Dihedrals listed in either order in the frame are included.
+
+    """
+
+    def __init__(
+            self,
+            type1: str,
+            type2: str,
+            type3: str,
+            type4: str,
+            x_min: float,
+            x_max: float,
+            bins: int
+    ):
+        self.types = (type1, type2, type3, type4)
+        super(DihedralHistogram, self).__init__(x_min, x_max, bins)
+
+    def _samples(self, positions, boxes, topology) -> np.ndarray:
+        group = topology.group("dihedrals", self.types)
+        return dihedral_angles(
+            positions[:, group[:, 0]],
+            positions[:, group[:, 1]],
+            positions[:, group[:, 2]],
+            positions[:, group[:, 3]],
+            boxes
+        )
+
+
+class PairHistogram(Histogram):
+    """Accumulates a radial distribution function between two particle types.
+
+    Parameters
+    ----------
+    type1, type2 : str, required
+        Particle types of the pair.
+    exclude_bonded : bool, optional, default False
+        If True, pairs of particles in the same molecule are not counted.
+
+    Notes
+    -----
+    The RDF is scaled by the fraction of neighbor pairs that remain after
+    excluding bonded pairs, so that the distribution is comparable to
+    one calculated without exclusions.
+
+    Neighbors are found by msibi.analysis.RDFEngine, which can fill the
+    histograms of several pair types from one neighbor query per frame.
+
+    The pairs counted in the RDF are not always the pairs that feel the
+    pair potential in a simulation. The RDF may exclude every pair in the
+    same molecule, while the neighbor list only excludes bonded pairs.
+    To reweight the RDF, see PairHistogram.record_frames.
+
+    """
+
+    def __init__(
+            self,
+            type1: str,
+            type2: str,
+            x_min: float,
+            x_max: float,
+            bins: int,
+            exclude_bonded: bool=False
+    ):
+        self.types = (type1, type2)
+        self.exclude_bonded = exclude_bonded
+        self._ideal_density = 0.0
+        self._pre_filter = 0
+        self._post_filter = 0
+        self._dimensions = 3
+        self._energy_exclusions = None
+        self._recorded_energy_counts = None
+        super(PairHistogram, self).__init__(x_min, x_max, bins)
+
+    @property
+    def parameters(self) -> dict:
+        """The settings that define this histogram."""
+        return dict(
+            super(PairHistogram, self).parameters,
+            exclude_bonded=self.exclude_bonded
+        )
+
+    @property
+    def normalization(self) -> float:
+        """Fraction of neighbor pairs left after excluding bonded pairs."""
+        if not self.exclude_bonded or self._pre_filter == 0:
+            return 1.0
+        return self._post_filter / self._pre_filter
+
+    def add_frames(self, positions, boxes, topology) -> None:
+        RDFEngine(n_threads=1).compute(positions, boxes, topology, [self])
+
+    def record_frames(self, energy_exclusions: list=None) -> None:
+        """Also keep the bin counts of every frame.
+
+        They are needed to reweight the distribution, see
+        msibi.analysis.Histogram.distribution.
+        It must be called before any frames are added.
+
+        Parameters
+        ----------
+        energy_exclusions : list of str, optional, default None
+            If given, the counts used to find the energy change of each
+            frame are also kept. They hold every pair within the cutoff
+            except those the neighbor list of the simulation excludes,
+            see msibi.analysis.Topology.excluded_pairs.
+
+        """
+        super(PairHistogram, self).record_frames()
+        if energy_exclusions is not None:
+            self._energy_exclusions = tuple(energy_exclusions)
+            self._recorded_energy_counts = []
+
+    def distribution(self, weights: np.ndarray=None) -> np.ndarray:
+        """The RDF with shape (bins, 2).
+
+        The first column holds the bin centers, and the second column holds
+        g(r) scaled by the bonded exclusion normalization.
+
+        Parameters
+        ----------
+        weights : np.ndarray, shape=(n_frames,), optional, default None
+            If given, the RDF is the weighted average over frames.
+            The per-frame counts must have been recorded,
+            see msibi.analysis.Histogram.record_frames.
+
+        """
+        rdf = self._weighted_counts(weights) * self._scale()
+        return np.stack((self.bin_centers, rdf)).T
+
+    @property
+    def _multiplicity(self) -> int:
+        """Pairs of the same type are counted once from each particle."""
+        return 2 if self.types[0] == self.types[1] else 1
+
+    def _scale(self, counts: np.ndarray=None) -> np.ndarray:
+        if self._dimensions == 2:
+            shell = np.pi * np.diff(self.edges ** 2)
+        else:
+            shell = 4 / 3 * np.pi * np.diff(self.edges ** 3)
+        return self.normalization / (self._ideal_density * shell)
+
+    def _frame_counts(
+            self,
+            query_idx: np.ndarray,
+            point_idx: np.ndarray,
+            distances: np.ndarray,
+            box: freud.box.Box,
+            topology: Topology
+    ) -> tuple:
+        """Histogram one frame's neighbor pairs that belong to this pair type.
+
+        Type1 particles are the points and type2 particles are the query
+        points, so that A-A pairs are counted once from each particle.
+        """
+        A = topology.types.index(self.types[0])
+        B = topology.types.index(self.types[1])
+        keep = (
+            (topology.typeid[point_idx] == A)
+            & (topology.typeid[query_idx] == B)
+            & (distances < self.x_max)
+        )
+        pre_filter = np.count_nonzero(keep)
+        energy_counts = None
+        if self._energy_exclusions is not None:
+            first = np.minimum(point_idx, query_idx)
+            second = np.maximum(point_idx, query_idx)
+            interacting = keep & ~np.isin(
+                first * topology.N + second,
+                topology.excluded_pairs(self._energy_exclusions)
+            )
+            energy_counts, _ = np.histogram(
+                distances[interacting],
+                bins=self.bins,
+                range=(self.x_min, self.x_max)
+            )
+        if self.exclude_bonded:
+            keep &= (
+                topology.molecules[point_idx] != topology.molecules[query_idx]
+            )
+        counts, _ = np.histogram(
+            distances[keep], bins=self.bins, range=(self.x_min, self.x_max)
+        )
+        n_A = np.count_nonzero(topology.typeid == A)
+        n_B = np.count_nonzero(topology.typeid == B)
+        ideal_density = n_A * n_B / box.volume
+        return (
+            counts,
+            ideal_density,
+            pre_filter,
+            np.count_nonzero(keep),
+            energy_counts
+        )
+
+    def _energy_counts(self) -> np.ndarray:
+        if self._recorded_energy_counts is None:
+            return self.frame_counts()
+        if not self._recorded_energy_counts:
+            return np.zeros((0, self.bins))
+        if len(self._recorded_energy_counts) > 1:
+            self._recorded_energy_counts = [
+                np.concatenate(self._recorded_energy_counts)
+            ]
+        return self._recorded_energy_counts[0]
+
+    def _accumulate(
+            self,
+            counts: np.ndarray,
+            ideal_density: float,
+            pre_filter: int,
+            post_filter: int,
+            energy_counts: np.ndarray,
+            dimensions: int
+    ) -> None:
+        self.counts += counts
+        self._ideal_density += ideal_density
+        self._pre_filter += pre_filter
+        self._post_filter += post_filter
+        self._dimensions = dimensions
+        self.n_frames += 1
+        self._add_frame_counts(counts[None])
+        if self._recorded_energy_counts is not None:
+            self._recorded_energy_counts.append(energy_counts[None])
+
+
+class RDFEngine(object):
+    """
+    Computes the RDFs of several pair types from a trajectory.
+
+    A single neighbor query over every particle of the requested types is
+    made for each frame, and the neighbor pairs are split between the
+    pair types. Frames are processed in parallel in a thread pool.
+
+    The engine keeps its thread pool, and the particle selection of the
+    last topology it was used with, so one engine per State is reused
+    across iterations.
+
+    Parameters
+    ----------
+    n_threads : int, optional, default None
+        Number of threads processing frames.
+        Defaults to the number of available CPUs.
+
+    """
+
+    def __init__(self, n_threads: int=None):
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self._executor = None
+        self._selection_key = None
+        self._selection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def compute(
+            self,
+            positions: np.ndarray,
+            boxes: np.ndarray,
+            topology: Topology,
+            histograms: list
+    ) -> None:
+        """Add a stack of frames to several pair histograms.
+
+        Parameters
+        ----------
+        positions : np.ndarray, shape=(n_frames, N, 3), required
+            Particle positions of each frame.
+        boxes : np.ndarray, shape=(n_frames, 6), required
+            Box parameters of each frame.
+        topology : msibi.analysis.Topology, required
+            The topology shared by every frame.
+        histograms : list of msibi.analysis.PairHistogram, required
+            The histograms to fill.
+
+        """
+        if not histograms:
+            return
+        import freud
+
+        selection = self._select(topology, histograms)
+        r_max = max(h.x_max for h in histograms)
+
+        def frame_counts(i):
+            box = freud.box.Box.from_box(boxes[i])
+            points = positions[i][selection]
+            aq = freud.locality.AABBQuery(box, points)
+            nlist = aq.query(
+                points, dict(r_max=r_max, exclude_ii=True)
+            ).toNeighborList()
+            query_idx = selection[nlist.query_point_indices]
+            point_idx = selection[nlist.point_indices]
+            distances = nlist.distances
+            return box.dimensions, [
+                h._frame_counts(query_idx, point_idx, distances, box, topology)
+                for h in histograms
+            ]
+
+        if self.n_threads > 1 and len(positions) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.n_threads)
+            results = self._executor.map(frame_counts, range(len(positions)))
+        else:
+            results = map(frame_counts, range(len(positions)))
+        for dimensions, frame_results in results:
+            for histogram, counts in zip(histograms, frame_results):
+                histogram._accumulate(*counts, dimensions=dimensions)
+
+    def close(self) -> None:
+        """Shut down the thread pool."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _select(self, topology: Topology, histograms: list) -> np.ndarray:
+        """Indices of every particle belonging to a requested pair type."""
+        types = sorted({t for h in histograms for t in h.types})
+        key = (id(topology), tuple(types))
+        if key != self._selection_key:
+            typeids = [topology.types.index(t) for t in types]
+            self._selection = np.where(np.isin(topology.typeid, typeids))[0]
+            self._selection_key = key
+        return self._selection
+
+
+def compute_distributions(
+        gsd_file: str,
+        histograms: dict,
+        start: int=0,
+        stop: int=None,
+        stride: int=1,
+        topology: Topology=None,
+        rdf_engine: RDFEngine=None
+) -> dict:
+    """Calculate several distributions in a single pass over a trajectory.
+
+    Only the particle positions and box of each frame are read, once,
+    and every histogram is filled from the stacked arrays.
+
+    Parameters
+    ----------
+    gsd_file : str, required
+        Path to the GSD trajectory.
+    histograms : dict, required
+        msibi.analysis.Histogram objects, keyed by any hashable value.
+    start, stop, stride : int, optional
+        The slice of frames used. Negative values count from the end.
+        The distributions of forces use the frames selected by
+        msibi.state.State.frame_slice.
+    topology : msibi.analysis.Topology, optional
+        The trajectory's topology. It is read from the first frame
+        if not given.
+    rdf_engine : msibi.analysis.RDFEngine, optional
+        The engine filling every pair histogram together.
+        A new engine is created if not given.
+
+    Returns
+    -------
+    dict
+        The distribution of each histogram, using the same keys.
+
+    """
+    if topology is None:
+        topology = Topology.from_gsd(gsd_file)
+    if rdf_engine is None:
+        rdf_engine = RDFEngine()
+    positions, boxes = read_frames(gsd_file, start=start, stop=stop, stride=stride)
+    pairs = [h for h in histograms.values() if isinstance(h, PairHistogram)]
+    rdf_engine.compute(positions, boxes, topology, pairs)
+    for histogram in histograms.values():
+        if not isinstance(histogram, PairHistogram):
+            histogram.add_frames(positions, boxes, topology)
+    return {
+        key: histogram.distribution() for key, histogram in histograms.items()
+    }
+
+
+def boltzmann_weights(delta_energy: np.ndarray, kT: float) -> np.ndarray:
+    """Normalized weights of frames whose energy changes by delta_energy.
+
+    Parameters
+    ----------
+    delta_energy : np.ndarray, shape=(n_frames,), required
+        The change of each frame's potential energy.
+    kT : float, required
+        The kT of the sampled state.
+
+    Returns
+    -------
+    np.ndarray, shape=(n_frames,)
+        The weight of each frame, summing to one.
+
+    """
+    exponent = -np.asarray(delta_energy, dtype=float) / kT
+    weights = np.exp(exponent - np.max(exponent))
+    return weights / np.sum(weights)
+
+
+def effective_sample_size(weights: np.ndarray) -> float:
+    """The effective sample size of weighted frames, as a fraction.
+
+    It is one when every frame has the same weight, and approaches
+    1 / n_frames when a single frame dominates.
+    """
+    weights = np.asarray(weights, dtype=float)
+    if len(weights) == 0:
+        return 0.0
+    return np.sum(weights) ** 2 / np.sum(weights ** 2) / len(weights)
+
+
+def read_frames(
+        gsd_file: str,
+        start: int=0,
+        stop: int=None,
+        stride: int=1
+) -> tuple:
+    """Read the particle positions and boxes of a slice of frames.
+
+    Parameters
+    ----------
+    gsd_file : str, required
+        Path to the GSD trajectory.
+    start, stop, stride : int, optional
+        The slice of frames read. Negative values count from the end.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        Positions with shape (n_frames, N, 3)
+        and boxes with shape (n_frames, 6).
+
+    """
+    import gsd.fl
+
+    with gsd.fl.open(gsd_file, "r") as f:
+        frames = range(f.nframes)[start:stop:stride]
+        positions = np.stack(
+            [_read_chunk(f, i, "particles/position") for i in frames]
+        )
+        boxes = np.stack(
+            [_read_chunk(f, i, "configuration/box") for i in frames]
+        )
+    return positions, boxes.astype(float)
+
+
+def bond_lengths(
+        pos1: np.ndarray,
+        pos2: np.ndarray,
+        box: np.ndarray
+) -> np.ndarray:
+    """Minimum image distances between two arrays of positions."""
+    return np.linalg.norm(minimum_image(pos2 - pos1, box), axis=-1)
+
+
+def bond_angles(
+        pos1: np.ndarray,
+        pos2: np.ndarray,
+        pos3: np.ndarray,
+        box: np.ndarray
+) -> np.ndarray:
+    """Angles, in radians, formed by pos1-pos2-pos3 with pos2 as the vertex."""
+    v1 = minimum_image(pos1 - pos2, box)
+    v2 = minimum_image(pos3 - pos2, box)
+    cos = np.sum(v1 * v2, axis=-1) / (
+        np.linalg.norm(v1, axis=-1) * np.linalg.norm(v2, axis=-1)
+    )
+    return np.arccos(np.clip(cos, -1.0, 1.0))
+
+
+def dihedral_angles(
+        pos1: np.ndarray,
+        pos2: np.ndarray,
+        pos3: np.ndarray,
+        pos4: np.ndarray,
+        box: np.ndarray
+) -> np.ndarray:
+    """Dihedral angles, in radians, formed by pos1-pos2-pos3-pos4."""
+    b0 = minimum_image(pos1 - pos2, box)
+    b1 = minimum_image(pos3 - pos2, box)
+    b2 = minimum_image(pos4 - pos3, box)
+    b1 = b1 / np.linalg.norm(b1, axis=-1)[..., None]
+    v = b0 - np.sum(b0 * b1, axis=-1)[..., None] * b1
+    w = b2 - np.sum(b2 * b1, axis=-1)[..., None] * b1
+    x = np.sum(v * w, axis=-1)
+    y = np.sum(np.cross(b1, v) * w, axis=-1)
+    return np.arctan2(y, x)
+
+
+def minimum_image(vectors: np.ndarray, box: np.ndarray) -> np.ndarray:
+    """Wrap vectors into the minimum image convention of a periodic box.
+
+    Parameters
+    ----------
+    vectors : np.ndarray, shape=(..., 3)
+        The vectors to wrap.
+    box : array-like, shape=(6,) or (..., 6)
+        Box parameters [Lx, Ly, Lz, xy, xz, yz] as stored in GSD files.
+        A stack of boxes wraps a matching stack of vectors, for example
+        boxes with shape (n_frames, 6) and vectors with
+        shape (n_frames, n_vectors, 3).
+
+    """
+    h = box_matrix(box)
+    frac = np.einsum("...ij,...nj->...ni", np.linalg.inv(h), vectors)
+    frac -= np.round(frac)
+    return np.einsum("...ij,...nj->...ni", h, frac)
+
+
+def box_matrix(box: np.ndarray) -> np.ndarray:
+    """Box matrices, with box vectors as columns, from GSD box parameters.
+
+    For two dimensional boxes (Lz = 0), Lz is set to one so that
+    the matrix can be inverted. The z components are not wrapped.
+
+    """
+    box = np.asarray(box, dtype=float)
+    Lx, Ly, Lz, xy, xz, yz = np.moveaxis(box, -1, 0)
+    Lz = np.where(Lz == 0, 1.0, Lz)
+    zero = np.zeros_like(Lx)
+    h = np.stack([
+        np.stack([Lx, xy * Ly, xz * Lz], axis=-1),
+        np.stack([zero, Ly, yz * Lz], axis=-1),
+        np.stack([zero, zero, Lz], axis=-1),
+    ], axis=-2)
+    return h
+
+
+def molecule_ids(n_particles: int, bonds: np.ndarray) -> np.ndarray:
+    """Label each particle with the index of the molecule it belongs to.
+
+    Molecules are the connected components of the bond graph.
+    Each molecule is labeled by the lowest particle index it contains.
+
+    """
+    labels = np.arange(n_particles)
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    if len(bonds) == 0:
+        return labels
+    while True:
+        linked = np.minimum(labels[bonds[:, 0]], labels[bonds[:, 1]])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, bonds[:, 0], linked)
+        np.minimum.at(new_labels, bonds[:, 1], linked)
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def _index_groups(group_data) -> dict:
+    """Particle indices of a frame's bonds, angles or dihedrals by type name."""
+    group = np.asarray(group_data.group, dtype=int)
+    typeid = np.asarray(group_data.typeid)
+    return {
+        name: group[typeid == i] for i, name in enumerate(group_data.types)
+    }
+
+
+def _read_chunk(f, frame: int, name: str) -> np.ndarray:
+    """Read a chunk, falling back to the first frame as gsd.hoomd does."""
+    if f.chunk_exists(frame=frame, name=name):
+        return f.read_chunk(frame=frame, name=name)
+    return f.read_chunk(frame=0, name=name)
+
+
+def block_error(histogram: Histogram, n_blocks: int=5) -> float:
+    """The statistical error of a histogram's distribution, from the spread
+    of its block averages.
+
+    The recorded frames are split into n_blocks consecutive blocks, and
+    the standard error of every bin is found from the distributions of
+    the blocks. The error is the sum of the standard errors divided by
+    twice the sum of the distribution, the same normalization as the
+    residual 1 - f_fit of msibi.utils.error_calculation.calc_similarity.
+
+    Parameters
+    ----------
+    histogram : msibi.analysis.Histogram, required
+        A histogram recording the counts of every frame,
+        see msibi.analysis.Histogram.record_frames.
+    n_blocks : int, optional, default 5
+        The number of blocks.
+
+    Returns
+    -------
+    float
+        The error, or infinity if there are fewer frames than blocks.
+
+    """
+    if n_blocks < 2:
+        raise ValueError("n_blocks must be at least 2.")
+    n_frames = len(histogram.frame_counts())
+    if n_frames < n_blocks:
+        return np.inf
+    blocks = np.array_split(np.arange(n_frames), n_blocks)
+    distributions = []
+    for block in blocks:
+        weights = np.zeros(n_frames)
+        weights[block] = 1
+        distributions.append(histogram.distribution(weights)[:, 1])
+    distributions = np.nan_to_num(np.stack(distributions))
+    errors = np.std(distributions, axis=0, ddof=1) / np.sqrt(n_blocks)
+    total = np.sum(np.abs(np.mean(distributions, axis=0)))
+    if total == 0:
+        return np.inf
+    return np.sum(errors) / (2 * total)
@@ -3,26 +3,29 @@ import os
 from typing import Union
 import warnings
 
-from cmeutils.structure import (
-    angle_distribution,
-    bond_distribution,
-    dihedral_distribution,
-    gsd_rdf
-)
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 
 import msibi
+from msibi.analysis import (
+    AngleHistogram,
+    BondHistogram,
+    DihedralHistogram,
+    PairHistogram,
+    Topology,
+    compute_distributions
+)
 from msibi.potentials import (
     bond_correction,
     lennard_jones,
     quadratic_spring,
     pair_correction
 )
+from msibi.schemes import IBI, UpdateScheme
 from msibi.utils.error_calculation import calc_similarity
-from msibi.utils.smoothing import savitzky_golay
+from msibi.utils.history import HistoryBuffer
+from msibi.utils.smoothing import Smoother, get_smoother
 from msibi.utils.sorting import natural_sort
+from msibi.utils.store import IterationStore
 
 
 class Force(object):
@@ -52,6 +55,22 @@ class Force(object):
         It is also used in determining the bin size of the target and query
         distributions.
 
+    Attributes
+    ----------
+    update_scheme : msibi.schemes.UpdateScheme
+        The scheme used to update this force's potential.
+        If None, the update scheme of the optimization is used,
+        see msibi.optimize.MSIBI.
+    accelerator : msibi.schemes.AndersonAcceleration
+        If set, the potential updates of this force are accelerated
+        by Anderson mixing. Defaults to None.
+    potential_history : msibi.utils.history.HistoryBuffer
+        The potential before the first update, followed by the potential
+        after each update, so n updates give n + 1 entries. A potential
+        changed between updates, for example by smoothing, is also stored
+        before the next update. Earlier versions stored the potential
+        both before and after every update, two entries per iteration.
+
     """
 
     def __init__(
@@ -69,20 +88,26 @@ class Force(object):
         self.name = name
         self.optimize = optimize
         self.correction_form = correction_form
+        self.update_scheme = None
+        self.accelerator = None
         self.format = None
         self.xmin = None
         self.xmax = None
         self.dx = None
         self.x_range = None
-        self.potential_history = []
+        self._history_policy = {
+            "retention": None, "keep_every": 1, "spill_dir": None
+        }
+        self.potential_history = self._new_history("potential_history")
+        self._correction_cutoffs = []
         self._potential = None
+        self._potential_version = 0
+        self._table_cache = None
         self._smoothing_window = 3
         self._smoothing_order = 1
+        self._smoother = None
         self._nbins = nbins
         self._states = dict()
-        self._head_correction_history = []
-        self._tail_correction_history = []
-        self._learned_potential_history = []
 
     def __repr__(self):
         return (
@@ -109,14 +134,159 @@ class Force(object):
                 "msibi.forces.Force.set_from_file()"
             )
         self._potential = array
+        self._potential_changed()
 
     @property
     def force(self) -> np.ndarray:
-        """The force values F(x)."""
+        """The force values F(x).
+
+        This is a read-only array, recalculated only when the potential
+        changes.
+        """
         if self.format != "table":
             warnings.warn(f"{self} is not using a table potential.")
             return None
-        return -1.0 * np.gradient(self.potential, self.dx)
+        return self._table_arrays()[1]
+
+    def set_history_policy(
+            self,
+            retention: int=None,
+            keep_every: int=1,
+            spill_dir: str=None
+    ) -> None:
+        """Set how the potential and distribution histories are stored.
+
+        This must be set before the optimization starts.
+
+        Parameters
+        ----------
+        retention : int, optional, default None
+            If given, only the most recent retention entries of each
+            history are kept.
+        keep_every : int, optional, default 1
+            Only every keep_every-th entry of each history is kept.
+        spill_dir : str, optional, default None
+            If given, histories are stored in memory-mapped `.npy` files
+            in this directory instead of in memory. The files are named
+            by the force class, name and whether it is optimized, for
+            example `Bond_A-B_optimized_potential_history.npy`.
+
+        """
+        if len(self.potential_history) > 0:
+            raise RuntimeError(
+                "The history policy can not be changed after the "
+                "optimization has started."
+            )
+        self._history_policy = {
+            "retention": retention,
+            "keep_every": keep_every,
+            "spill_dir": spill_dir
+        }
+        self.potential_history = self._new_history("potential_history")
+        for state, state_dict in self._states.items():
+            state_dict["distribution_history"] = self._new_history(
+                f"{state.name}_distribution_history"
+            )
+
+    @property
+    def _head_correction_history(self) -> list:
+        """The head correction of each kept potential update."""
+        return [
+            potential[0:head_cut]
+            for potential, head_cut, tail_cut in self._corrections()
+        ]
+
+    @property
+    def _tail_correction_history(self) -> list:
+        """The tail correction of each kept potential update."""
+        return [
+            potential[tail_cut:]
+            for potential, head_cut, tail_cut in self._corrections()
+        ]
+
+    @property
+    def _learned_potential_history(self) -> list:
+        """The uncorrected region of each kept potential update."""
+        return [
+            potential[head_cut + 1:tail_cut]
+            for potential, head_cut, tail_cut in self._corrections()
+        ]
+
+    def _corrections(self):
+        """The updated potential and correction cutoffs of each update
+        whose potential is still kept in the potential history.
+        """
+        for entry, head_cut, tail_cut in self._correction_cutoffs:
+            potential = self.potential_history.get(entry)
+            if potential is not None:
+                yield potential, head_cut, tail_cut
+
+    def _new_history(self, name: str) -> HistoryBuffer:
+        """Create an empty history using this force's history policy."""
+        spill_dir = self._history_policy["spill_dir"]
+        spill_path = None
+        if spill_dir:
+            # Forces of different classes, or an optimized and a static
+            # force, may share a name.
+            role = "optimized" if self.optimize else "static"
+            prefix = "_".join(self._key + (role,))
+            spill_path = os.path.join(spill_dir, f"{prefix}_{name}.npy")
+        return HistoryBuffer(
+            retention=self._history_policy["retention"],
+            keep_every=self._history_policy["keep_every"],
+            spill_path=spill_path
+        )
+
+    def _potential_changed(self) -> None:
+        """Mark the force and table entry as out of date.
+
+        This must be called after _potential is changed in place.
+        """
+        self._potential_version += 1
+
+    def _table_arrays(self) -> tuple:
+        """The potential, force and table entry of the current potential.
+
+        They are calculated once per change of the potential, and the
+        arrays are read-only and contiguous so they can be passed to
+        hoomd without being copied.
+        """
+        if (
+                self._table_cache is None
+                or self._table_cache[0] != self._potential_version
+        ):
+            potential = _read_only(self._potential)
+            force = _read_only(-1.0 * np.gradient(potential, self.dx))
+            self._table_cache = (
+                self._potential_version,
+                force,
+                self._build_table_entry(potential, force)
+            )
+        return self._table_cache
+
+    def _table_entry(self, potential: np.ndarray=None) -> dict:
+        """The hoomd table parameters of this force.
+
+        If a potential is given, the parameters are built from it instead
+        of the force's own potential, and are not cached.
+        """
+        if potential is None:
+            return dict(self._table_arrays()[2])
+        potential = _read_only(np.array(potential, dtype=float))
+        force = _read_only(-1.0 * np.gradient(potential, self.dx))
+        return self._build_table_entry(potential, force)
+
+    def _build_table_entry(
+            self,
+            potential: np.ndarray,
+            force: np.ndarray
+    ) -> dict:
+        raise NotImplementedError
+
+    @property
+    def _key(self) -> tuple:
+        """Identifies this force in a state's query distributions."""
+        return (self.__class__.__name__, self.name)
 
     @property
     def smoothing_window(self) -> int:
@@ -128,6 +298,7 @@ class Force(object):
         if not isinstance(value, int) or value <= 0:
             raise ValueError("The smoothing window must be an integer.")
         self._smoothing_window = value
+        self._smoother = None
         for state in self._states:
             self._add_state(state)
 
@@ -141,9 +312,25 @@ class Force(object):
         if not isinstance(value, int) or value <= 0:
             raise ValueError("The smoothing order must be an integer.")
         self._smoothing_order = value
+        self._smoother = None
         for state in self._states:
             self._add_state(state)
 
+    @property
+    def smoother(self) -> Smoother:
+        """The Savitzky Golay filter used in smoothing distributions
+        and potentials.
+
+        It is shared by every force using the same smoothing window and
+        order, so its filter coefficients are only calculated once.
+        """
+        if self._smoother is None:
+            self._smoother = get_smoother(
+                window_size=self.smoothing_window,
+                order=self.smoothing_order
+            )
+        return self._smoother
+
     @property
     def nbins(self) -> int:
         """The number of bins used in calculating distributions."""
@@ -174,11 +361,7 @@ class Force(object):
                 "This force is not a table potential and is not mutable."
             )
         potential = np.copy(self.potential)
-        self.potential = savitzky_golay(
-            y=potential,
-            window_size=self.smoothing_window,
-            order=self.smoothing_order,
-        )
+        self.potential = self.smoother.smooth(potential)
 
     def save_potential(self, file_path: str) -> None:
         """Save the x-range, potential and force to a csv file.
@@ -198,6 +381,8 @@ class Force(object):
         calling this method.
 
         """
+        import pandas as pd
+
         if self.format != "table":
             raise RuntimeError(
                 "This force is not a table potential and "
@@ -213,6 +398,9 @@ class Force(object):
     def save_potential_history(self, file_path: str) -> None:
         """Save the potential history of the force to a `npy` file.
 
+        The file holds one row per entry of Force.potential_history,
+        the initial potential followed by the potential after each update.
+
         Parameters
         ----------
         file_path : str, required
@@ -224,7 +412,7 @@ class Force(object):
                 "This force is not a table potential and "
                 "cannot be saved to a .txt file."
             )
-        np.save(file_path, np.asarray(self.potential_history))
+        self.potential_history.save(file_path)
 
     def save_state_data(self, state: msibi.state.State, file_path: str) -> None:
         """Save the distribution data of a state as a a dictionary to a `npz` file.
@@ -276,6 +464,8 @@ class Force(object):
         and smoothing order.
 
         """
+        import matplotlib.pyplot as plt
+
         # TODO: Make custom error
         if not self.optimize:
             raise RuntimeError(
@@ -289,11 +479,7 @@ class Force(object):
         plt.xlabel("x")
         plt.plot(target[:, 0], target[:, 1])
         if self.smoothing_window:
-            y_smoothed = savitzky_golay(
-                target[:, 1],
-                window_size=self.smoothing_window,
-                order=self.smoothing_order
-            )
+            y_smoothed = self.smoother.smooth(target[:, 1])
             plt.plot(target[:, 0], y_smoothed, label="Smoothed")
             plt.legend()
         if file_path:
@@ -310,6 +496,8 @@ class Force(object):
             If given, the plot will be saved to this location.
 
        """
+        import matplotlib.pyplot as plt
+
         if not self.optimize:
             raise RuntimeError("This force object is not set to be optimized.")
         fig = plt.figure()
@@ -329,6 +517,8 @@ class Force(object):
             If given, the plot will be saved to this location.
 
         """
+        import matplotlib.pyplot as plt
+
         plt.plot(self.x_range, self.potential, "o-")
         plt.xlim(xlim)
         plt.ylim(ylim)
@@ -347,6 +537,8 @@ class Force(object):
             If given, the plot will be saved to this location.
 
         """
+        import matplotlib.pyplot as plt
+
         for i, pot in enumerate(self.potential_history):
             plt.plot(self.x_range, pot, "o-", label=i)
 
@@ -360,7 +552,9 @@ class Force(object):
             plt.savefig(file_path, bbox_inches='tight')
 
     def plot_distribution_comparison(self, state: msibi.state.State, file_path=None):
-        final_dist = self.distribution_history(state=state)[-1]
+        import matplotlib.pyplot as plt
+
+        final_dist = self._states[state]["current_distribution"]
         target_dist = self.target_distribution(state=state)
 
         plt.plot(final_dist[:, 0], final_dist[:, 1], "o-", label="MSIBI")
@@ -381,6 +575,11 @@ class Force(object):
         state : msibi.state.State, required
             The state to use for calculating the distribution.
 
+        Returns
+        -------
+        msibi.utils.history.HistoryBuffer
+            The distribution of each iteration, as (nbins, 2) arrays.
+
         """
         return self._states[state]["distribution_history"]
 
@@ -485,6 +684,8 @@ class Force(object):
         Also see: msibi.forces.Force.save_potential()
 
         """
+        import pandas as pd
+
         self.format = "table"
         df = pd.read_csv(file_path)
         self.x_range = df["x"].values
@@ -509,12 +710,8 @@ class Force(object):
                 state=state, query=False
             )
             if self.smoothing_window and self.smoothing_order:
-                target_distribution[:, 1] = savitzky_golay(
-                    y=target_distribution[:, 1],
-                    window_size=self.smoothing_window,
-                    order=self.smoothing_order,
-                    deriv=0,
-                    rate=1
+                target_distribution[:, 1] = self.smoother.smooth(
+                    target_distribution[:, 1]
                 )
 
         else:
@@ -524,7 +721,9 @@ class Force(object):
             "current_distribution": None,
             "alpha0": state.alpha0,
             "f_fit": [],
-            "distribution_history": [],
+            "distribution_history": self._new_history(
+                f"{state.name}_distribution_history"
+            ),
             "path": state.dir
         }
 
@@ -539,16 +738,11 @@ class Force(object):
         """
         distribution = self._get_state_distribution(state, query=True)
         if self.smoothing_window and self.smoothing_order:
-            distribution[:, 1] = savitzky_golay(
-                y=distribution[:, 1],
-                window_size=self.smoothing_window,
-                order=self.smoothing_order,
-                deriv=0,
-                rate=1
-            )
+            distribution[:, 1] = self.smoother.smooth(distribution[:, 1])
             negative_idx = np.where(distribution[:, 1] < 0)[0]
             distribution[:, 1][negative_idx] = 0
         self._states[state]["current_distribution"] = distribution
+        self._states[state]["response"] = state._query_responses.get(self._key)
 
         f_fit = calc_similarity(
             distribution[:, 1],
@@ -569,19 +763,74 @@ class Force(object):
             State used in calculating the distribution.
         query: bool
             If True, uses the most recent query trajectory.
-            If False, uses the state's target trajectory.
+            If False, uses the state's target trajectory, loading
+            the distribution from the state's target_cache when one is set.
 
         """
         if query:
-            traj = state.query_traj
-        else:
-            traj = state.traj_file
-        return self._get_distribution(state=state, gsd_file=traj)
+            if self._key in state._query_distributions:
+                return np.copy(state._query_distributions[self._key])
+            return self._get_distribution(
+                state=state,
+                gsd_file=state.query_traj,
+                topology=state._topology(query=True)
+            )
+        cache = state.target_cache
+        if cache is None:
+            return self._get_distribution(
+                state=state,
+                gsd_file=state.traj_file,
+                topology=state._topology(query=False)
+            )
+        key = cache.key(
+            state.traj_file,
+            frames=state.frame_slice,
+            **self._histogram(state).parameters
+        )
+        distribution = cache.get(key)
+        if distribution is None:
+            distribution = self._get_distribution(
+                state=state,
+                gsd_file=state.traj_file,
+                topology=state._topology(query=False)
+            )
+            cache.set(key, distribution)
+        return distribution
+
+    def _get_distribution(
+            self,
+            state: msibi.state.State,
+            gsd_file: str,
+            topology: Topology=None
+    ) -> np.ndarray:
+        """Calculate this force's distribution from a trajectory.
+
+        Uses the frames of the trajectory selected by State.frame_slice.
+
+        Parameters
+        ----------
+        state: msibi.state.State, required
+            State used in calculating the distribution.
+        gsd_file: str, required
+            Path to the GSD file used.
+        topology: msibi.analysis.Topology, optional
+            The trajectory's topology. It is read from the file if not given.
+
+        """
+        distributions = compute_distributions(
+            gsd_file=gsd_file,
+            histograms={self._key: self._histogram(state)},
+            topology=topology,
+            rdf_engine=state._rdf_engine,
+            **state.frame_slice
+        )
+        return distributions[self._key]
 
     def _save_current_distribution(
             self,
             state: msibi.state.State,
-            iteration: int
+            iteration: int,
+            store: IterationStore=None
     ) -> None:
         """Save the corresponding distrubiton for a given state to a file.
 
@@ -591,40 +840,137 @@ class Force(object):
             The state used in finding the distribution.
         iteration : int
             Current iteration step, used in the filename.
+        store : msibi.utils.store.IterationStore, optional, default None
+            If given, the distribution is appended to this store
+            instead of being written to a text file.
 
         """
         distribution = self._states[state]["current_distribution"]
         distribution[:, 0] -= self.dx / 2
+        if store is not None:
+            store.append(
+                "distribution",
+                distribution,
+                iteration=iteration,
+                force=self.name,
+                state=state.name
+            )
+            return
         fname = f"dist_{self.name}-state_{state.name}-step_{iteration}.txt"
         fpath = os.path.join(state.dir, fname)
         np.savetxt(fpath, distribution)
 
-    def _update_potential(self) -> None:
+    def _alpha(self, state: msibi.state.State) -> np.ndarray:
+        """The alpha values of a state over this force's x range.
+
+        They are calculated once and reused until the state's alpha0
+        or alpha_form changes.
+        """
+        state_dict = self._states[state]
+        key = (state.alpha0, state.alpha_form)
+        if state_dict.get("alpha_key") != key:
+            alpha = state.alpha(pot_x_range=self.x_range, dx=self.dx)
+            state_dict["alpha"] = np.broadcast_to(
+                np.asarray(alpha, dtype=float), self.x_range.shape
+            )
+            state_dict["alpha_key"] = key
+        return state_dict["alpha"]
+
+    def _stacked_distributions(self) -> tuple:
+        """The arrays used in the IBI step, stacked over every state.
+
+        Returns
+        -------
+        tuple of np.ndarray
+            The current distributions and target distributions, both with
+            shape (n_states, nbins), the kT of each state, and the alpha
+            values of each state with shape (n_states, nbins).
+
+        """
+        states = list(self._states)
+        current = np.stack([
+            self._states[state]["current_distribution"][:, 1]
+            for state in states
+        ])
+        target = np.stack([
+            self._states[state]["target_distribution"][:, 1]
+            for state in states
+        ])
+        kT = np.array([state.kT for state in states], dtype=float)
+        alpha = np.stack([self._alpha(state) for state in states])
+        return current, target, kT, alpha
+
+    def _stacked_responses(self) -> np.ndarray:
+        """The response of each state's distribution to the potential,
+        with shape (n_states, nbins, nbins).
+        """
+        responses = [
+            state_dict.get("response") for state_dict in self._states.values()
+        ]
+        if any(response is None for response in responses):
+            raise RuntimeError(
+                f"The response of the distributions of {self.name} to its "
+                "potential was not recorded during the query simulations."
+            )
+        return np.stack(responses)
+
+    def _potential_step(self, scheme: UpdateScheme) -> np.ndarray:
+        """Find the change to the potential using an update scheme."""
+        responses = None
+        if scheme.requires_fluctuations:
+            responses = self._stacked_responses()
+        return scheme.step(*self._stacked_distributions(), responses=responses)
+
+    def _update_potential(self, delta: np.ndarray=None) -> None:
         """Compare distributions of current iteration against target,
         and update the potential via Boltzmann inversion.
 
+        Parameters
+        ----------
+        delta : np.ndarray, optional, default None
+            The step of this force, when it was already found together
+            with other forces. Otherwise it is found using this force's
+            update scheme, or IBI if it has none.
+            The step is then accelerated if this force has an accelerator.
+
         """
-        self.potential_history.append(np.copy(self.potential))
-        for state in self._states:
-            kT = state.kT
-            current_dist = self._states[state]["current_distribution"]
-            target_dist = self._states[state]["target_distribution"]
-            self._states[state]["distribution_history"].append(current_dist)
-            N = len(self._states)
-            # TODO: Use potential setter here? Does it work with +=?
-            alpha_array = state.alpha(pot_x_range=self.x_range, dx=self.dx)
-            self._potential += alpha_array * (
-                    kT * np.log(current_dist[:, 1] / target_dist[:, 1]) / N
+        if delta is None:
+            delta = self._potential_step(self.update_scheme or IBI())
+        if self.accelerator is not None:
+            fit = np.mean([
+                state_dict["f_fit"][-1] for state_dict in self._states.values()
+            ])
+            delta = self.accelerator.step(
+                force=self, potential=self.potential, delta=delta, fit=fit
             )
+        history = self.potential_history
+        # The potential is only recorded before the update if it changed
+        # since the last update, e.g. the first update or after smoothing.
+        if history.last is None or not np.array_equal(
+                history.last, self.potential
+        ):
+            history.append(self.potential)
+        for state_dict in self._states.values():
+            distribution = state_dict["current_distribution"]
+            if state_dict["distribution_history"].x is None:
+                state_dict["distribution_history"].x = distribution[:, 0]
+            state_dict["distribution_history"].append(distribution[:, 1])
+        self._potential += delta
         # TODO: Add correction funcs to Force classes
         # TODO: Smoothing potential before doing head and tail corrections?
         self._potential, real, head_cut, tail_cut = self._correction_function(
             self.x_range, self.potential, self.correction_form
         )
-        self.potential_history.append(np.copy(self.potential))
-        self._head_correction_history.append(np.copy(self.potential[0:head_cut]))
-        self._tail_correction_history.append(np.copy(self.potential[tail_cut:]))
-        self._learned_potential_history.append(np.copy(self.potential[real]))
+        history.append(self.potential)
+        self._correction_cutoffs.append(
+            (history.n_appended - 1, head_cut, tail_cut)
+        )
+        if len(history) > 0:
+            self._correction_cutoffs = [
+                cutoffs for cutoffs in self._correction_cutoffs
+                if cutoffs[0] >= history.indices[0]
+            ]
+        self._potential_changed()
 
 
 class Bond(Force):
@@ -704,39 +1050,33 @@ class Bond(Force):
         self.force_init = "Harmonic"
         self.force_entry = dict(r0=r0, k=k)
 
-    def _table_entry(self) -> dict:
+    def _build_table_entry(
+            self,
+            potential: np.ndarray,
+            force: np.ndarray
+    ) -> dict:
         table_entry = {
             "r_min": self.x_min,
             "r_max": self.x_max,
-            "U": self.potential,
-            "F": self.force
+            "U": potential,
+            "F": force
         }
         return table_entry
 
-    def _get_distribution(
-            self,
-            state: msibi.state.State,
-            gsd_file: str
-    ) -> np.ndarray:
-        """Calculate a bond length distribution.
+    def _histogram(self, state: msibi.state.State) -> BondHistogram:
+        """Create a histogram accumulating this bond's length distribution.
 
         Parameters
         ----------
         state: msibi.state.State, required
-            State used in calculating the distribution.
-        gsd_file: str, required
-            Path to the GSD file used.
+            State the distribution is calculated for.
 
         """
-        return bond_distribution(
-            gsd_file=gsd_file,
-            A_name=self.type1,
-            B_name=self.type2,
-            start=-state.n_frames,
-            histogram=True,
-            normalize=True,
-            l_min=self.x_min,
-            l_max=self.x_max,
+        return BondHistogram(
+            type1=self.type1,
+            type2=self.type2,
+            x_min=self.x_min,
+            x_max=self.x_max,
             bins=self.nbins + 1
         )
 
@@ -819,35 +1159,29 @@ class Angle(Force):
         self.force_init = "Harmonic"
         self.force_entry = dict(t0=t0, k=k)
 
-    def _table_entry(self) -> dict:
-        table_entry = {"U": self.potential, "tau": self.force}
+    def _build_table_entry(
+            self,
+            potential: np.ndarray,
+            force: np.ndarray
+    ) -> dict:
+        table_entry = {"U": potential, "tau": force}
         return table_entry
 
-    def _get_distribution(
-            self,
-            state: msibi.state.State,
-            gsd_file: str
-    ) -> np.ndarray:
-        """Calculate a bond angle distribution.
+    def _histogram(self, state: msibi.state.State) -> AngleHistogram:
+        """Create a histogram accumulating this angle's distribution.
 
         Parameters
         ----------
         state: msibi.state.State, required
-            State used in calculating the distribution.
-        gsd_file: str, required
-            Path to the GSD file used.
+            State the distribution is calculated for.
 
         """
-        return angle_distribution(
-            gsd_file=gsd_file,
-            A_name=self.type1,
-            B_name=self.type2,
-            C_name=self.type3,
-            start=-state.n_frames,
-            histogram=True,
-            normalize=True,
-            theta_min=self.x_min,
-            theta_max=self.x_max,
+        return AngleHistogram(
+            type1=self.type1,
+            type2=self.type2,
+            type3=self.type3,
+            x_min=self.x_min,
+            x_max=self.x_max,
             bins=self.nbins + 1
         )
 
@@ -946,44 +1280,35 @@ class Pair(Force):
         )
         self.force_init = "Table"
 
-    def _table_entry(self) -> dict:
+    def _build_table_entry(
+            self,
+            potential: np.ndarray,
+            force: np.ndarray
+    ) -> dict:
         table_entry = {
             "r_min": self.x_min,
-            "U": self.potential,
-            "F": self.force,
+            "U": potential,
+            "F": force,
         }
         return table_entry
 
-    def _get_distribution(
-            self,
-            state: msibi.state.State,
-            gsd_file: str
-    ) -> np.ndarray:
-        """Calculate a pair distribution.
+    def _histogram(self, state: msibi.state.State) -> PairHistogram:
+        """Create a histogram accumulating this pair's RDF.
 
         Parameters
         ----------
         state: msibi.state.State, required
-            State used in calculating the distribution.
-        gsd_file: str, required
-            Path to the GSD file used.
+            State the distribution is calculated for.
 
         """
-        rdf, N = gsd_rdf(
-            gsdfile=gsd_file,
-            A_name=self.type1,
-            B_name=self.type2,
-            r_min=self.x_min,
-            r_max=self.r_cut,
-            exclude_bonded=state.exclude_bonded,
-            start=-state.n_frames,
-            stop=-1,
-            bins=self.nbins + 1
+        return PairHistogram(
+            type1=self.type1,
+            type2=self.type2,
+            x_min=self.x_min,
+            x_max=self.r_cut,
+            bins=self.nbins + 1,
+            exclude_bonded=state.exclude_bonded
         )
-        x = rdf.bin_centers
-        y = rdf.rdf * N
-        dist = np.vstack([x, y])
-        return dist.T
 
 
 class Dihedral(Force):
@@ -1077,33 +1402,36 @@ class Dihedral(Force):
         self.force_init = "Periodic"
         self.force_entry = dict(phi0=phi0, k=k, d=d, n=n)
 
-    def _table_entry(self) -> dict:
-        table_entry = {"U": self.potential, "tau": self.force}
+    def _build_table_entry(
+            self,
+            potential: np.ndarray,
+            force: np.ndarray
+    ) -> dict:
+        table_entry = {"U": potential, "tau": force}
         return table_entry
 
-    def _get_distribution(
-            self,
-            state: msibi.state.State,
-            gsd_file: str
-    ) -> np.ndarray:
-        """Calculate a dihedral distribution.
+    def _histogram(self, state: msibi.state.State) -> DihedralHistogram:
+        """Create a histogram accumulating this dihedral's distribution.
 
         Parameters
         ----------
         state: msibi.state.State, required
-            State used in calculating the distribution.
-        gsd_file: str, required
-            Path to the GSD file used.
+            State the distribution is calculated for.
 
         """
-        return dihedral_distribution(
-                gsd_file=gsd_file,
-                A_name=self.type1,
-                B_name=self.type2,
-                C_name=self.type3,
-                D_name=self.type4,
-                start=-state.n_frames,
-                histogram=True,
-                normalize=True,
-                bins=self.nbins + 1
+        return DihedralHistogram(
+            type1=self.type1,
+            type2=self.type2,
+            type3=self.type3,
+            type4=self.type4,
+            x_min=-np.pi,
+            x_max=np.pi,
+            bins=self.nbins + 1
         )
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    """A read-only, contiguous float copy of array."""
+    array = np.array(array, dtype=float, order="C")
+    array.flags.writeable = False
+    return array
@@ -1,12 +1,30 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import cProfile
+import functools
+import multiprocessing
 import os
 import pickle
 import shutil
+import time
+import warnings
 
-import hoomd
-from hoomd.md.methods import ConstantVolume, ConstantPressure
 import numpy as np
 
 import msibi
+from msibi.analysis import (
+        PAIR_EXCLUSIONS,
+        boltzmann_weights,
+        compute_distributions,
+        effective_sample_size
+)
+from msibi.schedules import StepSchedule
+from msibi.schemes import IBI, UpdateScheme
+from msibi.utils.store import IterationStore
+from msibi.utils.timing import Timer
 
 
 class MSIBI(object):
@@ -32,10 +50,24 @@ class MSIBI(object):
         The number of frames between snapshots written to query.gsd
     n_steps : int, required
         How many steps to run the query simulations
-    nlist_exclusions : list of str, optional, default ["1-2", "1-3"]
-        Sets the pair exclusions used during the optimization simulations
+    nlist_exclusions : list of str, optional, default ["bond", "angle"]
+        Sets the pair exclusions used during the optimization simulations.
+        Pairs can only be reweighted, see run_optimization, with the
+        exclusions in msibi.analysis.PAIR_EXCLUSIONS.
     seed : int, optional, default 42
         Random seed to use during the simulation
+    update_scheme : msibi.schemes.UpdateScheme, optional, default None
+        The scheme used to update the optimized potentials.
+        Defaults to msibi.schemes.IBI. A force's own update_scheme,
+        if it has one, takes precedence.
+    store : msibi.utils.store.IterationStore, optional, default None
+        If given, the distributions, fit scores and potentials of the
+        optimized forces, the duration of each iteration, and the timing
+        record of every phase are appended to this store instead of
+        writing a text file per distribution.
+    timing_file : str, optional, default None
+        If given, the timing record of every phase of the optimization
+        is appended to this file as a line of JSON.
 
     Attributes
     ----------
@@ -49,6 +81,24 @@ class MSIBI(object):
         All angles to be used in the optimization procedure.
     dihedrals : list of msibi.bonds.Dihedral
         All dihedrals to be used in the optimization procedure.
+    frozen_states : list of msibi.state.State
+        States that converged and are no longer simulated during
+        the current run_optimization call. See freeze_converged.
+    stop_reason : str
+        Why the last run_optimization call stopped early;
+        "converged", "time_budget", or None if every iteration ran.
+    timer : msibi.utils.timing.Timer
+        Records the wall time and resource use of each phase of
+        the optimization. See MSIBI.timings.
+    speculation_hits : int
+        The number of speculative query simulations that were kept.
+        See the speculate parameter of run_optimization.
+    speculation_misses : int
+        The number of speculative query simulations that were discarded.
+    n_steps : int
+        The number of simulation steps of each query simulation during
+        run_optimization. Callbacks may change it between iterations,
+        unless a step_schedule is used.
 
     Methods
     -------
@@ -56,12 +106,20 @@ class MSIBI(object):
         Add a state point to be included in optimizing forces.
     add_force(msibi.forces.Force)
         Add the required interaction objects. See forces.py
-    run_optimization(n_iterations, n_steps, backup_trajectories)
+    run_optimization(n_iterations, n_steps, backup_trajectories, parallel_states)
         Performs iterations of query simulations and potential updates
         resulting in a final optimized potential.
     pickle_forces()
         Saves a pickle file containing a list of Hoomd force objects
         as they existed in the most recent optimization run.
+    save_checkpoint(file_path)
+        Saves the state of the optimization so it can be resumed.
+    add_callback(on_iteration_end, on_state_simulated)
+        Adds functions called during the optimization.
+    request_stop()
+        Stops the optimization at the end of the current iteration.
+    load_checkpoint(file_path)
+        Creates an MSIBI instance from a checkpoint file.
 
     """
 
@@ -76,7 +134,12 @@ class MSIBI(object):
             gsd_period: int,
             nlist_exclusions: list[str]=["bond", "angle"],
             seed: int=42,
+            update_scheme: UpdateScheme=None,
+            store: IterationStore=None,
+            timing_file: str=None,
     ):
+        import hoomd
+
         if integrator_method not in [
                 hoomd.md.methods.ConstantVolume,
                 hoomd.md.methods.ConstantPressure
@@ -94,12 +157,34 @@ class MSIBI(object):
         self.dt = dt
         self.gsd_period = gsd_period
         self.seed = seed
+        self.update_scheme = update_scheme or IBI()
+        self.store = store
+        self.timer = Timer(jsonl_file=timing_file)
+        self._n_stored_timings = 0
+        self._record_frames = False
         self.nlist_exclusions = nlist_exclusions
         self.n_iterations = 0
+        self.frozen_states = []
+        self.stop_reason = None
+        self.speculation_hits = 0
+        self.speculation_misses = 0
+        self._previous_potentials = dict()
+        self.n_steps = None
+        self._step_schedule = None
+        self._callbacks = {"on_iteration_end": [], "on_state_simulated": []}
+        self._stop_requested = False
         self.states = []
         self.forces = []
         self._optimize_forces = []
 
+    def __getstate__(self):
+        # Callbacks are often lambdas or closures that cannot be pickled,
+        # so they are not saved in checkpoints.
+        state = self.__dict__.copy()
+        state.pop("_callbacks", None)
+        state.pop("_stop_requested", None)
+        return state
+
     def add_state(self, state: msibi.state.State) -> None:
         """Add a state point to MSIBI.states.
 
@@ -132,6 +217,68 @@ class MSIBI(object):
         for state in self.states:
             force._add_state(state)
 
+    def add_callback(
+            self,
+            on_iteration_end=None,
+            on_state_simulated=None
+    ) -> None:
+        """Add functions called during the optimization.
+
+        Callbacks are given the MSIBI instance itself, so they can read the
+        live potentials, distributions and fit scores of every force
+        without reading the files written by the optimization. They can
+        also steer the run, for example by calling MSIBI.request_stop,
+        changing MSIBI.n_steps, or changing the alpha0 of a state.
+
+        Callbacks are not saved by MSIBI.save_checkpoint, so they must be
+        added again to an instance loaded with MSIBI.load_checkpoint.
+
+        Parameters
+        ----------
+        on_iteration_end : callable, optional, default None
+            Called as on_iteration_end(msibi, iteration) after the
+            potentials of each iteration are updated.
+        on_state_simulated : callable, optional, default None
+            Called as on_state_simulated(msibi, state, simulation) after
+            each query simulation, once its distributions are available
+            if they were accumulated in situ. simulation is the hoomd
+            Simulation, or None if the state was simulated in a worker
+            process.
+
+        """
+        if on_iteration_end is not None:
+            self._callbacks["on_iteration_end"].append(on_iteration_end)
+        if on_state_simulated is not None:
+            self._callbacks["on_state_simulated"].append(on_state_simulated)
+
+    def request_stop(self) -> None:
+        """Stop the optimization once the current iteration has finished.
+
+        MSIBI.stop_reason is then set to "callback".
+        """
+        self._stop_requested = True
+
+    @property
+    def timings(self):
+        """The timing records of every phase as a pandas DataFrame.
+
+        Each row holds the phase name, the iteration, state and force it
+        belongs to, its wall time, the bytes read and written, the peak
+        resident set size of the process, and for query simulations the
+        number of timesteps and the hoomd timesteps per second.
+        """
+        return self.timer.to_dataframe()
+
+    @property
+    def speculation_hit_rate(self) -> float:
+        """The fraction of speculative query simulations that were kept,
+        or None if no iteration was run speculatively.
+        """
+        total = self.speculation_hits + self.speculation_misses
+        if total == 0:
+            return None
+        return self.speculation_hits / total
+
     @property
     def bonds(self):
         """All instances of msibi.forces.Bond that have been added."""
@@ -167,6 +314,24 @@ class MSIBI(object):
             n_steps: int,
             n_iterations: int,
             backup_trajectories: bool=False,
+            parallel_states: int=None,
+            threads_per_state: int=None,
+            persistent_simulations: bool=False,
+            in_situ_analysis: bool=False,
+            fit_threshold: float=None,
+            plateau_window: int=None,
+            plateau_tolerance: float=1e-3,
+            time_budget: float=None,
+            freeze_converged: bool=False,
+            checkpoint_every: int=None,
+            checkpoint_file: str="checkpoint.pkl",
+            profile_iteration: int=None,
+            profiler=None,
+            profile_file: str=None,
+            reweight_threshold: float=None,
+            speculate: bool=False,
+            speculation_tolerance: float=0.1,
+            step_schedule: StepSchedule=None,
             _dir=None
     ) -> None:
         """Runs query simulations and performs MSIBI
@@ -176,32 +341,305 @@ class MSIBI(object):
         ----------
         n_steps : int, required
             Number of simulation steps during each iteration.
+            May be None when a step_schedule is given.
         n_iterations : int, required
             Number of MSIBI update iterations.
         backup_trajectories : bool, optional default False
             If True, copies of the query simulation trajectories
             are saved in their respective msibi.state.State directory.
+        parallel_states : int, optional, default None
+            If given, the query simulations of each state are run
+            concurrently in a pool of this many worker processes.
+            The potentials are only updated once every state has finished.
+        threads_per_state : int, optional, default None
+            The number of CPU threads given to each worker process
+            when parallel_states is used. Defaults to splitting the
+            available CPUs evenly between the workers.
+        persistent_simulations : bool, optional, default False
+            If True, each state keeps its hoomd Simulation and force objects
+            between iterations. Each iteration only pushes the updated
+            table potentials into the existing forces and rewinds the
+            simulation to the target configuration.
+            This cannot be combined with parallel_states.
+        in_situ_analysis : bool, optional, default False
+            If True, the distributions of the optimized forces are
+            accumulated while the query simulations run, instead of being
+            calculated from the query trajectory afterwards.
+            The query trajectory is then only written when
+            backup_trajectories is True.
+        fit_threshold : float, optional, default None
+            If given, a state has converged once the fit score of every
+            optimized force at that state is at least fit_threshold.
+        plateau_window : int, optional, default None
+            If given, a state has also converged once the fit score of
+            every optimized force improved by less than plateau_tolerance,
+            relative to its value plateau_window iterations earlier.
+        plateau_tolerance : float, optional, default 1e-3
+            The relative improvement used with plateau_window.
+        time_budget : float, optional, default None
+            If given, no new iteration is started once this many seconds
+            have passed since run_optimization was called.
+        freeze_converged : bool, optional, default False
+            If True, a state that has converged is no longer simulated.
+            Its last query distributions are reused in the potential
+            updates while the other states keep iterating. Once every
+            other state has converged, the frozen states are simulated
+            again, and the optimization only stops as converged if every
+            state converges with the current potentials.
+        checkpoint_every : int, optional, default None
+            If given, a checkpoint is saved to checkpoint_file every
+            checkpoint_every iterations, and when the run ends.
+            See MSIBI.save_checkpoint.
+        checkpoint_file : str, optional, default "checkpoint.pkl"
+            The path of the checkpoint file written when checkpoint_every
+            is given. Each checkpoint replaces the previous one.
+        profile_iteration : int, optional, default None
+            If given, the iteration with this number, counted like
+            MSIBI.n_iterations, is profiled.
+        profiler : callable, optional, default None
+            A function given the iteration number that returns a context
+            manager wrapping the profiled iteration, for example to use a
+            sampling profiler. By default cProfile is used.
+        profile_file : str, optional, default None
+            The file the cProfile statistics are written to.
+            Defaults to "profile_{iteration}.prof".
+        reweight_threshold : float, optional, default None
+            If given, a state is only simulated again once the potentials
+            have changed too much to reweight its last query simulation.
+            Until then, its distributions are estimated by Boltzmann
+            reweighting the frames of that simulation by the change of
+            their energy. A state is simulated once the effective sample
+            size of the weights, as a fraction of the frames, falls below
+            reweight_threshold.
+        speculate : bool, optional, default False
+            If True, the query simulations of the next iteration are
+            started in worker processes before the potentials are updated,
+            using potentials predicted by extrapolating the last update.
+            They are kept if the updated potentials land within
+            speculation_tolerance of the prediction, and discarded and
+            run again otherwise. parallel_states defaults to the number of
+            states. This cannot be combined with persistent_simulations
+            or reweight_threshold.
+        speculation_tolerance : float, optional, default 0.1
+            The largest root mean square difference between the predicted
+            and updated potentials, in units of the lowest state kT, for
+            which the speculative simulations are kept.
+        step_schedule : msibi.schedules.StepSchedule, optional, default None
+            If given, chooses the number of steps of each iteration's query
+            simulations instead of n_steps. See
+            msibi.schedules.GeometricSchedule for a schedule growing every
+            iteration, and msibi.schedules.AdaptiveSchedule for one
+            extending each state's simulation until its distributions are
+            precise enough. An adaptive schedule needs in_situ_analysis,
+            and cannot be combined with speculate.
+
+        Notes
+        -----
+        The hit rate of speculation is found in
+        MSIBI.speculation_hit_rate, and the difference between each
+        prediction and the updated potentials in the "speculation" phase
+        of MSIBI.timings.
+
+        When reweighting, the energy change of each frame is found from its
+        histogram counts, giving every sample the change of the table
+        potential in its bin. The energy change of pairs counts every pair
+        the neighbor list includes, so pairs removed by nlist_exclusions
+        are left out, and pairs removed from the RDF by
+        State.exclude_bonded are kept. The effective sample size of each
+        reweighted state is recorded in the "reweight" phase of
+        MSIBI.timings.
+
+        The wall time and resource use of each phase of every iteration
+        are recorded in MSIBI.timings.
+
+        The optimization stops before n_iterations once every state has
+        converged, the time budget has been used, or a callback requested
+        a stop. The reason is stored in MSIBI.stop_reason.
+
+        n_iterations counts the iterations run by this call. When resuming
+        from a checkpoint, MSIBI.n_iterations holds the number of
+        iterations already completed.
+
+        Worker processes are started with the `spawn` method, so scripts
+        using parallel_states must guard their entry point with
+        `if __name__ == "__main__":`.
 
         """
-        for n in range(n_iterations):
-            print(f"---Optimization: {n+1} of {n_iterations}---")
-            forces = self._build_force_objects()
-            for state in self.states:
-                state._run_simulation(
-                    n_steps=n_steps,
-                    forces=forces,
-                    integrator_method=self.integrator_method,
-                    method_kwargs=self.method_kwargs,
-                    thermostat=self.thermostat,
-                    thermostat_kwargs=self.thermostat_kwargs,
-                    dt=self.dt,
-                    seed=self.seed,
-                    iteration=self.n_iterations,
-                    gsd_period=self.gsd_period,
-                    backup_trajectories=backup_trajectories
+        parallel_states = self._check_run_options(
+                n_steps=n_steps,
+                parallel_states=parallel_states,
+                persistent_simulations=persistent_simulations,
+                in_situ_analysis=in_situ_analysis,
+                fit_threshold=fit_threshold,
+                plateau_window=plateau_window,
+                freeze_converged=freeze_converged,
+                checkpoint_every=checkpoint_every,
+                reweight_threshold=reweight_threshold,
+                speculate=speculate,
+                step_schedule=step_schedule
+        )
+        self._record_frames = reweight_threshold is not None or (
+                step_schedule is not None and step_schedule.adaptive
+        )
+        criteria = dict(
+                fit_threshold=fit_threshold,
+                plateau_window=plateau_window,
+                plateau_tolerance=plateau_tolerance
+        )
+        options = dict(
+                backup_trajectories=backup_trajectories,
+                persistent=persistent_simulations,
+                in_situ_analysis=in_situ_analysis,
+                reweight_threshold=reweight_threshold,
+                speculate=speculate,
+                speculation_tolerance=speculation_tolerance
+        )
+        start_time = time.perf_counter()
+        self.frozen_states = []
+        self.stop_reason = None
+        self.n_steps = n_steps
+        self._step_schedule = step_schedule
+        self._stop_requested = False
+        speculation = None
+        executor, threads_per_state = _process_pool(
+                parallel_states, threads_per_state
+        )
+        try:
+            for n in range(n_iterations):
+                print(f"---Optimization: {n+1} of {n_iterations}---")
+                last = n + 1 == n_iterations
+                self.n_steps = self._scheduled_steps(self.n_iterations)
+                sim_kwargs = self._sim_kwargs(
+                        self.n_steps, backup_trajectories
                 )
-            self._update_potentials()
-            self.n_iterations += 1
+                active = [
+                        s for s in self.states if s not in self.frozen_states
+                ]
+                with self.timer.phase(
+                        "iteration", iteration=self.n_iterations
+                ) as record, self._profiler(
+                        profile_iteration, profiler, profile_file
+                ):
+                    speculation = self._iterate(
+                            states=active,
+                            speculation=speculation,
+                            sim_kwargs=sim_kwargs,
+                            executor=executor,
+                            num_cpu_threads=threads_per_state,
+                            speculate_next=not last,
+                            **options
+                    )
+                if self.store is not None:
+                    self._store_iteration(record["wall_time"])
+                self.n_iterations += 1
+                if checkpoint_every and not last and (
+                        self.n_iterations % checkpoint_every == 0
+                ):
+                    self.save_checkpoint(checkpoint_file)
+                self._iteration_end()
+                if speculation is not None and speculation.n_steps != (
+                        self._scheduled_steps(self.n_iterations)
+                ):
+                    speculation.discard()
+                    speculation = None
+                self.stop_reason = self._stop_reason(
+                        active=active,
+                        criteria=criteria,
+                        freeze_converged=freeze_converged,
+                        time_budget=None if last else time_budget,
+                        elapsed=time.perf_counter() - start_time
+                )
+                if self.stop_reason is not None:
+                    break
+            if checkpoint_every and n_iterations > 0:
+                self.save_checkpoint(checkpoint_file)
+        finally:
+            if speculation is not None:
+                speculation.discard()
+            if executor:
+                executor.shutdown()
+            if self.store is not None:
+                self._store_timings()
+                self.store.flush()
+
+    async def run_optimization_async(
+            self,
+            n_steps: int,
+            n_iterations: int,
+            backup_trajectories: bool=False,
+            parallel_states: int=None,
+            threads_per_state: int=None,
+            in_situ_analysis: bool=False,
+            step_schedule: StepSchedule=None
+    ):
+        """Run the optimization without blocking the asyncio event loop,
+        yielding the results of each iteration as it completes.
+
+        The query simulations and potential updates of each iteration run
+        in a worker thread, and the simulations run in a pool of worker
+        processes when parallel_states is given. The parameters are the
+        same as those of MSIBI.run_optimization.
+
+        Yields
+        ------
+        dict
+            The "iteration" number, the latest "fit_scores" of each
+            optimized force at each state as {force name: {state name:
+            score}}, a copy of the "potentials" of each optimized force,
+            and the "timings" records of the iteration.
+
+        Notes
+        -----
+        The optimization can be stopped between iterations by closing
+        the async iterator, or by cancelling the task consuming it.
+        An iteration already running is completed before the cancellation
+        takes effect, so the potentials, histories and state directories
+        always match a completed iteration.
+
+        Callbacks are run in the worker thread, and a stop requested by a
+        callback ends the iteration once the current results are yielded.
+
+        """
+        self._check_run_options(
+                n_steps=n_steps,
+                parallel_states=parallel_states,
+                in_situ_analysis=in_situ_analysis,
+                step_schedule=step_schedule
+        )
+        self._record_frames = (
+                step_schedule is not None and step_schedule.adaptive
+        )
+        self.stop_reason = None
+        self.n_steps = n_steps
+        self._step_schedule = step_schedule
+        self._stop_requested = False
+        executor, threads_per_state = _process_pool(
+                parallel_states, threads_per_state
+        )
+        try:
+            for n in range(n_iterations):
+                print(f"---Optimization: {n+1} of {n_iterations}---")
+                self.n_steps = self._scheduled_steps(self.n_iterations)
+                yield await _run_to_completion(
+                        self._run_iteration,
+                        states=self.states,
+                        sim_kwargs=self._sim_kwargs(
+                            self.n_steps, backup_trajectories
+                        ),
+                        executor=executor,
+                        num_cpu_threads=threads_per_state,
+                        in_situ_analysis=in_situ_analysis
+                )
+                if self._stop_requested:
+                    self.stop_reason = "callback"
+                    print("---Optimization stopped by a callback---")
+                    break
+        finally:
+            if executor:
+                executor.shutdown()
+            if self.store is not None:
+                self._store_timings()
+                self.store.flush()
 
     def pickle_forces(self, file_path: str) -> None:
         """Save the Hoomd objects for all forces to a single pickle file.
@@ -226,8 +664,69 @@ class MSIBI(object):
         f = open(file_path, "wb")
         pickle.dump(forces, f)
 
-    def _build_force_objects(self) -> list:
-        """Creates force objects for query simulations."""
+    def save_checkpoint(self, file_path: str) -> None:
+        """Save the state of the optimization to a pickle file.
+
+        The checkpoint holds the potentials, histories and fit scores of
+        every force, the states with their last query distributions and
+        snapshots, the iteration count and the random seed.
+        Hoomd simulation objects are not saved, and are recreated when
+        the optimization continues.
+
+        Parameters
+        ----------
+        file_path : str, required
+            The path and file name for the checkpoint file.
+            An existing file is replaced once the new one is written.
+
+        """
+        with self.timer.phase("checkpoint", iteration=self.n_iterations):
+            tmp_path = f"{file_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(self, f)
+            os.replace(tmp_path, file_path)
+
+    @classmethod
+    def load_checkpoint(cls, file_path: str) -> "MSIBI":
+        """Create an MSIBI instance from a checkpoint file.
+
+        Calling run_optimization on the returned instance continues the
+        optimization from the last completed iteration. State directories
+        are reopened, and created again if they were removed.
+        Callbacks are not saved in checkpoints, and must be added again
+        with MSIBI.add_callback.
+
+        Parameters
+        ----------
+        file_path : str, required
+            The path to a file written by MSIBI.save_checkpoint.
+
+        Returns
+        -------
+        msibi.optimize.MSIBI
+
+        """
+        with open(file_path, "rb") as f:
+            opt = pickle.load(f)
+        if not isinstance(opt, cls):
+            raise ValueError(f"{file_path} is not an MSIBI checkpoint.")
+        opt._callbacks = {"on_iteration_end": [], "on_state_simulated": []}
+        opt._stop_requested = False
+        for state in opt.states:
+            state._opt = opt
+            os.makedirs(state.dir, exist_ok=True)
+        return opt
+
+    def _build_force_objects(self, potentials: dict=None) -> list:
+        """Creates force objects for query simulations.
+
+        If potentials are given, the table forces whose keys they hold
+        use those potentials instead of their current ones.
+        """
+        import hoomd
+
+        potentials = potentials or dict()
+
         # Create pair objects
         pair_force = None
         for pair in self.pairs:
@@ -239,7 +738,9 @@ class MSIBI(object):
                             default_r_cut=0
                         )
                 )
-            pair_force.params[pair._pair_name] = pair._table_entry()
+            pair_force.params[pair._pair_name] = pair._table_entry(
+                    potentials.get(pair._key)
+            )
             pair_force.r_cut[pair._pair_name] = pair.r_cut
 
         # Create bond objects
@@ -252,7 +753,9 @@ class MSIBI(object):
                 else:
                     bond_force = hoomd_bond_force()
             if bond.format == "table":
-                bond_force.params[bond.name] = bond._table_entry()
+                bond_force.params[bond.name] = bond._table_entry(
+                        potentials.get(bond._key)
+                )
             else:
                 bond_force.params[bond.name] = bond.force_entry
 
@@ -266,7 +769,9 @@ class MSIBI(object):
                 else:
                     angle_force = hoomd_angle_force()
             if angle.format == "table":
-                angle_force.params[angle.name] = angle._table_entry()
+                angle_force.params[angle.name] = angle._table_entry(
+                        potentials.get(angle._key)
+                )
             else:
                 angle_force.params[angle.name] = angle.force_entry
         # Create dihedral objects
@@ -281,31 +786,973 @@ class MSIBI(object):
                 else:
                     dihedral_force = hoomd_dihedral_force()
             if dih.format == "table":
-                dihedral_force.params[dih.name] = dih._table_entry()
+                dihedral_force.params[dih.name] = dih._table_entry(
+                        potentials.get(dih._key)
+                )
             else:
                 dihedral_force.params[dih.name] = dih.force_entry
         forces = [pair_force, bond_force, angle_force, dihedral_force]
         return [f for f in forces if f] # Filter out any None values
 
+    def _sim_kwargs(self, n_steps: int, backup_trajectories: bool) -> dict:
+        """The arguments of the current iteration's query simulations."""
+        return dict(
+            n_steps=n_steps,
+            integrator_method=self.integrator_method,
+            method_kwargs=self.method_kwargs,
+            thermostat=self.thermostat,
+            thermostat_kwargs=self.thermostat_kwargs,
+            dt=self.dt,
+            seed=self.seed,
+            iteration=self.n_iterations,
+            gsd_period=self.gsd_period,
+            backup_trajectories=backup_trajectories,
+            step_schedule=self._step_schedule
+        )
+
+    def _scheduled_steps(self, iteration: int) -> int:
+        """The number of steps of an iteration's query simulations."""
+        if self._step_schedule is None:
+            return self.n_steps
+        return self._step_schedule.n_steps(iteration)
+
+    def _fit_residuals(self, state: msibi.state.State) -> dict:
+        """The residual 1 - f_fit of each optimized force at a state,
+        from the last iteration.
+        """
+        return {
+            force._key: 1 - force._states[state]["f_fit"][-1]
+            for force in self._optimize_forces
+            if force._states[state]["f_fit"]
+        }
+
+    def _run_iteration(
+            self,
+            states: list,
+            sim_kwargs: dict,
+            executor: ProcessPoolExecutor=None,
+            num_cpu_threads: int=None,
+            in_situ_analysis: bool=False
+    ) -> dict:
+        """Run one iteration of query simulations and potential updates,
+        returning its results. See MSIBI.run_optimization_async.
+        """
+        n_records = len(self.timer.records)
+        with self.timer.phase(
+                "iteration", iteration=self.n_iterations
+        ) as record:
+            self._run_query_simulations(
+                    states=states,
+                    sim_kwargs=sim_kwargs,
+                    executor=executor,
+                    num_cpu_threads=num_cpu_threads,
+                    in_situ_analysis=in_situ_analysis
+            )
+            self._update_potentials()
+        if self.store is not None:
+            self._store_iteration(record["wall_time"])
+        results = {
+            "iteration": self.n_iterations,
+            "fit_scores": {
+                force.name: {
+                    state.name: state_dict["f_fit"][-1]
+                    for state, state_dict in force._states.items()
+                }
+                for force in self._optimize_forces
+            },
+            "potentials": {
+                force.name: np.array(force.potential)
+                for force in self._optimize_forces
+            },
+            "timings": self.timer.records[n_records:]
+        }
+        self.n_iterations += 1
+        self._iteration_end()
+        return results
+
+    def _iteration_end(self) -> None:
+        """Call the on_iteration_end callbacks of the iteration
+        just completed.
+        """
+        for callback in self._callbacks["on_iteration_end"]:
+            callback(self, self.n_iterations - 1)
+
+    def _state_simulated(
+            self,
+            state: msibi.state.State,
+            simulation: hoomd.Simulation=None
+    ) -> None:
+        """Call the on_state_simulated callbacks of a state."""
+        for callback in self._callbacks["on_state_simulated"]:
+            callback(self, state, simulation)
+
+    def _run_query_simulations(
+            self,
+            states: list,
+            sim_kwargs: dict,
+            executor: ProcessPoolExecutor=None,
+            num_cpu_threads: int=None,
+            persistent: bool=False,
+            in_situ_analysis: bool=False
+    ) -> None:
+        """Run the query simulations of the given states, and collect
+        the timing records of each simulation.
+        """
+        for state in states:
+            state._reference_potentials = {
+                force._key: np.array(force.potential)
+                for force in self._optimize_forces
+            }
+        if executor:
+            self._run_parallel_simulations(
+                    executor=executor,
+                    states=states,
+                    sim_kwargs=sim_kwargs,
+                    num_cpu_threads=num_cpu_threads,
+                    in_situ_analysis=in_situ_analysis
+            )
+            for state in states:
+                self._state_simulated(state)
+        elif persistent:
+            self._run_persistent_simulations(
+                    states=states,
+                    sim_kwargs=sim_kwargs,
+                    in_situ_analysis=in_situ_analysis
+            )
+        else:
+            forces = self._build_force_objects()
+            for state in states:
+                state._run_simulation(
+                        forces=forces,
+                        histograms=self._state_histograms(
+                            state, in_situ_analysis
+                        ),
+                        residuals=self._fit_residuals(state),
+                        callback=self._state_simulated,
+                        **sim_kwargs
+                )
+        for state in states:
+            for record in state._timings:
+                self.timer.add(record)
+            state._timings = []
+
+    def _reweight(self, state: msibi.state.State, threshold: float) -> bool:
+        """Estimate a state's query distributions by reweighting the frames
+        of its last query simulation to the current potentials.
+
+        Returns False, leaving the state unchanged, if the state has no
+        recorded frames for every optimized force, or if the effective
+        sample size of the weights is below threshold.
+
+        The energy change of pairs is found from counts of the pairs the
+        neighbor list includes, which are not the pairs of the RDF when
+        bonded pairs are excluded. If a pair histogram has no such counts,
+        a warning is given and the state is simulated instead.
+        """
+        histograms = state._query_histograms
+        if not self._optimize_forces or not all(
+                force._key in state._reference_potentials
+                and force._key in histograms
+                and histograms[force._key].records_frames
+                for force in self._optimize_forces
+        ):
+            return False
+        if any(
+                getattr(histograms[force._key], "_energy_exclusions", ())
+                is None
+                for force in self._optimize_forces
+        ):
+            warnings.warn(
+                    f"The pair histograms of state {state.name} did not "
+                    "record the pairs included by the neighbor list, so it "
+                    "is simulated instead of reweighted."
+            )
+            return False
+        with self.timer.phase(
+                "reweight", iteration=self.n_iterations, state=state.name
+        ) as record:
+            delta_energy = sum(
+                    histograms[force._key].energy_change(
+                        force.potential
+                        - state._reference_potentials[force._key]
+                    )
+                    for force in self._optimize_forces
+            )
+            weights = boltzmann_weights(delta_energy, kT=state.kT)
+            ess = effective_sample_size(weights)
+            record["ess"] = ess
+            record["reweighted"] = bool(ess >= threshold)
+            if ess < threshold:
+                return False
+            state._query_distributions = {
+                key: histogram.distribution(weights)
+                for key, histogram in histograms.items()
+            }
+            state._query_responses = {
+                key: histogram.response(kT=state.kT, weights=weights)
+                for key, histogram in histograms.items()
+                if histogram.records_fluctuations
+            }
+        print(f"Reweighted state {state.name}, effective sample size {ess:.3f}")
+        return True
+
+    def _profiler(
+            self,
+            profile_iteration: int,
+            profiler=None,
+            profile_file: str=None
+    ):
+        """The context manager profiling the current iteration, if it is
+        the one chosen.
+        """
+        if profile_iteration is None or profile_iteration != self.n_iterations:
+            return contextlib.nullcontext()
+        if profiler is not None:
+            return profiler(self.n_iterations)
+        return _cprofile(profile_file or f"profile_{self.n_iterations}.prof")
+
+    def _run_parallel_simulations(
+            self,
+            executor: ProcessPoolExecutor,
+            states: list,
+            sim_kwargs: dict,
+            num_cpu_threads: int,
+            in_situ_analysis: bool=False
+    ) -> None:
+        """Run the query simulations of the given states in worker processes.
+
+        Waits for every state to finish. If any simulation fails,
+        a RuntimeError naming each failed state is raised.
+        """
+        futures = self._submit_simulations(
+                executor=executor,
+                states=states,
+                sim_kwargs=sim_kwargs,
+                num_cpu_threads=num_cpu_threads,
+                in_situ_analysis=in_situ_analysis
+        )
+        self._collect_simulations(futures)
+
+    def _submit_simulations(
+            self,
+            executor: ProcessPoolExecutor,
+            states: list,
+            sim_kwargs: dict,
+            num_cpu_threads: int,
+            in_situ_analysis: bool=False,
+            potentials: dict=None,
+            query_trajs: dict=None
+    ) -> dict:
+        """Start the query simulations of the given states in worker
+        processes, returning the future of each state.
+
+        If potentials are given, they are simulated instead of the current
+        potentials. If query_trajs are given, each state's query trajectory
+        is written to its path there instead of State.query_traj.
+        """
+        forces = self._build_force_objects(potentials)
+        query_trajs = query_trajs or dict()
+        return {
+            state: executor.submit(
+                _run_state_simulation,
+                state,
+                dict(
+                    sim_kwargs,
+                    forces=forces,
+                    num_cpu_threads=num_cpu_threads,
+                    histograms=self._state_histograms(state, in_situ_analysis),
+                    residuals=self._fit_residuals(state)
+                ),
+                query_trajs.get(state)
+            )
+            for state in states
+        }
+
+    def _collect_simulations(self, futures: dict) -> None:
+        """Wait for the simulation of each state, and set its results.
+
+        If any simulation fails, a RuntimeError naming each failed state
+        is raised.
+        """
+        failed = dict()
+        for state, future in futures.items():
+            try:
+                state.__dict__.update(future.result())
+            except Exception as e:
+                failed[state.name] = e
+        if failed:
+            message = "; ".join(
+                    f"{name}: {repr(error)}" for name, error in failed.items()
+            )
+            raise RuntimeError(
+                    f"Query simulations failed for state(s) {message}"
+            ) from next(iter(failed.values()))
+
+    def _predict_potentials(self) -> dict:
+        """Predict the potentials after the next update, by repeating
+        the last update of each optimized force.
+
+        Bins where the prediction is not finite keep the current potential.
+        """
+        potentials = dict()
+        for force in self._optimize_forces:
+            potential = np.array(force.potential)
+            previous = self._previous_potentials.get(force._key)
+            if previous is not None and previous.shape == potential.shape:
+                with np.errstate(invalid="ignore"):
+                    predicted = 2 * potential - previous
+                finite = np.isfinite(predicted)
+                potential[finite] = predicted[finite]
+            potentials[force._key] = potential
+        return potentials
+
+    def _speculate(
+            self,
+            executor: ProcessPoolExecutor,
+            states: list,
+            sim_kwargs: dict,
+            num_cpu_threads: int,
+            in_situ_analysis: bool=False
+    ) -> _Speculation:
+        """Start the next iteration's query simulations with predicted
+        potentials, while the current potentials are being updated.
+        """
+        iteration = self.n_iterations + 1
+        n_steps = self._scheduled_steps(iteration)
+        potentials = self._predict_potentials()
+        query_trajs = {
+            state: os.path.join(state.dir, f"query_speculative{iteration}.gsd")
+            for state in states
+        }
+        futures = self._submit_simulations(
+                executor=executor,
+                states=states,
+                sim_kwargs=dict(
+                    sim_kwargs,
+                    n_steps=n_steps,
+                    iteration=iteration,
+                    backup_trajectories=False
+                ),
+                num_cpu_threads=num_cpu_threads,
+                in_situ_analysis=in_situ_analysis,
+                potentials=potentials,
+                query_trajs=query_trajs
+        )
+        return _Speculation(
+                iteration=iteration,
+                n_steps=n_steps,
+                potentials=potentials,
+                futures=futures,
+                query_trajs=query_trajs
+        )
+
+    def _speculation_hit(
+            self,
+            speculation: _Speculation,
+            tolerance: float
+    ) -> bool:
+        """Whether the updated potentials are close enough to the predicted
+        ones to keep the speculative simulations.
+
+        The root mean square difference over the bins where both are finite
+        is compared, in units of the lowest state kT, for every optimized
+        force.
+        """
+        kT = min(state.kT for state in self.states)
+        with self.timer.phase(
+                "speculation", iteration=speculation.iteration
+        ) as record:
+            deviation = 0.0
+            for force in self._optimize_forces:
+                difference = (
+                        force.potential - speculation.potentials[force._key]
+                )
+                difference = difference[np.isfinite(difference)]
+                if len(difference):
+                    deviation = max(
+                            deviation, np.sqrt(np.mean(difference**2)) / kT
+                    )
+            hit = bool(deviation <= tolerance)
+            record["deviation"] = deviation
+            record["hit"] = hit
+        if hit:
+            self.speculation_hits += 1
+        else:
+            self.speculation_misses += 1
+            print(
+                f"Discarding speculative simulations {speculation.iteration}, "
+                f"deviation {deviation:.3f} kT"
+            )
+        return hit
+
+    def _collect_speculation(
+            self,
+            speculation: _Speculation,
+            states: list,
+            backup_trajectories: bool=False
+    ) -> None:
+        """Use the speculative simulations of the given states as their
+        query simulations. Those of any other state are discarded.
+        """
+        for state in list(speculation.futures):
+            if state not in states:
+                speculation.discard(state)
+        self._collect_simulations(speculation.futures)
+        for state in states:
+            query_traj = speculation.query_trajs[state]
+            if os.path.exists(query_traj):
+                os.replace(query_traj, state.query_traj)
+                if backup_trajectories:
+                    shutil.copy(
+                            state.query_traj,
+                            os.path.join(
+                                state.dir, f"query{speculation.iteration}.gsd"
+                            )
+                    )
+            state._reference_potentials = speculation.potentials
+            self._state_simulated(state)
+            for record in state._timings:
+                self.timer.add(record)
+            state._timings = []
+
+    def _iterate(
+            self,
+            states: list,
+            sim_kwargs: dict,
+            speculation: _Speculation=None,
+            executor: ProcessPoolExecutor=None,
+            num_cpu_threads: int=None,
+            backup_trajectories: bool=False,
+            persistent: bool=False,
+            in_situ_analysis: bool=False,
+            reweight_threshold: float=None,
+            speculate: bool=False,
+            speculation_tolerance: float=0.1,
+            speculate_next: bool=False
+    ) -> _Speculation:
+        """Find the query distributions of the given states and update
+        the potentials. See MSIBI.run_optimization for the options.
+
+        States are reweighted when possible, and otherwise simulated,
+        using the speculative simulations started during the previous
+        iteration if there are any. States without one, such as frozen
+        states simulated again, are simulated as usual. Returns the
+        speculation started for the next iteration, or None.
+        """
+        if reweight_threshold is not None:
+            states = [
+                    s for s in states
+                    if not self._reweight(s, reweight_threshold)
+            ]
+        unspeculated = states
+        if speculation is not None:
+            unspeculated = [
+                    s for s in states if s not in speculation.futures
+            ]
+            self._collect_speculation(
+                    speculation,
+                    [s for s in states if s in speculation.futures],
+                    backup_trajectories
+            )
+        if unspeculated:
+            self._run_query_simulations(
+                    states=unspeculated,
+                    sim_kwargs=sim_kwargs,
+                    executor=executor,
+                    num_cpu_threads=num_cpu_threads,
+                    persistent=persistent,
+                    in_situ_analysis=in_situ_analysis
+            )
+        if not speculate:
+            self._update_potentials()
+            return None
+        return self._speculative_update(
+                executor=executor,
+                states=states,
+                sim_kwargs=sim_kwargs,
+                num_cpu_threads=num_cpu_threads,
+                in_situ_analysis=in_situ_analysis,
+                tolerance=speculation_tolerance,
+                speculate_next=speculate_next
+        )
+
+    def _speculative_update(
+            self,
+            executor: ProcessPoolExecutor,
+            states: list,
+            sim_kwargs: dict,
+            num_cpu_threads: int,
+            in_situ_analysis: bool=False,
+            tolerance: float=0.1,
+            speculate_next: bool=True
+    ) -> _Speculation:
+        """Update the potentials while the next iteration's query
+        simulations run with predicted potentials.
+
+        Returns the speculation, or None if it was not started or
+        the updated potentials are too far from the prediction.
+        """
+        speculation = None
+        if speculate_next:
+            speculation = self._speculate(
+                    executor=executor,
+                    states=states,
+                    sim_kwargs=sim_kwargs,
+                    num_cpu_threads=num_cpu_threads,
+                    in_situ_analysis=in_situ_analysis
+            )
+        self._previous_potentials = {
+            force._key: np.array(force.potential)
+            for force in self._optimize_forces
+        }
+        self._update_potentials()
+        if speculation is not None and not self._speculation_hit(
+                speculation, tolerance
+        ):
+            speculation.discard()
+            speculation = None
+        return speculation
+
+    def _run_persistent_simulations(
+            self,
+            states: list,
+            sim_kwargs: dict,
+            in_situ_analysis: bool=False
+    ) -> None:
+        """Run each state's query simulation, reusing its hoomd objects.
+
+        Force objects are only built the first time a state is simulated.
+        After that, the current table potentials of the optimized forces
+        are pushed into the existing objects.
+        """
+        for state in states:
+            if state._forces is None:
+                state._forces = self._build_force_objects()
+            else:
+                self._update_force_objects(state._forces)
+            state._run_simulation(
+                    forces=state._forces,
+                    persistent=True,
+                    histograms=self._state_histograms(state, in_situ_analysis),
+                    residuals=self._fit_residuals(state),
+                    callback=self._state_simulated,
+                    **sim_kwargs
+            )
+
+    def _state_histograms(
+            self,
+            state: msibi.state.State,
+            in_situ_analysis: bool
+    ) -> dict:
+        """Histograms filled during a state's query simulation.
+
+        Returns None when the distributions are not accumulated in situ.
+        """
+        if not in_situ_analysis:
+            return None
+        return {
+            force._key: self._histogram(force, state)
+            for force in self._optimize_forces
+        }
+
+    def _histogram(
+            self,
+            force: msibi.forces.Force,
+            state: msibi.state.State
+    ) -> msibi.analysis.Histogram:
+        """A force's query histogram, recording the count fluctuations
+        when its update scheme needs them, and the counts of every frame
+        when reweighting. Pair histograms then also count the pairs the
+        neighbor list includes, to find their energy change.
+        """
+        histogram = force._histogram(state)
+        if self._update_scheme(force).requires_fluctuations:
+            histogram.record_fluctuations()
+        if self._record_frames and isinstance(force, msibi.forces.Pair):
+            histogram.record_frames(energy_exclusions=self.nlist_exclusions)
+        elif self._record_frames:
+            histogram.record_frames()
+        return histogram
+
+    def _update_force_objects(self, forces: list) -> None:
+        """Set the current table potentials on existing hoomd force objects.
+
+        Only forces being optimized are updated, since static forces
+        do not change between iterations.
+        """
+        import hoomd
+
+        table_forces = {
+            msibi.forces.Pair: hoomd.md.pair.Table,
+            msibi.forces.Bond: hoomd.md.bond.Table,
+            msibi.forces.Angle: hoomd.md.angle.Table,
+            msibi.forces.Dihedral: hoomd.md.dihedral.Table,
+        }
+        for force in self._optimize_forces:
+            hoomd_force = next(
+                    f for f in forces
+                    if isinstance(f, table_forces[type(force)])
+            )
+            if isinstance(force, msibi.forces.Pair):
+                hoomd_force.params[force._pair_name] = force._table_entry()
+            else:
+                hoomd_force.params[force.name] = force._table_entry()
+
     def _update_potentials(self) -> None:
-        """Update the potentials for the potentials to be optimized."""
+        """Update the potentials for the potentials to be optimized.
+
+        The steps of all forces using the same update scheme, with the same
+        number of bins and states, are found together from stacked arrays.
+        """
         for force in self._optimize_forces:
             self._recompute_distribution(force)
-            force._update_potential()
+        groups = dict()
+        for force in self._optimize_forces:
+            scheme = self._update_scheme(force)
+            arrays = force._stacked_distributions()
+            if scheme.requires_fluctuations:
+                arrays += (force._stacked_responses(),)
+            key = (id(scheme), arrays[0].shape)
+            groups.setdefault(key, (scheme, []))[1].append((force, arrays))
+        for scheme, group in groups.values():
+            forces, arrays = zip(*group)
+            with self.timer.phase("update_step", iteration=self.n_iterations):
+                deltas = scheme.step(*[np.stack(a) for a in zip(*arrays)])
+            for force, delta in zip(forces, deltas):
+                with self.timer.phase(
+                        "update", iteration=self.n_iterations, force=force.name
+                ):
+                    force._update_potential(delta=delta)
+
+    def _check_run_options(
+            self,
+            n_steps: int,
+            parallel_states: int=None,
+            persistent_simulations: bool=False,
+            in_situ_analysis: bool=False,
+            fit_threshold: float=None,
+            plateau_window: int=None,
+            freeze_converged: bool=False,
+            checkpoint_every: int=None,
+            reweight_threshold: float=None,
+            speculate: bool=False,
+            step_schedule: StepSchedule=None
+    ) -> int:
+        """Check the options of a run, and of every combination of them.
+
+        Returns the number of parallel states, which defaults to the
+        number of states when speculating.
+        """
+        if speculate and parallel_states is None:
+            parallel_states = len(self.states)
+        if parallel_states is not None and parallel_states < 1:
+            raise ValueError("parallel_states must be a positive integer.")
+        if n_steps is None and step_schedule is None:
+            raise ValueError("n_steps is needed without a step_schedule.")
+        if plateau_window is not None and (
+                not isinstance(plateau_window, int) or plateau_window < 1
+        ):
+            raise ValueError("plateau_window must be a positive integer.")
+        if checkpoint_every is not None and (
+                not isinstance(checkpoint_every, int) or checkpoint_every < 1
+        ):
+            raise ValueError("checkpoint_every must be a positive integer.")
+        if reweight_threshold is not None and not 0 < reweight_threshold <= 1:
+            raise ValueError("reweight_threshold must be between 0 and 1.")
+        unsupported = [
+                name for name in self.nlist_exclusions
+                if name not in PAIR_EXCLUSIONS
+        ]
+        if reweight_threshold is not None and unsupported and any(
+                isinstance(f, msibi.forces.Pair) for f in self._optimize_forces
+        ):
+            raise ValueError(
+                    f"Pairs can't be reweighted with the neighbor list "
+                    f"exclusions {unsupported}. Supported exclusions are "
+                    f"{list(PAIR_EXCLUSIONS)}."
+            )
+        if freeze_converged and fit_threshold is None and plateau_window is None:
+            raise ValueError(
+                    "freeze_converged needs fit_threshold or plateau_window "
+                    "to decide when a state has converged."
+            )
+        if speculate and (persistent_simulations or reweight_threshold):
+            raise ValueError(
+                    "speculate cannot be used with persistent_simulations "
+                    "or reweight_threshold."
+            )
+        if parallel_states and persistent_simulations:
+            raise ValueError(
+                    "persistent_simulations cannot be used with "
+                    "parallel_states."
+            )
+        if step_schedule is not None and step_schedule.adaptive and (
+                speculate or not in_situ_analysis
+        ):
+            raise ValueError(
+                    "An adaptive step_schedule needs in_situ_analysis, "
+                    "and cannot be used with speculate."
+            )
+        return parallel_states
+
+    def _stop_reason(
+            self,
+            active: list,
+            criteria: dict,
+            freeze_converged: bool=False,
+            time_budget: float=None,
+            elapsed: float=0.0
+    ) -> str:
+        """Why the optimization stops after the iteration just completed,
+        or None if it continues.
+
+        Converged states of the iteration's active states are frozen when
+        freeze_converged is True. Once every active state has converged,
+        the frozen states are unfrozen to be simulated again.
+        criteria holds the arguments of MSIBI._converged.
+        """
+        if self._stop_requested:
+            print("---Optimization stopped by a callback---")
+            return "callback"
+        # Frozen states reuse old query distributions, so their
+        # fit scores say nothing about the current potentials.
+        converged = [
+                state for state in active
+                if self._converged(state, **criteria)
+        ]
+        if converged and len(converged) == len(active):
+            if not self.frozen_states:
+                print("---Optimization converged---")
+                return "converged"
+            print("---Simulating frozen states again---")
+            self.frozen_states = []
+        elif freeze_converged:
+            for state in converged:
+                if state not in self.frozen_states:
+                    print(f"---State {state.name} converged---")
+                    self.frozen_states.append(state)
+        if time_budget is not None and elapsed >= time_budget:
+            print("---Optimization time budget used---")
+            return "time_budget"
+        return None
+
+    def _converged(
+            self,
+            state: msibi.state.State,
+            fit_threshold: float=None,
+            plateau_window: int=None,
+            plateau_tolerance: float=1e-3
+    ) -> bool:
+        """Whether the fit scores of every optimized force at a state
+        meet the fit threshold or have stopped improving.
+        """
+        if not self._optimize_forces:
+            return False
+        for force in self._optimize_forces:
+            f_fit = force._states[state]["f_fit"]
+            if not f_fit:
+                return False
+            if fit_threshold is not None and f_fit[-1] >= fit_threshold:
+                continue
+            if plateau_window is not None and len(f_fit) > plateau_window:
+                previous = f_fit[-plateau_window - 1]
+                improvement = f_fit[-1] - previous
+                if improvement <= plateau_tolerance * abs(previous):
+                    continue
+            return False
+        return True
+
+    def _store_iteration(self, duration: float) -> None:
+        """Append the updated potentials, the iteration's duration and
+        the timing records not stored yet to the iteration store.
+        """
+        for force in self._optimize_forces:
+            self.store.append(
+                    "potential",
+                    force.potential,
+                    iteration=self.n_iterations,
+                    force=force.name
+            )
+        self.store.append(
+                "iteration_time", duration, iteration=self.n_iterations
+        )
+        self._store_timings()
+
+    def _store_timings(self) -> None:
+        """Append the timing records not stored yet to the iteration store.
+
+        Each record is stored at its own iteration, state and force.
+        """
+        for record in self.timer.records[self._n_stored_timings:]:
+            self.store.append_timing(record)
+        self._n_stored_timings = len(self.timer.records)
+
+    def _update_scheme(self, force: msibi.forces.Force) -> UpdateScheme:
+        """The update scheme used for a force."""
+        return force.update_scheme or self.update_scheme
+
+    def _compute_query_distributions(self, state: msibi.state.State) -> None:
+        """Calculate the query distributions of every optimized force.
+
+        The query trajectory is read once, and all distributions are found
+        in the same pass. Distributions already accumulated during the
+        query simulation are not recalculated.
+        """
+        histograms = dict()
+        for force in self._optimize_forces:
+            fluctuations = self._update_scheme(force).requires_fluctuations
+            if force._key in state._query_distributions and (
+                    not fluctuations or force._key in state._query_responses
+            ):
+                continue
+            histograms[force._key] = self._histogram(force, state)
+        if histograms:
+            with self.timer.phase(
+                    "analysis", iteration=self.n_iterations, state=state.name
+            ):
+                state._query_distributions.update(
+                        compute_distributions(
+                            gsd_file=state.query_traj,
+                            histograms=histograms,
+                            topology=state._topology(query=True),
+                            rdf_engine=state._rdf_engine,
+                            **state.frame_slice
+                        )
+                )
+            state._query_responses.update({
+                key: histogram.response(kT=state.kT)
+                for key, histogram in histograms.items()
+                if histogram.records_fluctuations
+            })
+            state._query_histograms.update(histograms)
 
     def _recompute_distribution(self, force: msibi.forces.Force) -> None:
         """Recompute the current distribution of bond lengths or angles"""
         for state in self.states:
-            force._compute_current_distribution(state)
+            self._compute_query_distributions(state)
+            with self.timer.phase(
+                    "distribution",
+                    iteration=self.n_iterations,
+                    state=state.name,
+                    force=force.name
+            ):
+                force._compute_current_distribution(state)
             force._save_current_distribution(
                     state,
-                    iteration=self.n_iterations
+                    iteration=self.n_iterations,
+                    store=self.store
             )
+            if self.store is not None:
+                self.store.append(
+                        "f_fit",
+                        force._states[state]["f_fit"][-1],
+                        iteration=self.n_iterations,
+                        force=force.name,
+                        state=state.name
+                )
             print("Force: {0}, State: {1}, Iteration: {2}: {3:f}".format(
                     force.name,
                     state.name,
                     self.n_iterations,
-                    force._states[state]["f_fit"][self.n_iterations]
+                    force._states[state]["f_fit"][-1]
                 )
             )
             print()
+
+
+def _process_pool(parallel_states: int, threads_per_state: int) -> tuple:
+    """The pool of worker processes used for parallel_states, and the
+    number of CPU threads given to each worker.
+
+    Returns (None, threads_per_state) when parallel_states is not given.
+    """
+    if not parallel_states:
+        return None, threads_per_state
+    if threads_per_state is None:
+        threads_per_state = max(1, (os.cpu_count() or 1) // parallel_states)
+    executor = ProcessPoolExecutor(
+            max_workers=parallel_states,
+            mp_context=multiprocessing.get_context("spawn")
+    )
+    return executor, threads_per_state
+
+
+async def _run_to_completion(func, *args, **kwargs):
+    """Run func in a worker thread and await its result.
+
+    If the awaiting task is cancelled, func is still run to completion
+    before the cancellation is raised, so it never stops halfway.
+    """
+    task = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        while not task.done():
+            with contextlib.suppress(asyncio.CancelledError):
+                await asyncio.wait([task])
+        raise
+
+
+@contextlib.contextmanager
+def _cprofile(file_path: str):
+    """Profile the code in a with block, writing the stats to file_path."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(file_path)
+
+
+def _run_state_simulation(
+        state: msibi.state.State,
+        sim_kwargs: dict,
+        query_traj: str=None
+) -> dict:
+    """Run a single state's query simulation inside a worker process.
+
+    If query_traj is given, the query trajectory is written there.
+    """
+    if query_traj is not None:
+        state.query_traj = query_traj
+    state._run_simulation(**sim_kwargs)
+    return state._query_results()
+
+
+class _Speculation(object):
+    """Query simulations started with predicted potentials."""
+
+    def __init__(
+            self,
+            iteration: int,
+            n_steps: int,
+            potentials: dict,
+            futures: dict,
+            query_trajs: dict
+    ):
+        self.iteration = iteration
+        self.n_steps = n_steps
+        self.potentials = potentials
+        self.futures = futures
+        self.query_trajs = query_trajs
+
+    def discard(self, state: msibi.state.State=None) -> None:
+        """Cancel the simulations of a state, or of every state,
+        removing their query trajectories once they finish.
+        """
+        states = [state] if state is not None else list(self.futures)
+        for state in states:
+            future = self.futures.pop(state)
+            if not future.cancel():
+                future.add_done_callback(
+                        functools.partial(
+                            _remove_file, self.query_trajs[state]
+                        )
+                )
+
+
+def _remove_file(file_path: str, future=None) -> None:
+    """Remove a file if it exists."""
+    if os.path.exists(file_path):
+        os.remove(file_path)
@@ -1,8 +1,6 @@
 import warnings
 
-import more_itertools as mit
 import numpy as np
-from scipy.optimize import curve_fit
 
 from msibi.utils.general import find_nearest
 
@@ -31,6 +29,21 @@ def lennard_jones(r, epsilon, sigma):
 
 
 def pair_correction(r, V, form, r_switch=2.5):
+    """Apply head and tail corrections to one or more pair potentials.
+
+    Parameters
+    ----------
+    r : np.ndarray, shape=(n_points,)
+        Separation values
+    V : np.ndarray, shape=(n_points,) or (n_potentials, n_points)
+        Potential at each of the separation values.
+        A 2D array is corrected as a batch of potentials.
+    form : str
+        The form of the head correction, "linear" or "exponential".
+    r_switch : float, optional, default=2.5
+        The radius after which the tail correction is applied.
+
+    """
     if form == "linear":
         head_correction_function = linear_head_correction
         tail_correction_function = pair_tail_correction
@@ -40,28 +53,7 @@ def pair_correction(r, V, form, r_switch=2.5):
     else:
         raise ValueError(f'Unsupported head correction form: "{form}"')
 
-    real_idx = np.where(np.isfinite(V))[0]
-    # Check for continuity of real_indices:
-    if not np.all(np.ediff1d(real_idx) == 1):
-        start = real_idx[0]
-        end = real_idx[-1]
-        # Correct nans, infs that are surrounded by 2 finite numbers
-        for idx, v in enumerate(V[start:end]):
-            if not np.isfinite(v):
-                try:
-                    avg = (V[idx + start - 1] + V[idx + start + 1]) / 2
-                    V[idx + start] = avg
-                except IndexError:
-                    pass
-        # Trim off edge cases
-        _real_idx = np.where(np.isfinite(V))[0]
-        real_idx = max(
-            [list(g) for g in mit.consecutive_groups(_real_idx)], key=len
-        )
-
-    head_cutoff = real_idx[0] - 1
-    tail_cutoff = real_idx[-1] + 1
-
+    V, real_idx, head_cutoff, tail_cutoff = finite_segment(V)
     head_correction_V = head_correction_function(r=r, V=V, cutoff=head_cutoff)
     # Potential with both head correction and tial correciton applied
     tail_correction_V = tail_correction_function(
@@ -73,9 +65,19 @@ def pair_correction(r, V, form, r_switch=2.5):
 def bond_correction(r, V, form):
     """Handles corrections for both the head and tail of
     bond scretching and angle potentials.
-    """
-    import more_itertools as mit
 
+    Parameters
+    ----------
+    r : np.ndarray, shape=(n_points,)
+        Separation values
+    V : np.ndarray, shape=(n_points,) or (n_potentials, n_points)
+        Potential at each of the separation values.
+        A 2D array is corrected as a batch of potentials.
+    form : str
+        The form of the corrections, "linear", "linear_optimized"
+        or "exponential".
+
+    """
     if form == "linear":
         head_correction_function = linear_head_correction
         tail_correction_function = linear_tail_correction
@@ -88,27 +90,7 @@ def bond_correction(r, V, form):
     else:
         raise ValueError(f'Unsupported head correction form: "{form}"')
 
-    real_idx = np.where(np.isfinite(V))[0]
-    # Check for continuity of real_indices:
-    if not np.all(np.ediff1d(real_idx) == 1):
-        start = real_idx[0]
-        end = real_idx[-1]
-        # Correct nans, infs that are surrounded by 2 finite numbers
-        for idx, v in enumerate(V[start:end]):
-            if not np.isfinite(v):
-                try:
-                    avg = (V[idx + start - 1] + V[idx + start + 1]) / 2
-                    V[idx + start] = avg
-                except IndexError:
-                    pass
-        # Trim off edge cases
-        _real_idx = np.where(np.isfinite(V))[0]
-        real_idx = max(
-            [list(g) for g in mit.consecutive_groups(_real_idx)], key=len
-        )
-
-    head_cutoff = real_idx[0] - 1
-    tail_cutoff = real_idx[-1] + 1
+    V, real_idx, head_cutoff, tail_cutoff = finite_segment(V)
     # Potential with the head correction applied
     head_correction_V = head_correction_function(r=r, V=V, cutoff=head_cutoff)
     # Potential with both head correction and tial correciton applied
@@ -118,6 +100,87 @@ def bond_correction(r, V, form):
     return tail_correction_V, real_idx, head_cutoff, tail_cutoff
 
 
+def finite_segment(V):
+    """Fill isolated undefined values of V and find its real region.
+
+    Parameters
+    ----------
+    V : np.ndarray, shape=(n_points,) or (n_potentials, n_points)
+        Potential values. Undefined values are filled in place.
+
+    Returns
+    -------
+    V : np.ndarray
+        The potential with isolated undefined values filled.
+    real_idx : np.ndarray or list of np.ndarray
+        Indices of the longest run of finite values.
+        For a batch of potentials, one array per potential.
+    head_cutoff : int or np.ndarray
+        The last non real index before the real region.
+    tail_cutoff : int or np.ndarray
+        The first non real index after the real region.
+
+    """
+    V = np.asarray(V)
+    batch = np.atleast_2d(V)
+    interpolate_gaps(batch)
+    start, stop = longest_finite_run(batch)
+    if V.ndim == 1:
+        return V, np.arange(start[0], stop[0]), start[0] - 1, stop[0]
+    real_idx = [np.arange(i, j) for i, j in zip(start, stop)]
+    return V, real_idx, start - 1, stop
+
+
+def interpolate_gaps(V):
+    """Replace undefined values that have a finite value on each side
+    with the average of their two neighbors.
+
+    Parameters
+    ----------
+    V : np.ndarray, shape=(..., n_points)
+        Potential values, modified in place.
+
+    """
+    finite = np.isfinite(V)
+    gaps = ~finite[..., 1:-1] & finite[..., :-2] & finite[..., 2:]
+    with np.errstate(invalid="ignore"):
+        average = (V[..., :-2] + V[..., 2:]) / 2
+    V[..., 1:-1][gaps] = average[gaps]
+    return V
+
+
+def longest_finite_run(V):
+    """Find the longest run of consecutive finite values of each potential.
+
+    The first run is used when several runs have the same length.
+
+    Parameters
+    ----------
+    V : np.ndarray, shape=(n_points,) or (n_potentials, n_points)
+        Potential values.
+
+    Returns
+    -------
+    start, stop : np.ndarray, shape=(n_potentials,)
+        The first index and one past the last index of each run.
+
+    """
+    finite = np.isfinite(np.atleast_2d(V))
+    if not np.all(finite.any(axis=1)):
+        raise RuntimeError(
+            "No finite values in the potential. "
+            "This probably means you need better sampling at this state point."
+        )
+    padded = np.zeros((finite.shape[0], finite.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = finite
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    stops = np.nonzero(edges == -1)[1]
+    order = np.lexsort((starts, starts - stops, rows))
+    longest = order[np.unique(rows[order], return_index=True)[1]]
+    return starts[longest], stops[longest]
+
+
 def pair_tail_correction(r, V, r_switch):
     """Apply a tail correction to a potential making it go to zero smoothly.
 
@@ -125,7 +188,7 @@ def pair_tail_correction(r, V, r_switch):
     ----------
     r : np.ndarray, shape=(n_points,), dtype=float
         The radius values at which the potential is given.
-    V : np.ndarray, shape=r.shape, dtype=float
+    V : np.ndarray, shape=(..., n_points), dtype=float
         The potential values at each radius value.
     r_switch : float, optional, default=pot_r[-1] - 5 * dr
         The radius after which a tail correction is applied.
@@ -170,32 +233,29 @@ def pair_head_correction(r, V, previous_V=None, form="linear"):
     else:
         raise ValueError(f'Unsupported head correction form: "{form}"')
 
-    for i, pot_value in enumerate(V[::-1]):
-        # Apply correction function because either of the following is true:
-        #   * both current and target RDFs are 0 --> nan values in potential.
-        #   * current rdf > 0, target rdf = 0 --> +inf values in potential.
-        if np.isnan(pot_value) or np.isposinf(pot_value):
-            last_real = V.shape[0] - i - 1
-            if last_real > len(V) - 2:
-                raise RuntimeError(
-                    "Undefined values in tail of potential."
-                    "This probably means you need better "
-                    "sampling at this state point."
-                )
-            return correction_function(r, V, last_real)
-        # Retain old potential at small r because:
-        #   * current rdf = 0, target rdf > 0 --> -inf values in potential.
-        elif np.isneginf(pot_value):
-            last_neginf = V.shape[0] - i - 1
-            for i, pot_value in enumerate(V[: last_neginf + 1]):
-                V[i] = previous_V[i]
-            return V
-    else:
+    undefined = np.flatnonzero(~np.isfinite(V))
+    if len(undefined) == 0:
         warnings.warn(
             "No inf/nan values in your potential--this is unusual!"
             "No head correction applied"
         )
         return V
+    last_undefined = undefined[-1]
+    # Retain old potential at small r because:
+    #   * current rdf = 0, target rdf > 0 --> -inf values in potential.
+    if np.isneginf(V[last_undefined]):
+        V[: last_undefined + 1] = previous_V[: last_undefined + 1]
+        return V
+    # Apply correction function because either of the following is true:
+    #   * both current and target RDFs are 0 --> nan values in potential.
+    #   * current rdf > 0, target rdf = 0 --> +inf values in potential.
+    if last_undefined > len(V) - 2:
+        raise RuntimeError(
+            "Undefined values in tail of potential."
+            "This probably means you need better "
+            "sampling at this state point."
+        )
+    return correction_function(r, V, last_undefined)
 
 
 def linear_tail_correction(r, V, cutoff, window=6):
@@ -205,47 +265,52 @@ def linear_tail_correction(r, V, cutoff, window=6):
     ----------
     r : np.ndarray
         Separation values
-    V : np.ndarray
+    V : np.ndarray, shape=(n_points,) or (n_potentials, n_points)
         Potential at each of the separation values
-    cutoff : int
-        The last real value of V when iterating backwards
+    cutoff : int or np.ndarray
+        The last real value of V when iterating backwards,
+        one value per potential for a batch.
     window : int
         Number of data points backward from cutoff to use in slope calculation
 
     """
-    slope = (
-                    V[cutoff - 1] - V[cutoff - window]
-            ) / (r[cutoff - 1] - r[cutoff - window])
-    if slope < 0:
-        slope = -slope
-    V[cutoff:] = slope * (r[cutoff:] - r[cutoff - 1]) + V[cutoff - 1]
+    batch, cutoff, rows = _batch(V, cutoff)
+    slope = np.abs(
+            (batch[rows, cutoff - 1] - batch[rows, cutoff - window])
+            / (r[cutoff - 1] - r[cutoff - window])
+    )
+    rows, cols = np.nonzero(np.arange(len(r)) >= cutoff[:, None])
+    batch[rows, cols] = (
+            slope[rows] * (r[cols] - r[cutoff[rows] - 1])
+            + batch[rows, cutoff[rows] - 1]
+    )
     return V
 
 
 def linear_tail_correction_optimized(r, V, cutoff, window=6):
     """Use a linear function to smoothly force V to a finite value at V(cut).
 
-    This function uses scipy.optimize.curve_fit to find the slope and intercept
-    of the linear function that is used to correct the tail of the potential.
+    The slope and intercept of the linear function used to correct the tail
+    of the potential are found by a least squares fit.
 
     Parameters
     ----------
     r : np.ndarray
         Separation values
-    V : np.ndarray
+    V : np.ndarray, shape=(n_points,) or (n_potentials, n_points)
         Potential at each of the separation values
-    cutoff : int
-        The last real value of V when iterating backwards
+    cutoff : int or np.ndarray
+        The last real value of V when iterating backwards,
+        one value per potential for a batch.
     window : int
         Number of data points backward from cutoff to use in slope calculation
 
     """
-
-    def linear(x, m, b):
-        return m * x + b
-
-    popt, pcov = curve_fit(linear, r[cutoff - window:cutoff], V[cutoff - window:cutoff])
-    V[cutoff:] = linear(r[cutoff:], *popt)
+    batch, cutoff, rows = _batch(V, cutoff)
+    fit_idx = cutoff[:, None] + np.arange(-window, 0)
+    slope, intercept = _linear_fit(r[fit_idx], batch[rows[:, None], fit_idx])
+    rows, cols = np.nonzero(np.arange(len(r)) >= cutoff[:, None])
+    batch[rows, cols] = slope[rows] * r[cols] + intercept[rows]
     return V
 
 
@@ -255,46 +320,51 @@ def linear_head_correction(r, V, cutoff, window=6):
     ----------
     r : np.ndarray
         Separation values
-    V : np.ndarray
+    V : np.ndarray, shape=(n_points,) or (n_potentials, n_points)
         Potential at each of the separation values
-    cutoff : int
-        The first real value of V when iterating forwards
+    cutoff : int or np.ndarray
+        The first real value of V when iterating forwards,
+        one value per potential for a batch.
     window : int
         Number of data points forward from cutoff to use in slope calculation
 
     """
-    slope = (
-                    V[cutoff + 1] - V[cutoff + window]
-            ) / (r[cutoff + 1] - r[cutoff + window])
-    if slope > 0:
-        slope = -slope
-    V[: cutoff + 1] = slope * (r[: cutoff + 1] - r[cutoff + 1]) + V[cutoff + 1]
+    batch, cutoff, rows = _batch(V, cutoff)
+    slope = -np.abs(
+            (batch[rows, cutoff + 1] - batch[rows, cutoff + window])
+            / (r[cutoff + 1] - r[cutoff + window])
+    )
+    rows, cols = np.nonzero(np.arange(len(r)) <= cutoff[:, None])
+    batch[rows, cols] = (
+            slope[rows] * (r[cols] - r[cutoff[rows] + 1])
+            + batch[rows, cutoff[rows] + 1]
+    )
     return V
 
 
 def linear_head_correction_optimized(r, V, cutoff, window=6):
     """Use a linear function to smoothly force V to a finite value at V(0).
 
-    This function uses scipy.optimize.curve_fit to find the slope and intercept
-    of the linear function that is used to correct the head of the potential.
+    The slope and intercept of the linear function used to correct the head
+    of the potential are found by a least squares fit.
 
     Parameters
     ----------
     r : np.ndarray
         Separation values
-    V : np.ndarray
+    V : np.ndarray, shape=(n_points,) or (n_potentials, n_points)
         Potential at each of the separation values
-    cutoff : int
-        The first real value of V when iterating forwards
+    cutoff : int or np.ndarray
+        The first real value of V when iterating forwards,
+        one value per potential for a batch.
     window : int
         Number of data points forward from cutoff to use in slope calculation
     """
-
-    def linear(x, m, b):
-        return m * x + b
-
-    popt, pcov = curve_fit(linear, r[cutoff + 1:cutoff + window], V[cutoff + 1:cutoff + window])
-    V[:cutoff + 1] = linear(r[:cutoff + 1], *popt)
+    batch, cutoff, rows = _batch(V, cutoff)
+    fit_idx = cutoff[:, None] + np.arange(1, window)
+    slope, intercept = _linear_fit(r[fit_idx], batch[rows[:, None], fit_idx])
+    rows, cols = np.nonzero(np.arange(len(r)) <= cutoff[:, None])
+    batch[rows, cols] = slope[rows] * r[cols] + intercept[rows]
     return V
 
 
@@ -317,11 +387,6 @@ def exponential_tail_correction(r, V, cutoff):
     raise RuntimeError("Exponential tail corrections are not implemented."
                        "Use the linear correction form when optimizing bonds and angles."
                        )
-    dr = r[cutoff - 1] - r[cutoff - 2]
-    B = np.log(V[cutoff - 1] / V[cutoff - 2]) / dr
-    A = V[cutoff - 1] * np.exp(B * r[cutoff - 1])
-    V[cutoff:] = A * np.exp(B * r[cutoff:])
-    return V
 
 
 def exponential_head_correction(r, V, cutoff):
@@ -331,22 +396,74 @@ def exponential_head_correction(r, V, cutoff):
     ----------
     r : np.ndarray
         Separation values
-    V : np.ndarray
+    V : np.ndarray, shape=(n_points,) or (n_potentials, n_points)
         Potential at each of the separation values
-    cutoff : int
-        The last non real value of V when iterating forwards
+    cutoff : int or np.ndarray
+        The last non real value of V when iterating forwards,
+        one value per potential for a batch.
 
     This function fits the small part of the potential to the form:
     V(r) = A*exp(-Br)
 
     """
+    batch, cutoff, rows = _batch(V, cutoff)
     dr = r[cutoff + 2] - r[cutoff + 1]
-    B = np.log(V[cutoff + 1] / V[cutoff + 2]) / dr
-    A = V[cutoff + 1] * np.exp(B * r[cutoff + 1])
-    V[:cutoff + 1] = A * np.exp(-B * r[:cutoff + 1])
+    B = np.log(batch[rows, cutoff + 1] / batch[rows, cutoff + 2]) / dr
+    A = batch[rows, cutoff + 1] * np.exp(B * r[cutoff + 1])
+    rows, cols = np.nonzero(np.arange(len(r)) <= cutoff[:, None])
+    batch[rows, cols] = A[rows] * np.exp(-B[rows] * r[cols])
     return V
 
 
+def _batch(V, cutoff):
+    """View V as a 2D batch of potentials with one cutoff per potential."""
+    batch = np.atleast_2d(V)
+    cutoff = np.broadcast_to(np.asarray(cutoff, dtype=int), batch.shape[:1])
+    return batch, cutoff, np.arange(batch.shape[0])
+
+
+def _linear_fit(x, y):
+    """Closed form least squares fit of a line to each row of x and y."""
+    x_mean = x.mean(axis=-1, keepdims=True)
+    y_mean = y.mean(axis=-1, keepdims=True)
+    dx = x - x_mean
+    slope = np.sum(dx * (y - y_mean), axis=-1) / np.sum(dx ** 2, axis=-1)
+    intercept = y_mean[..., 0] - slope * x_mean[..., 0]
+    return slope, intercept
+
+
 def alpha_array(alpha0, pot_r, dr, form="linear"):
     """Generate an array of alpha values used for scaling in the IBI step. """
     return alpha0 * (1.0 - (pot_r - dr) / (pot_r[-1] - dr))
+
+
+def ibi_update(current, target, kT, alpha):
+    """Find the IBI step of one or more potentials from several states.
+
+    The Boltzmann inversion of every state is weighted by its alpha values
+    and averaged over the states in a single vectorized operation.
+
+    Parameters
+    ----------
+    current : np.ndarray, shape=(..., n_states, nbins)
+        The current distribution of each state.
+    target : np.ndarray, shape=(..., n_states, nbins)
+        The target distribution of each state.
+    kT : np.ndarray, shape=(..., n_states)
+        The kT value of each state.
+    alpha : np.ndarray, shape=(..., n_states, nbins)
+        The alpha values of each state.
+
+    Returns
+    -------
+    np.ndarray, shape=(..., nbins)
+        The change to each potential.
+
+    """
+    current = np.asarray(current, dtype=float)
+    target = np.asarray(target, dtype=float)
+    kT = np.asarray(kT, dtype=float)
+    n_states = current.shape[-2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_ratio = np.log(current / target)
+    return np.sum(alpha * kT[..., None] * log_ratio, axis=-2) / n_states
@@ -0,0 +1,188 @@
+import numpy as np
+
+from msibi.analysis import block_error
+
+
+class StepSchedule(object):
+    """
+    Base class of the rules choosing the number of steps of each query
+    simulation. Don't call this class directly, instead use
+    msibi.schedules.GeometricSchedule or msibi.schedules.AdaptiveSchedule.
+
+    Attributes
+    ----------
+    adaptive : bool
+        If True, each query simulation is extended while the schedule's
+        extend method asks for more steps.
+
+    """
+
+    adaptive = False
+
+    def __repr__(self):
+        return f"{self.__class__}"
+
+    def n_steps(self, iteration: int) -> int:
+        """The number of steps of the query simulations of an iteration.
+
+        Parameters
+        ----------
+        iteration : int, required
+            The iteration, counted like MSIBI.n_iterations.
+
+        """
+        raise NotImplementedError
+
+
+class GeometricSchedule(StepSchedule):
+    """
+    A number of steps growing by a constant factor every iteration.
+
+    Early iterations, far from convergence, are run short, and later
+    iterations get the longer runs needed to resolve small differences
+    between the query and target distributions.
+
+    Parameters
+    ----------
+    start : int, required
+        The number of steps of the first iteration.
+    factor : float, optional, default 1.5
+        The factor the number of steps grows by each iteration.
+    max_steps : int, optional, default None
+        If given, the largest number of steps of any iteration.
+    multiple_of : int, optional, default 1
+        The number of steps is rounded up to a multiple of this,
+        for example the gsd_period of the optimization.
+
+    """
+
+    def __init__(
+            self,
+            start: int,
+            factor: float=1.5,
+            max_steps: int=None,
+            multiple_of: int=1
+    ):
+        if start < 1:
+            raise ValueError("start must be a positive integer.")
+        if factor <= 0:
+            raise ValueError("factor must be positive.")
+        if not isinstance(multiple_of, int) or multiple_of < 1:
+            raise ValueError("multiple_of must be a positive integer.")
+        self.start = start
+        self.factor = factor
+        self.max_steps = max_steps
+        self.multiple_of = multiple_of
+
+    def __repr__(self):
+        return (
+                f"{self.__class__}; "
+                + f"Start: {self.start}; "
+                + f"Factor: {self.factor}; "
+                + f"Max steps: {self.max_steps}"
+        )
+
+    def n_steps(self, iteration: int) -> int:
+        n_steps = self.start * self.factor ** iteration
+        if self.max_steps is not None:
+            n_steps = min(n_steps, self.max_steps)
+        return int(np.ceil(n_steps / self.multiple_of)) * self.multiple_of
+
+
+class AdaptiveSchedule(StepSchedule):
+    """
+    Extend each query simulation until its distributions are precise
+    enough for the current fit.
+
+    Every query simulation first runs min_steps, and is then extended in
+    chunks of chunk_steps while the statistical error of the distribution
+    of any optimized force is above target times the residual 1 - f_fit
+    of that force at the state, found in the previous iteration.
+    The error is found by block averaging the frames sampled so far,
+    see msibi.analysis.block_error. The statistical noise of the
+    distributions then stays a fixed fraction of the difference still to
+    be fitted, so runs get longer as the optimization converges.
+
+    The distributions must be accumulated while the query simulations run,
+    see the in_situ_analysis parameter of MSIBI.run_optimization.
+    Frames are sampled from the last State.n_frames frames of the first
+    min_steps, and from every frame of each extension.
+
+    Parameters
+    ----------
+    min_steps : int, required
+        The number of steps run before the error is first checked.
+    chunk_steps : int, required
+        The number of steps of each extension.
+    max_steps : int, required
+        The largest number of steps of any query simulation.
+    target : float, optional, default 0.5
+        The largest error, relative to the fit residual.
+    n_blocks : int, optional, default 5
+        The number of blocks used to find the error.
+
+    """
+
+    adaptive = True
+
+    def __init__(
+            self,
+            min_steps: int,
+            chunk_steps: int,
+            max_steps: int,
+            target: float=0.5,
+            n_blocks: int=5
+    ):
+        if min_steps < 1 or chunk_steps < 1:
+            raise ValueError(
+                "min_steps and chunk_steps must be positive integers."
+            )
+        if max_steps < min_steps:
+            raise ValueError("max_steps must be at least min_steps.")
+        if target <= 0:
+            raise ValueError("target must be positive.")
+        if n_blocks < 2:
+            raise ValueError("n_blocks must be at least 2.")
+        self.min_steps = min_steps
+        self.chunk_steps = chunk_steps
+        self.max_steps = max_steps
+        self.target = target
+        self.n_blocks = n_blocks
+
+    def __repr__(self):
+        return (
+                f"{self.__class__}; "
+                + f"Steps: {self.min_steps} to {self.max_steps}; "
+                + f"Target: {self.target}"
+        )
+
+    def n_steps(self, iteration: int) -> int:
+        return self.min_steps
+
+    def extend(
+            self,
+            histograms: dict,
+            residuals: dict,
+            steps_run: int
+    ) -> bool:
+        """Whether a query simulation needs another chunk of steps.
+
+        Parameters
+        ----------
+        histograms : dict of msibi.analysis.Histogram, required
+            The histograms filled by the simulation, by force key.
+            They must record the counts of every frame.
+        residuals : dict of float, required
+            The fit residual of each force at the simulated state.
+            Forces without one use a residual of 1.
+        steps_run : int, required
+            The number of steps run so far.
+
+        """
+        if steps_run + self.chunk_steps > self.max_steps:
+            return False
+        return any(
+                block_error(histogram, self.n_blocks)
+                > self.target * residuals.get(key, 1.0)
+                for key, histogram in histograms.items()
+        )
@@ -0,0 +1,286 @@
+import numpy as np
+
+from msibi.potentials import ibi_update
+from msibi.utils.history import HistoryBuffer
+
+
+class UpdateScheme(object):
+    """
+    Base class of the rules used to update potentials each iteration.
+    Don't call this class directly, instead use msibi.schemes.IBI
+    or msibi.schemes.IMC.
+
+    A scheme is given the current and target distributions of a force at
+    every state, stacked into arrays, and returns the change to the
+    force's potential.
+
+    Attributes
+    ----------
+    requires_fluctuations : bool
+        If True, the covariance of the per-frame histogram counts is
+        recorded during each query run, and the response of every
+        distribution to the potential is passed to the scheme.
+
+    """
+
+    requires_fluctuations = False
+
+    def __repr__(self):
+        return f"{self.__class__}"
+
+    def step(
+            self,
+            current: np.ndarray,
+            target: np.ndarray,
+            kT: np.ndarray,
+            alpha: np.ndarray,
+            responses: np.ndarray=None
+    ) -> np.ndarray:
+        """Find the change to one or more potentials.
+
+        Parameters
+        ----------
+        current : np.ndarray, shape=(..., n_states, nbins), required
+            The current distribution of each state.
+        target : np.ndarray, shape=(..., n_states, nbins), required
+            The target distribution of each state.
+        kT : np.ndarray, shape=(..., n_states), required
+            The kT value of each state.
+        alpha : np.ndarray, shape=(..., n_states, nbins), required
+            The alpha values of each state.
+        responses : np.ndarray, shape=(..., n_states, nbins, nbins)
+            The response of each state's distribution to the potential.
+            Only given when requires_fluctuations is True.
+
+        Returns
+        -------
+        np.ndarray, shape=(..., nbins)
+            The change to each potential.
+
+        """
+        raise NotImplementedError
+
+
+class IBI(UpdateScheme):
+    """
+    Iterative Boltzmann inversion, the default update scheme.
+
+    The potential is changed by the alpha-weighted average over states of
+    kT * ln(P_current / P_target).
+
+    """
+
+    def step(self, current, target, kT, alpha, responses=None) -> np.ndarray:
+        return ibi_update(current, target, kT, alpha)
+
+
+class IMC(UpdateScheme):
+    """
+    Inverse Monte Carlo, a Newton method for updating potentials.
+
+    During each query run the covariance matrix of the per-frame histogram
+    counts is accumulated. It gives the linear response J of each
+    distribution to the potential, and the update solves
+
+        J dU = P_target - P_current
+
+    for every state at once as a regularized least squares problem.
+    Each bin of the step is then scaled by the average alpha of the states.
+    IMC usually needs far fewer iterations than IBI, but needs enough
+    frames per query run for the covariance to be well sampled.
+
+    Parameters
+    ----------
+    regularization : float, optional, default 1e-2
+        Tikhonov regularization, relative to the mean diagonal of J^T J.
+        Larger values give smaller, more stable steps.
+    max_step : float, optional, default None
+        If given, the largest change to the potential in any bin, in units
+        of kT. Larger steps are scaled down.
+
+    """
+
+    requires_fluctuations = True
+
+    def __init__(self, regularization: float=1e-2, max_step: float=None):
+        if regularization < 0:
+            raise ValueError("regularization must not be negative.")
+        self.regularization = regularization
+        self.max_step = max_step
+
+    def step(self, current, target, kT, alpha, responses=None) -> np.ndarray:
+        if responses is None:
+            raise RuntimeError(
+                "The IMC update scheme needs the response of each "
+                "distribution, found from the query run fluctuations."
+            )
+        current = np.asarray(current, dtype=float)
+        if current.ndim > 2:
+            return np.stack([
+                self.step(c, t, k, a, r)
+                for c, t, k, a, r in zip(current, target, kT, alpha, responses)
+            ])
+        residual = np.nan_to_num(np.asarray(target) - current)
+        responses = np.nan_to_num(np.asarray(responses, dtype=float))
+        normal = np.einsum("skj,ski->ji", responses, responses)
+        rhs = np.einsum("skj,sk->j", responses, residual)
+        n_bins = len(rhs)
+        scale = np.trace(normal) / n_bins
+        if scale == 0:
+            return np.zeros(n_bins)
+        normal[np.diag_indices(n_bins)] += self.regularization * scale
+        delta = np.linalg.lstsq(normal, rhs, rcond=None)[0]
+        delta *= np.mean(alpha, axis=0)
+        if self.max_step is not None:
+            limit = self.max_step * np.min(kT)
+            largest = np.max(np.abs(delta))
+            if largest > limit:
+                delta *= limit / largest
+        return delta
+
+
+class AndersonAcceleration(object):
+    """
+    Anderson mixing of the potential updates of a force.
+
+    Each iteration's update scheme step is treated as the residual of a
+    fixed point iteration. The last history_size potentials and steps are
+    kept, and the next potential is extrapolated from the combination of
+    previous steps that best cancels the current one. This damps the
+    oscillations around the fixed point seen in late IBI iterations.
+
+    As a safeguard, if the fit score of the distributions gets worse after
+    an accelerated step, the accelerated step is undone: the potential
+    goes back to the one used before it, plus the plain step found from
+    that potential's distributions. The stored history is discarded.
+
+    The accelerator stores a separate history for each force, so one
+    instance can be shared by several forces. Only the potential update
+    is changed; the query simulations are run as usual.
+
+    Parameters
+    ----------
+    history_size : int, optional, default 5
+        The number of previous steps used in the extrapolation.
+    mixing : float, optional, default 1.0
+        The fraction of the current step mixed into the next potential.
+    regularization : float, optional, default 1e-8
+        Tikhonov regularization of the least squares fit, relative to the
+        mean squared step difference.
+
+    Attributes
+    ----------
+    n_accelerated : int
+        The number of accelerated steps taken.
+    n_rejected : int
+        The number of times an accelerated step made the fit worse.
+
+    """
+
+    def __init__(
+            self,
+            history_size: int=5,
+            mixing: float=1.0,
+            regularization: float=1e-8
+    ):
+        if not isinstance(history_size, int) or history_size < 1:
+            raise ValueError("history_size must be a positive integer.")
+        self.history_size = history_size
+        self.mixing = mixing
+        self.regularization = regularization
+        self.n_accelerated = 0
+        self.n_rejected = 0
+        self._forces = dict()
+
+    def __repr__(self):
+        return (
+                f"{self.__class__}; "
+                + f"History size: {self.history_size}; "
+                + f"Mixing: {self.mixing}"
+        )
+
+    def reset(self, force=None) -> None:
+        """Discard the stored history of one force, or of every force."""
+        if force is None:
+            self._forces = dict()
+        else:
+            self._forces.pop(force._key, None)
+
+    def step(
+            self,
+            force,
+            potential: np.ndarray,
+            delta: np.ndarray,
+            fit: float
+    ) -> np.ndarray:
+        """Find the accelerated change to a force's potential.
+
+        Parameters
+        ----------
+        force : msibi.forces.Force, required
+            The force being updated.
+        potential : np.ndarray, required
+            The potential used in the latest query simulations.
+        delta : np.ndarray, required
+            The plain step found by the force's update scheme.
+        fit : float, required
+            The fit score of the distributions found using potential.
+
+        Returns
+        -------
+        np.ndarray
+            The change to the potential.
+
+        """
+        history = self._history(force)
+        if history["accelerated"] and fit < history["fit"]:
+            self.n_rejected += 1
+            plain = history["potentials"].last + history["residuals"].last
+            self.reset(force)
+            restored = np.array(delta, dtype=float)
+            finite = np.isfinite(plain) & np.isfinite(potential)
+            restored[finite] = plain[finite] - potential[finite]
+            return restored
+        history["fit"] = fit
+        history["potentials"].append(potential)
+        history["residuals"].append(delta)
+        history["accelerated"] = False
+        if len(history["residuals"]) < 2:
+            return delta
+
+        potentials = history["potentials"].array
+        residuals = history["residuals"].array
+        finite = (
+            np.all(np.isfinite(potentials), axis=0)
+            & np.all(np.isfinite(residuals), axis=0)
+        )
+        if not np.any(finite):
+            return delta
+        d_potentials = np.diff(potentials[:, finite], axis=0).T
+        d_residuals = np.diff(residuals[:, finite], axis=0).T
+        normal = d_residuals.T @ d_residuals
+        scale = np.trace(normal) / len(normal)
+        if scale == 0:
+            return delta
+        normal[np.diag_indices(len(normal))] += self.regularization * scale
+        gamma = np.linalg.lstsq(
+            normal, d_residuals.T @ delta[finite], rcond=None
+        )[0]
+        accelerated = np.array(delta, dtype=float)
+        accelerated[finite] = (
+            self.mixing * delta[finite]
+            - (d_potentials + self.mixing * d_residuals) @ gamma
+        )
+        history["accelerated"] = True
+        self.n_accelerated += 1
+        return accelerated
+
+    def _history(self, force) -> dict:
+        if force._key not in self._forces:
+            self._forces[force._key] = {
+                "potentials": HistoryBuffer(retention=self.history_size + 1),
+                "residuals": HistoryBuffer(retention=self.history_size + 1),
+                "fit": None,
+                "accelerated": False
+            }
+        return self._forces[force._key]
@@ -1,13 +1,18 @@
+from __future__ import annotations
+
+from functools import lru_cache
 import os
 import shutil
 from typing import Union
 import warnings
 
-import gsd.hoomd
-import hoomd
 import numpy as np
 
+from msibi.analysis import RDFEngine, Topology
 from msibi.potentials import alpha_array
+from msibi.schedules import StepSchedule
+from msibi.utils.cache import DistributionCache
+from msibi.utils.timing import Timer
 
 
 class State(object):
@@ -30,6 +35,28 @@ class State(object):
         Alpha can be a constant number that is applied to the potential at all
         independent values (x), or it can be a linear function that approaches
         zero as x approaches x_cut.
+    warm_start : bool, optional, default False
+        If True, each query simulation after the first starts from the
+        final configuration of the previous iteration's query simulation,
+        which is kept in memory, rather than from the last frame of traj_file.
+    equilibration_steps : int, optional, default 0
+        Number of steps run at the start of each query simulation before
+        frames are written to the query trajectory. These frames are
+        not used in calculating the query distributions.
+    target_cache : msibi.utils.cache.DistributionCache, optional
+        If given, target distributions calculated from traj_file are
+        stored in and loaded from this on-disk cache.
+    frame_stride : int, optional, default 1
+        Only every frame_stride-th frame of the last n_frames frames is
+        used in calculating distributions.
+    include_final_frame : bool, optional, default False
+        If True, the final frame of a trajectory is used in calculating
+        distributions. By default it is left out, as the original
+        cmeutils functions did.
+    resume : bool, optional, default False
+        If True, the state directory is reopened if it already exists,
+        for example when continuing an optimization from a checkpoint.
+        Otherwise an existing state directory raises an error.
 
     Attributes
     ----------
@@ -57,12 +84,22 @@ class State(object):
         alpha0: float=1.0,
         alpha_form: str = "constant",
         exclude_bonded: bool=True, #TODO: Do we use this here or in Force?
+        warm_start: bool=False,
+        equilibration_steps: int=0,
+        target_cache: DistributionCache=None,
+        frame_stride: int=1,
+        include_final_frame: bool=False,
+        resume: bool=False,
         _dir=None
     ):
         if alpha_form.lower() not in ["constant", "linear"]:
             raise ValueError(
                     "The only supported alpha forms are `constant` and `linear`"
             )
+        if equilibration_steps < 0:
+            raise ValueError("equilibration_steps must not be negative.")
+        if not isinstance(frame_stride, int) or frame_stride < 1:
+            raise ValueError("frame_stride must be a positive integer.")
         self.name = name
         self.kT = kT
         self.traj_file = os.path.abspath(traj_file)
@@ -70,9 +107,25 @@ class State(object):
         self._opt = None
         self._alpha0 = float(alpha0)
         self.alpha_form = alpha_form
-        self.dir = self._setup_dir(name, kT, dir_name=_dir)
+        self.dir = self._setup_dir(name, kT, dir_name=_dir, resume=resume)
         self.query_traj = os.path.join(self.dir, "query.gsd")
         self.exclude_bonded = exclude_bonded
+        self.warm_start = warm_start
+        self.equilibration_steps = int(equilibration_steps)
+        self.target_cache = target_cache
+        self.frame_stride = frame_stride
+        self.include_final_frame = include_final_frame
+        self._last_frame = None
+        self._last_target_frame = None
+        self._query_distributions = dict()
+        self._query_responses = dict()
+        self._query_histograms = dict()
+        self._reference_potentials = dict()
+        self._timings = []
+        self._topologies = dict()
+        self._rdf = None
+        self._sim = None
+        self._forces = None
 
     def __repr__(self):
         return (
@@ -82,6 +135,55 @@ class State(object):
                 + f"Alpha0: {self.alpha0}"
         )
 
+    def __getstate__(self):
+        # The MSIBI reference and any persistent hoomd objects are not
+        # sent to a worker process running this state's query simulation.
+        state = self.__dict__.copy()
+        state["_opt"] = None
+        state["_sim"] = None
+        state["_forces"] = None
+        return state
+
+    @property
+    def _target_frame(self) -> gsd.hoomd.Frame:
+        """The last frame of the target trajectory, read once."""
+        if self._last_target_frame is None:
+            import gsd.hoomd
+
+            with gsd.hoomd.open(self.traj_file, "r") as traj:
+                self._last_target_frame = traj[-1]
+        return self._last_target_frame
+
+    def _topology(self, query: bool) -> Topology:
+        """The topology of the query or target trajectory.
+
+        It is read once from the first frame of the trajectory and reused,
+        since bonded topology does not change between frames or iterations.
+        """
+        key = "query" if query else "target"
+        if key not in self._topologies:
+            traj = self.query_traj if query else self.traj_file
+            self._topologies[key] = Topology.from_gsd(traj)
+        return self._topologies[key]
+
+    @property
+    def _rdf_engine(self) -> RDFEngine:
+        """The engine computing this state's pair distributions.
+
+        It is created on first use and kept for the whole optimization,
+        so its thread pool is not restarted every iteration.
+        """
+        if self._rdf is None:
+            self._rdf = RDFEngine()
+        return self._rdf
+
+    @property
+    def _initial_frame(self) -> gsd.hoomd.Frame:
+        """The configuration the next query simulation starts from."""
+        if self.warm_start and self._last_frame is not None:
+            return self._last_frame
+        return self._target_frame
+
     @property
     def n_frames(self) -> int:
         """The number of frames used in calculating distributions."""
@@ -91,6 +193,20 @@ class State(object):
     def n_frames(self, value: int):
         self._n_frames = value
 
+    @property
+    def frame_slice(self) -> dict:
+        """The start, stop and stride of the trajectory frames used in
+        calculating distributions.
+
+        These are the last n_frames frames, every frame_stride-th frame,
+        and the final frame only if include_final_frame is True.
+        """
+        return dict(
+                start=-self.n_frames,
+                stop=None if self.include_final_frame else -1,
+                stride=self.frame_stride
+        )
+
     @property
     def alpha0(self) -> Union[int, float]:
         """State point base weighting value."""
@@ -138,20 +254,189 @@ class State(object):
             seed: int,
             iteration: int,
             gsd_period: int,
-            backup_trajectories: bool=False
+            backup_trajectories: bool=False,
+            num_cpu_threads: int=None,
+            persistent: bool=False,
+            histograms: dict=None,
+            callback=None,
+            step_schedule: StepSchedule=None,
+            residuals: dict=None
     ) -> None:
         """Run the hoomd 4 script used to run each query simulation.
         This method is called in msibi.optimize.
 
+        If num_cpu_threads is given, the simulation runs on a CPU device
+        limited to that many threads. Otherwise, the device is auto-selected.
+
+        If persistent is True, the Simulation is kept between iterations.
+        Later calls reuse the existing integrator and force objects, which
+        are expected to have had their parameters updated in place.
+        The simulation is rewound to the target configuration, unless
+        warm_start is True, in which case it continues from where the
+        previous iteration stopped.
+
+        If histograms are given, they accumulate the query distributions
+        from the same frames the query trajectory would be analyzed with,
+        see State.frame_slice, and the query trajectory is only written
+        when backup_trajectories is True.
+
+        If an adaptive step_schedule is given, the simulation is extended
+        in chunks while the schedule asks for more steps, given the
+        histograms and the fit residual of each force in residuals.
+
+        If a callback is given, it is called with this state and the hoomd
+        Simulation once the simulation has finished.
+
         """
-        device = hoomd.device.auto_select()
-        sim = hoomd.simulation.Simulation(device=device)
+        import hoomd
+
         print(f"Starting simulation {iteration} for state {self}")
-        print(f"Running on device {device}")
+        self._query_distributions = dict()
+        self._query_responses = dict()
+        self._query_histograms = dict()
+        timer = Timer()
+        phase = dict(iteration=iteration, state=self.name)
+        with timer.phase("simulation_setup", **phase):
+            if persistent and self._sim is not None:
+                sim = self._sim
+                if not self.warm_start:
+                    sim.state.set_snapshot(
+                            hoomd.Snapshot.from_gsd_frame(
+                                self._target_frame, sim.device.communicator
+                            )
+                    )
+            else:
+                sim = self._create_simulation(
+                        forces=forces,
+                        integrator_method=integrator_method,
+                        method_kwargs=method_kwargs,
+                        thermostat=thermostat,
+                        thermostat_kwargs=thermostat_kwargs,
+                        dt=dt,
+                        num_cpu_threads=num_cpu_threads
+                )
+                if persistent:
+                    self._sim = sim
+        with timer.phase("simulation", **phase) as record:
+            print(f"Running on device {sim.device}")
+            if self.equilibration_steps:
+                sim.run(self.equilibration_steps)
+            write_query_traj = histograms is None or backup_trajectories
+            writers = []
+            if write_query_traj:
+                #Create GSD writer
+                gsd_writer = hoomd.write.GSD(
+                        filename=self.query_traj,
+                        trigger=hoomd.trigger.Periodic(int(gsd_period)),
+                        mode="wb",
+                )
+                writers.append(gsd_writer)
+            if histograms is not None:
+                writers.append(
+                        hoomd.write.CustomWriter(
+                            action=_histogram_action_class()(histograms),
+                            trigger=self._histogram_trigger(
+                                sim=sim,
+                                n_steps=n_steps,
+                                gsd_period=gsd_period,
+                                extended=(
+                                    step_schedule is not None
+                                    and step_schedule.adaptive
+                                )
+                            )
+                        )
+                )
+            for writer in writers:
+                sim.operations.writers.append(writer)
+            # Run simulation
+            sim.run(n_steps)
+            steps_run = n_steps
+            if step_schedule is not None and step_schedule.adaptive:
+                while histograms and step_schedule.extend(
+                        histograms, residuals or dict(), steps_run
+                ):
+                    sim.run(step_schedule.chunk_steps)
+                    steps_run += step_schedule.chunk_steps
+            if write_query_traj:
+                gsd_writer.flush()
+            record["timesteps"] = steps_run
+            record["tps"] = sim.tps
+        if histograms is not None:
+            self._query_histograms = histograms
+            self._query_distributions = {
+                key: histogram.distribution()
+                for key, histogram in histograms.items()
+            }
+            self._query_responses = {
+                key: histogram.response(kT=self.kT)
+                for key, histogram in histograms.items()
+                if histogram.records_fluctuations
+            }
+        if callback is not None:
+            callback(self, sim)
+        if persistent:
+            for writer in writers:
+                sim.operations.writers.remove(writer)
+        elif self.warm_start:
+            self._last_frame = _snapshot_to_frame(sim.state.get_snapshot())
+        if backup_trajectories:
+            shutil.copy(
+                    self.query_traj,
+                    os.path.join(self.dir, f"query{iteration}.gsd")
+            )
+        self._timings = timer.records
+        print(f"Finished simulation {iteration} for state {self}")
+        print()
+
+    def _histogram_trigger(
+            self,
+            sim: hoomd.Simulation,
+            n_steps: int,
+            gsd_period: int,
+            extended: bool=False
+    ) -> hoomd.trigger.Trigger:
+        """Trigger on the steps of the frames of a run selected by
+        State.frame_slice.
 
-        with gsd.hoomd.open(self.traj_file, "r") as traj:
-            last_snap = traj[-1]
-        sim.create_state_from_snapshot(last_snap)
+        If the run is extended beyond n_steps, every frame_stride-th frame
+        from there on is also sampled.
+        """
+        import hoomd
+
+        period = int(gsd_period)
+        last = period * ((sim.timestep + n_steps) // period)
+        # The first frame written, and the first of the last n_frames.
+        first = max(
+                period * -(-sim.timestep // period),
+                last - period * (self.n_frames - 1)
+        )
+        stride = period * self.frame_stride
+        triggers = [hoomd.trigger.Periodic(stride, phase=first % stride)]
+        if first > sim.timestep:
+            triggers.append(hoomd.trigger.After(first - 1))
+        if not (extended or self.include_final_frame):
+            triggers.append(hoomd.trigger.Before(last))
+        return hoomd.trigger.And(triggers)
+
+    def _create_simulation(
+            self,
+            forces: list,
+            integrator_method: str,
+            method_kwargs: dict,
+            thermostat: str,
+            thermostat_kwargs: dict,
+            dt: float,
+            num_cpu_threads: int=None
+    ) -> hoomd.Simulation:
+        """Build a hoomd Simulation starting from the initial configuration."""
+        import hoomd
+
+        if num_cpu_threads:
+            device = hoomd.device.CPU(num_cpu_threads=num_cpu_threads)
+        else:
+            device = hoomd.device.auto_select()
+        sim = hoomd.simulation.Simulation(device=device)
+        sim.create_state_from_snapshot(self._initial_frame)
         integrator = hoomd.md.Integrator(dt=dt)
         integrator.forces = forces
         thermostat = thermostat(kT=self.kT, **thermostat_kwargs)
@@ -163,26 +448,27 @@ class State(object):
                 )
         )
         sim.operations.add(integrator)
-        #Create GSD writer
-        gsd_writer = hoomd.write.GSD(
-                filename=self.query_traj,
-                trigger=hoomd.trigger.Periodic(int(gsd_period)),
-                mode="wb",
-        )
-        sim.operations.writers.append(gsd_writer)
-        # Run simulation
-        sim.run(n_steps)
-        gsd_writer.flush()
-        if backup_trajectories:
-            shutil.copy(
-                    self.query_traj,
-                    os.path.join(self.dir, f"query{iteration}.gsd")
-            )
-        print(f"Finished simulation {iteration} for state {self}")
-        print()
+        return sim
+
+    def _query_results(self) -> dict:
+        """Attributes set by a query simulation.
+
+        These are sent back from a worker process when the query
+        simulations are run in parallel.
+        """
+        return {
+            "_last_frame": self._last_frame,
+            "_query_distributions": self._query_distributions,
+            "_query_responses": self._query_responses,
+            "_query_histograms": self._query_histograms,
+            "_timings": self._timings
+        }
 
-    def _setup_dir(self, name, kT, dir_name=None) -> str:
-        """Create a state directory each time a new State is created."""
+    def _setup_dir(self, name, kT, dir_name=None, resume=False) -> str:
+        """Create a state directory each time a new State is created.
+
+        An existing directory is only reused when resume is True.
+        """
         if dir_name is None:
             if not os.path.isdir("states"):
                 os.mkdir("states")
@@ -193,6 +479,8 @@ class State(object):
                     ):
                 os.mkdir(os.path.join(dir_name, "states"))
             dir_name = os.path.join(dir_name, "states", f"{name}_{kT}")
+        if resume and os.path.isdir(dir_name):
+            return os.path.abspath(dir_name)
         try:
             assert not os.path.isdir(dir_name)
             os.mkdir(dir_name)
@@ -200,3 +488,72 @@ class State(object):
             print(f"{dir_name} already exists")
             raise
         return os.path.abspath(dir_name)
+
+
+@lru_cache(maxsize=None)
+def _histogram_action_class() -> type:
+    """The hoomd action class used to fill histograms during a simulation.
+
+    It is defined on first use, so hoomd is only imported once a
+    query simulation is run.
+    """
+    import hoomd
+
+    class _HistogramAction(hoomd.custom.Action):
+        """Adds the current simulation state to structural histograms."""
+
+        def __init__(self, histograms: dict):
+            super(_HistogramAction, self).__init__()
+            self.histograms = histograms
+            self.topology = None
+
+        def act(self, timestep):
+            snapshot = self._state.get_snapshot()
+            if snapshot.communicator.rank == 0:
+                if self.topology is None:
+                    self.topology = Topology(snapshot)
+                for histogram in self.histograms.values():
+                    histogram.add_frame(snapshot, topology=self.topology)
+
+    return _HistogramAction
+
+
+def _snapshot_to_frame(snapshot: hoomd.Snapshot) -> gsd.hoomd.Frame:
+    """Copy a hoomd Snapshot into a gsd.hoomd.Frame held in memory."""
+    import gsd.hoomd
+
+    frame = gsd.hoomd.Frame()
+    frame.configuration.step = snapshot.configuration.step
+    frame.configuration.dimensions = snapshot.configuration.dimensions
+    frame.configuration.box = np.array(snapshot.configuration.box)
+    frame.particles.N = snapshot.particles.N
+    frame.particles.types = list(snapshot.particles.types)
+    for attr in [
+            "typeid",
+            "position",
+            "image",
+            "velocity",
+            "mass",
+            "charge",
+            "diameter",
+            "body",
+            "moment_inertia",
+            "orientation",
+            "angmom"
+    ]:
+        setattr(
+                frame.particles,
+                attr,
+                np.array(getattr(snapshot.particles, attr))
+        )
+    for group in ["bonds", "angles", "dihedrals", "impropers", "pairs"]:
+        snap_group = getattr(snapshot, group)
+        frame_group = getattr(frame, group)
+        frame_group.N = snap_group.N
+        frame_group.types = list(snap_group.types)
+        frame_group.typeid = np.array(snap_group.typeid)
+        frame_group.group = np.array(snap_group.group)
+    frame.constraints.N = snapshot.constraints.N
+    frame.constraints.value = np.array(snapshot.constraints.value)
+    frame.constraints.group = np.array(snapshot.constraints.group)
+    return frame
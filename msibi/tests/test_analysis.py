@@ -0,0 +1,308 @@
+import gsd.hoomd
+import numpy as np
+import pytest
+
+from msibi.analysis import (
+    AngleHistogram,
+    BondHistogram,
+    DihedralHistogram,
+    PairHistogram,
+    RDFEngine,
+    Topology,
+    block_error,
+    boltzmann_weights,
+    bond_lengths,
+    compute_distributions,
+    effective_sample_size,
+    read_frames,
+    minimum_image,
+    molecule_ids,
+)
+
+from .base_test import BaseTest
+
+
+class TestAnalysis(BaseTest):
+    @pytest.fixture
+    def frames(self, traj_file_path):
+        with gsd.hoomd.open(traj_file_path, "r") as traj:
+            return [traj[i] for i in range(-5, 0)]
+
+    def test_minimum_image(self):
+        box = np.array([2.0, 2.0, 2.0, 0, 0, 0])
+        vectors = np.array([[1.5, 0, 0], [-1.2, 0.5, 0]])
+        wrapped = minimum_image(vectors, box)
+        assert np.allclose(wrapped, [[-0.5, 0, 0], [0.8, 0.5, 0]])
+
+    def test_minimum_image_stacked_boxes(self):
+        boxes = np.array([[2.0, 2.0, 2.0, 0, 0, 0], [4.0, 4.0, 4.0, 0, 0, 0]])
+        vectors = np.array([[[1.5, 0, 0]], [[1.5, 0, 0]]])
+        wrapped = minimum_image(vectors, boxes)
+        assert np.allclose(wrapped[0], [[-0.5, 0, 0]])
+        assert np.allclose(wrapped[1], [[1.5, 0, 0]])
+
+    def test_molecule_ids(self):
+        bonds = np.array([[0, 1], [1, 2], [4, 3]])
+        ids = molecule_ids(6, bonds)
+        assert np.array_equal(ids, [0, 0, 0, 3, 3, 5])
+
+    def test_bond_histogram(self, frames):
+        hist = BondHistogram(
+            type1="B", type2="A", x_min=0.0, x_max=3.0, bins=61
+        )
+        for frame in frames:
+            hist.add_frame(frame)
+        dist = hist.distribution()
+        assert hist.n_frames == 5
+        assert dist.shape == (61, 2)
+        assert np.isclose(np.sum(dist[:, 1]), 1.0)
+        frame = frames[-1]
+        group = frame.bonds.group
+        lengths = bond_lengths(
+            frame.particles.position[group[:, 0]],
+            frame.particles.position[group[:, 1]],
+            frame.configuration.box
+        )
+        assert np.all(lengths < frame.configuration.box[0] / 2)
+
+    def test_angle_histogram(self, frames):
+        hist = AngleHistogram(
+            type1="A", type2="B", type3="A", x_min=0, x_max=np.pi, bins=61
+        )
+        hist.add_frame(frames[-1])
+        assert hist.counts.sum() > 0
+        assert np.all(hist.distribution()[:, 0] < np.pi)
+
+    def test_dihedral_histogram(self, frames):
+        hist = DihedralHistogram(
+            type1="A",
+            type2="B",
+            type3="A",
+            type4="B",
+            x_min=-np.pi,
+            x_max=np.pi,
+            bins=61
+        )
+        hist.add_frame(frames[-1])
+        assert hist.counts.sum() == frames[-1].dihedrals.N
+
+    def test_pair_histogram(self, frames):
+        hist = PairHistogram(
+            type1="A",
+            type2="B",
+            x_min=0.1,
+            x_max=3.0,
+            bins=101,
+            exclude_bonded=True
+        )
+        for frame in frames:
+            hist.add_frame(frame)
+        dist = hist.distribution()
+        assert dist.shape == (101, 2)
+        assert 0 < hist.normalization < 1
+        assert np.all(dist[:, 1] >= 0)
+
+    def test_missing_type(self, frames):
+        hist = BondHistogram(
+            type1="A", type2="C", x_min=0.0, x_max=3.0, bins=61
+        )
+        with pytest.raises(ValueError):
+            hist.add_frame(frames[-1])
+
+    def test_compute_distributions(self, traj_file_path, frames):
+        histograms = {
+            "bond": BondHistogram("A", "B", x_min=0, x_max=3.0, bins=61),
+            "angle": AngleHistogram(
+                "A", "B", "A", x_min=0, x_max=np.pi, bins=61
+            ),
+        }
+        dists = compute_distributions(
+            traj_file_path, histograms=histograms, start=-5
+        )
+        assert histograms["bond"].n_frames == 5
+        assert histograms["angle"].n_frames == 5
+        single = BondHistogram("A", "B", x_min=0, x_max=3.0, bins=61)
+        for frame in frames:
+            single.add_frame(frame)
+        assert np.allclose(dists["bond"], single.distribution())
+
+    def test_topology(self, frames):
+        topology = Topology(frames[-1])
+        assert topology.N == frames[-1].particles.N
+        assert len(topology.group("bonds", ("A", "B"))) == frames[-1].bonds.N
+        assert np.array_equal(
+            topology.group("bonds", ("B", "A")),
+            topology.group("bonds", ("A", "B"))
+        )
+        assert len(np.unique(topology.molecules)) < topology.N
+        with pytest.raises(ValueError):
+            topology.group("angles", ("A", "A", "A"))
+
+    def test_excluded_pairs(self, frames):
+        topology = Topology(frames[-1])
+        bonds = np.sort(frames[-1].bonds.group, axis=1)
+        keys = topology.excluded_pairs(["bond"])
+        assert np.array_equal(
+            keys, np.unique(bonds[:, 0] * topology.N + bonds[:, 1])
+        )
+        assert len(topology.excluded_pairs(["bond", "angle"])) >= len(keys)
+        assert len(topology.excluded_pairs([])) == 0
+        with pytest.raises(ValueError):
+            topology.excluded_pairs(["body"])
+
+    def test_pair_energy_counts(self, traj_file_path):
+        all_pairs = PairHistogram("A", "B", x_min=0.1, x_max=3.0, bins=31)
+        all_pairs.record_frames()
+        excluded = PairHistogram(
+            "A", "B", x_min=0.1, x_max=3.0, bins=31, exclude_bonded=True
+        )
+        excluded.record_frames(energy_exclusions=[])
+        bonded = PairHistogram(
+            "A", "B", x_min=0.1, x_max=3.0, bins=31, exclude_bonded=True
+        )
+        bonded.record_frames(energy_exclusions=["bond"])
+        compute_distributions(
+            traj_file_path,
+            histograms={"all": all_pairs, "none": excluded, "bond": bonded},
+            start=-5
+        )
+        delta = np.linspace(0, 1, 31)
+        # Pairs in the same molecule are left out of the RDF, but still
+        # feel the pair potential unless the neighbor list excludes them.
+        assert np.allclose(
+            excluded.energy_change(delta), all_pairs.energy_change(delta)
+        )
+        assert not np.allclose(
+            excluded.energy_change(delta),
+            excluded.frame_counts() @ delta
+        )
+        assert np.all(
+            bonded.energy_change(delta) < all_pairs.energy_change(delta)
+        )
+        assert np.all(
+            bonded.energy_change(delta) > excluded.frame_counts() @ delta
+        )
+
+    def test_batched_matches_single_frames(self, traj_file_path, frames):
+        positions, boxes = read_frames(traj_file_path, start=-5)
+        assert positions.shape == (5, frames[0].particles.N, 3)
+        assert boxes.shape == (5, 6)
+        topology = Topology.from_gsd(traj_file_path)
+        batched = AngleHistogram("B", "A", "B", x_min=0, x_max=np.pi, bins=61)
+        batched.add_frames(positions, boxes, topology)
+        single = AngleHistogram("B", "A", "B", x_min=0, x_max=np.pi, bins=61)
+        for frame in frames:
+            single.add_frame(frame)
+        assert batched.n_frames == single.n_frames == 5
+        assert np.array_equal(batched.counts, single.counts)
+
+    def test_rdf_engine(self, traj_file_path, frames):
+        pairs = [("A", "A"), ("A", "B"), ("B", "B")]
+        histograms = {
+            pair: PairHistogram(*pair, x_min=0.1, x_max=3.0, bins=61)
+            for pair in pairs
+        }
+        engine = RDFEngine(n_threads=2)
+        dists = compute_distributions(
+            traj_file_path, histograms=histograms, start=-5, rdf_engine=engine
+        )
+        engine.close()
+        topology = Topology(frames[0])
+        for pair in pairs:
+            single = PairHistogram(*pair, x_min=0.1, x_max=3.0, bins=61)
+            for frame in frames:
+                single.add_frame(frame, topology=topology)
+            assert histograms[pair].n_frames == 5
+            assert np.allclose(dists[pair], single.distribution())
+
+    def test_compute_distributions_stride(self, traj_file_path, frames):
+        hist = PairHistogram("A", "B", x_min=0.1, x_max=3.0, bins=61)
+        compute_distributions(
+            traj_file_path, histograms={"pair": hist}, start=-5, stride=2
+        )
+        assert hist.n_frames == 3
+        single = PairHistogram("A", "B", x_min=0.1, x_max=3.0, bins=61)
+        for frame in frames[::2]:
+            single.add_frame(frame)
+        assert np.array_equal(hist.counts, single.counts)
+
+    def test_response(self, traj_file_path):
+        kT = 2.0
+        pair = PairHistogram("A", "B", x_min=0.1, x_max=3.0, bins=31)
+        bond = BondHistogram("A", "B", x_min=0.0, x_max=3.0, bins=31)
+        for histogram in (pair, bond):
+            histogram.record_fluctuations()
+        dists = compute_distributions(
+            traj_file_path, histograms={"pair": pair, "bond": bond}, start=-5
+        )
+        plain = PairHistogram("A", "B", x_min=0.1, x_max=3.0, bins=31)
+        compute_distributions(traj_file_path, {"pair": plain}, start=-5)
+        assert np.allclose(dists["pair"], plain.distribution())
+        for histogram in (pair, bond):
+            response = histogram.response(kT=kT)
+            assert response.shape == (31, 31)
+            # The count covariance is positive semi-definite.
+            assert np.all(np.diag(response) <= 1e-12)
+        covariance = bond.count_covariance()
+        assert np.allclose(covariance, covariance.T)
+        with pytest.raises(RuntimeError):
+            bond.record_fluctuations()
+        with pytest.raises(RuntimeError):
+            plain.count_covariance()
+
+    def test_reweighting(self, traj_file_path):
+        pair = PairHistogram("A", "B", x_min=0.1, x_max=3.0, bins=31)
+        bond = BondHistogram("A", "B", x_min=0.0, x_max=3.0, bins=31)
+        for histogram in (pair, bond):
+            histogram.record_frames()
+            histogram.record_fluctuations()
+        dists = compute_distributions(
+            traj_file_path, histograms={"pair": pair, "bond": bond}, start=-5
+        )
+        for key, histogram in [("pair", pair), ("bond", bond)]:
+            frame_counts = histogram.frame_counts()
+            assert frame_counts.shape == (5, 31)
+            assert np.allclose(frame_counts.sum(axis=0), histogram.counts)
+            uniform = np.ones(5)
+            assert np.allclose(histogram.distribution(uniform), dists[key])
+            assert np.allclose(
+                histogram.response(kT=1.0, weights=uniform),
+                histogram.response(kT=1.0)
+            )
+            delta = np.zeros(31)
+            delta[10] = 1.0
+            assert np.allclose(
+                histogram.energy_change(delta), frame_counts[:, 10]
+            )
+        single = np.array([0, 0, 1.0, 0, 0])
+        frame = bond.frame_counts()[2]
+        assert np.allclose(
+            bond.distribution(single)[:, 1], frame / frame.sum()
+        )
+        with pytest.raises(RuntimeError):
+            bond.record_frames()
+        with pytest.raises(RuntimeError):
+            BondHistogram("A", "B", 0.0, 3.0, 31).frame_counts()
+
+    def test_block_error(self, traj_file_path):
+        bond = BondHistogram("A", "B", x_min=0.0, x_max=3.0, bins=31)
+        bond.record_frames()
+        compute_distributions(
+            traj_file_path, histograms={"bond": bond}, start=-10
+        )
+        error = block_error(bond, n_blocks=5)
+        assert 0 < error < 1
+        assert block_error(bond, n_blocks=2) >= 0
+        assert block_error(bond, n_blocks=20) == np.inf
+        with pytest.raises(ValueError):
+            block_error(bond, n_blocks=1)
+
+    def test_boltzmann_weights(self):
+        weights = boltzmann_weights(np.zeros(4), kT=1.0)
+        assert np.allclose(weights, 0.25)
+        assert effective_sample_size(weights) == pytest.approx(1.0)
+        weights = boltzmann_weights([0.0, 1000.0, 1000.0], kT=1.0)
+        assert np.allclose(weights, [1, 0, 0])
+        assert effective_sample_size(weights) == pytest.approx(1 / 3)
+        weights = boltzmann_weights([0.0, np.log(2)], kT=1.0)
+        assert np.allclose(weights, [2 / 3, 1 / 3])
@@ -1,9 +1,13 @@
 import os
+import shutil
 
 import numpy as np
 import pytest
 
-from msibi import Bond, Angle, Dihedral, Pair
+from msibi import Bond, Angle, Dihedral, Pair, State
+from msibi.analysis import compute_distributions
+from msibi.schemes import AndersonAcceleration
+from msibi.utils.cache import DistributionCache
 
 from .base_test import BaseTest
 
@@ -105,6 +109,155 @@ class TestForce(BaseTest):
         angle._add_state(stateX)
         angle.plot_target_distribution(state=stateX)
 
+    def test_target_cache(self, traj_file_path, tmp_path):
+        cache = DistributionCache(cache_dir=os.path.join(tmp_path, "cache"))
+        state = State(
+                name="C",
+                kT=1.0,
+                traj_file=traj_file_path,
+                n_frames=10,
+                target_cache=cache,
+                _dir=tmp_path
+        )
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x0=2, k4=0, k3=0, k2=100, x_min=0, x_max=3)
+        bond._add_state(state)
+        assert cache.misses == 1
+        target = np.copy(bond.target_distribution(state))
+        bond.smoothing_window = 5
+        assert cache.hits == 1
+        bond.smoothing_window = 3
+        assert np.allclose(bond.target_distribution(state), target)
+        bond.nbins = 30
+        assert cache.misses == 2
+        state.include_final_frame = True
+        bond._get_state_distribution(state, query=False)
+        assert cache.misses == 3
+        state.frame_stride = 2
+        bond._get_state_distribution(state, query=False)
+        assert cache.misses == 4
+
+    def test_target_frames(self, stateX):
+        # The final frame is left out, as the cmeutils functions did.
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x0=2, k4=0, k3=0, k2=100, x_min=0, x_max=3)
+        bond._add_state(stateX)
+        histogram = bond._histogram(stateX)
+        expected = compute_distributions(
+                stateX.traj_file,
+                histograms={"bond": histogram},
+                start=-stateX.n_frames,
+                stop=-1
+        )["bond"]
+        assert histogram.n_frames == stateX.n_frames - 1
+        assert np.allclose(
+                bond._get_distribution(stateX, stateX.traj_file), expected
+        )
+
+    def test_target_frame_selection(self, stateX):
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x0=2, k4=0, k3=0, k2=100, x_min=0, x_max=3)
+        bond._add_state(stateX)
+        stateX.include_final_frame = True
+        stateX.frame_stride = 3
+        assert stateX.frame_slice == dict(
+                start=-stateX.n_frames, stop=None, stride=3
+        )
+        histogram = bond._histogram(stateX)
+        expected = compute_distributions(
+                stateX.traj_file,
+                histograms={"bond": histogram},
+                start=-stateX.n_frames,
+                stride=3
+        )["bond"]
+        assert histogram.n_frames == 4
+        assert np.allclose(
+                bond._get_distribution(stateX, stateX.traj_file), expected
+        )
+
+    def test_alpha_arrays(self, stateX_linear_alpha):
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x0=2, k4=0, k3=0, k2=100, x_min=0, x_max=3)
+        bond._add_state(stateX_linear_alpha)
+        alpha = bond._alpha(stateX_linear_alpha)
+        assert alpha.shape == bond.x_range.shape
+        assert bond._alpha(stateX_linear_alpha) is alpha
+        stateX_linear_alpha.alpha0 = 0.5
+        assert np.allclose(bond._alpha(stateX_linear_alpha), alpha * 0.5)
+
+    def test_shared_smoother(self):
+        bond1 = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond2 = Bond(type1="A", type2="A", optimize=True, nbins=60)
+        assert bond1.smoother is bond2.smoother
+        bond2.smoothing_window = 5
+        assert bond2.smoother.window_size == 5
+        assert bond1.smoother is not bond2.smoother
+
+    def test_cached_table_entry(self):
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x0=2, k4=0, k3=0, k2=100, x_min=0, x_max=3)
+        force = bond.force
+        assert bond.force is force
+        assert not force.flags.writeable
+        entry = bond._table_entry()
+        assert entry["F"] is force
+        assert entry["U"].flags.c_contiguous
+        assert not entry["U"].flags.writeable
+        assert np.allclose(force, -np.gradient(bond.potential, bond.dx))
+        bond.potential = bond.potential * 2
+        assert bond.force is not force
+        assert np.allclose(bond.force, force * 2)
+        smoothed = bond.force
+        bond.smooth_potential()
+        assert bond.force is not smoothed
+
+    def test_rejected_acceleration(self, stateX):
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x0=2, k4=0, k3=0, k2=100, x_min=0, x_max=3)
+        bond.accelerator = AndersonAcceleration(history_size=3)
+        bond._add_state(stateX)
+        shutil.copy(stateX.traj_file, stateX.query_traj)
+        bond._compute_current_distribution(stateX)
+        f_fit = bond._states[stateX]["f_fit"]
+        steps = [0.2 * np.sin(bond.x_range * i) for i in range(1, 4)]
+        f_fit[-1] = 0.5
+        bond._update_potential(delta=steps[0])
+        before = np.copy(bond.potential)
+        f_fit.append(0.6)
+        bond._update_potential(delta=steps[1])
+        assert bond.accelerator.n_accelerated == 1
+        f_fit.append(0.4)
+        bond._update_potential(delta=steps[2])
+        assert bond.accelerator.n_rejected == 1
+        expected = bond._correction_function(
+            bond.x_range, before + steps[1], bond.correction_form
+        )[0]
+        assert np.allclose(bond.potential, expected)
+
+    def test_history_policy(self, stateX, tmp_path):
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x0=2, k4=0, k3=0, k2=100, x_min=0, x_max=3)
+        bond.set_history_policy(retention=2, spill_dir=tmp_path)
+        bond._add_state(stateX)
+        shutil.copy(stateX.traj_file, stateX.query_traj)
+        for i in range(3):
+            bond._compute_current_distribution(stateX)
+            bond._update_potential()
+        assert bond.potential_history.n_appended == 4
+        assert len(bond.potential_history) == 2
+        assert len(bond._learned_potential_history) == 2
+        assert len(bond.distribution_history(stateX)) == 2
+        assert os.path.exists(
+            os.path.join(tmp_path, "Bond_A-B_optimized_potential_history.npy")
+        )
+        with pytest.raises(RuntimeError):
+            bond.set_history_policy(retention=5)
+        pair = Pair(type1="A", type2="B", optimize=False, r_cut=3.0)
+        pair.set_history_policy(spill_dir=tmp_path)
+        assert pair.potential_history.spill_path == os.path.join(
+            tmp_path, "Pair_A-B_static_potential_history.npy"
+        )
+
     def test_static_warnings(self):
         bond = Bond(type1="A", type2="B", optimize=False)
         bond.set_harmonic(k=500, r0=2)
@@ -0,0 +1,41 @@
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ["hoomd", "gsd", "freud", "matplotlib", "pandas", "scipy"]
+
+IMPORT_SCRIPT = f"""
+import json
+import sys
+import time
+
+import numpy
+
+start = time.perf_counter()
+import msibi
+duration = time.perf_counter() - start
+print(json.dumps({{
+    "duration": duration,
+    "modules": [m for m in {HEAVY_MODULES} if m in sys.modules]
+}}))
+"""
+
+
+def _import_msibi():
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_import_skips_heavy_modules():
+    assert _import_msibi()["modules"] == []
+
+
+def test_import_time():
+    # The best of a few runs, so a busy machine does not fail the test.
+    duration = min(_import_msibi()["duration"] for i in range(3))
+    assert duration < 0.5
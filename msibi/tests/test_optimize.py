@@ -1,9 +1,17 @@
+import asyncio
+import os
+import shutil
+
 import numpy as np
 import pytest
 import hoomd
-from msibi import MSIBI, Bond, Angle, Dihedral, Pair
+from msibi import MSIBI, Bond, Angle, Dihedral, Pair, State
+from msibi.optimize import _Speculation
+from msibi.schedules import AdaptiveSchedule, GeometricSchedule
+from msibi.schemes import IBI, IMC
+from msibi.utils.store import IterationStore
 
-from .base_test import BaseTest
+from .base_test import BaseTest, test_assets
 
 
 
@@ -55,6 +63,632 @@ class TestMSIBI(BaseTest):
         assert len(bond._tail_correction_history) == 1
         assert len(bond._learned_potential_history) == 1
 
+    def test_run_parallel_states(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        init_bond_pot = np.copy(bond.potential)
+        msibi.run_optimization(
+                n_steps=500, n_iterations=2, parallel_states=2
+        )
+        assert not np.array_equal(bond.potential, init_bond_pot)
+        assert msibi.n_iterations == 2
+        assert len(bond._states[stateX]["f_fit"]) == 2
+        assert len(bond._states[stateY]["f_fit"]) == 2
+
+    def test_run_parallel_states_failure(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=False)
+        bond.set_harmonic(r0=1.1, k=100)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        stateY.traj_file = "missing.gsd"
+        with pytest.raises(RuntimeError, match="Y"):
+            msibi.run_optimization(
+                    n_steps=100, n_iterations=1, parallel_states=2
+            )
+        with pytest.raises(ValueError):
+            msibi.run_optimization(
+                    n_steps=100, n_iterations=1, parallel_states=0
+            )
+
+    def test_run_persistent_simulations(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        msibi.run_optimization(
+                n_steps=500, n_iterations=1, persistent_simulations=True
+        )
+        sim = stateX._sim
+        hoomd_bond = stateX._forces[0]
+        assert sim is not None
+        msibi.run_optimization(
+                n_steps=500, n_iterations=1, persistent_simulations=True
+        )
+        assert stateX._sim is sim
+        assert stateX._forces[0] is hoomd_bond
+        assert np.allclose(hoomd_bond.params["A-B"]["U"], bond.potential)
+        assert msibi.n_iterations == 2
+        with pytest.raises(ValueError):
+            msibi.run_optimization(
+                    n_steps=500,
+                    n_iterations=1,
+                    parallel_states=2,
+                    persistent_simulations=True
+            )
+
+    def test_run_warm_start(self, msibi, tmp_path):
+        msibi.gsd_period = 10
+        state = State(
+                name="W",
+                kT=1.0,
+                traj_file=os.path.join(test_assets, "AB-1.0kT.gsd"),
+                n_frames=10,
+                warm_start=True,
+                equilibration_steps=100,
+                _dir=tmp_path
+        )
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(state)
+        msibi.add_force(bond)
+        msibi.run_optimization(n_steps=500, n_iterations=1)
+        first_frame = state._last_frame
+        assert first_frame is not None
+        assert state._initial_frame is first_frame
+        assert not np.array_equal(
+                first_frame.particles.position,
+                state._target_frame.particles.position
+        )
+        msibi.run_optimization(n_steps=500, n_iterations=1)
+        assert state._last_frame is not first_frame
+
+    def test_run_in_situ_analysis(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        init_bond_pot = np.copy(bond.potential)
+        msibi.run_optimization(
+                n_steps=500, n_iterations=1, in_situ_analysis=True
+        )
+        assert not os.path.exists(stateX.query_traj)
+        assert not np.array_equal(bond.potential, init_bond_pot)
+        assert bond._key in stateX._query_distributions
+        assert len(bond._states[stateX]["f_fit"]) == 1
+
+    def test_converged(self, msibi, stateX, stateY):
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        assert not msibi._converged(stateX, fit_threshold=0.5)
+        bond._states[stateX]["f_fit"] = [0.2, 0.8, 0.9]
+        bond._states[stateY]["f_fit"] = [0.2, 0.4, 0.4]
+        assert msibi._converged(stateX, fit_threshold=0.85)
+        assert not msibi._converged(stateY, fit_threshold=0.85)
+        assert msibi._converged(stateY, plateau_window=1)
+        assert not msibi._converged(stateY, plateau_window=2)
+        assert not msibi._converged(stateX, plateau_window=1)
+        assert msibi._converged(
+                stateX, plateau_window=1, plateau_tolerance=0.2
+        )
+
+    def test_run_early_stopping(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        msibi.run_optimization(n_steps=500, n_iterations=3, fit_threshold=0.0)
+        assert msibi.n_iterations == 1
+        assert msibi.stop_reason == "converged"
+        msibi.run_optimization(n_steps=500, n_iterations=3, time_budget=0)
+        assert msibi.n_iterations == 2
+        assert msibi.stop_reason == "time_budget"
+
+    def test_run_freeze_converged(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        msibi._converged = lambda state, **kwargs: state is stateX
+        msibi.run_optimization(
+                n_steps=500,
+                n_iterations=2,
+                fit_threshold=1.0,
+                freeze_converged=True
+        )
+        assert msibi.frozen_states == [stateX]
+        assert msibi.stop_reason is None
+        assert len(bond._states[stateX]["f_fit"]) == 2
+        f_fit = bond._states[stateX]["f_fit"]
+        assert f_fit[0] == f_fit[1]
+        with pytest.raises(ValueError):
+            msibi.run_optimization(
+                    n_steps=500, n_iterations=1, freeze_converged=True
+            )
+
+    def test_run_freeze_converged_resimulates(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        checked = []
+
+        def converged(state, **kwargs):
+            checked.append((msibi.n_iterations, state.name))
+            return state is stateX or msibi.n_iterations > 1
+
+        msibi._converged = converged
+        msibi.run_optimization(
+                n_steps=500,
+                n_iterations=5,
+                fit_threshold=1.0,
+                freeze_converged=True
+        )
+        # X is frozen after the first iteration. Once Y converges, X is
+        # simulated again before the optimization stops.
+        assert checked == [
+            (1, "X"), (1, "Y"), (2, "Y"), (3, "X"), (3, "Y")
+        ]
+        assert msibi.stop_reason == "converged"
+        assert msibi.n_iterations == 3
+        assert msibi.frozen_states == []
+
+    def test_checkpoint(self, msibi, stateX, stateY, tmp_path):
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        bond._states[stateX]["f_fit"] = [0.2, 0.8]
+        stateX._query_distributions[bond._key] = np.ones(61)
+        msibi.n_iterations = 2
+        file_path = os.path.join(tmp_path, "checkpoint.pkl")
+        msibi.save_checkpoint(file_path)
+        opt = MSIBI.load_checkpoint(file_path)
+        assert opt.n_iterations == 2
+        assert opt.seed == msibi.seed
+        state = opt.states[0]
+        assert state._opt is opt
+        assert state.dir == stateX.dir
+        force = opt.forces[0]
+        assert force in opt._optimize_forces
+        assert force._states[state]["f_fit"] == [0.2, 0.8]
+        assert np.array_equal(force.potential, bond.potential)
+        assert np.array_equal(
+                state._query_distributions[bond._key], np.ones(61)
+        )
+
+    def test_run_checkpoint(self, msibi, stateX, stateY, tmp_path):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        file_path = os.path.join(tmp_path, "checkpoint.pkl")
+        msibi.run_optimization(
+                n_steps=500,
+                n_iterations=2,
+                checkpoint_every=1,
+                checkpoint_file=file_path
+        )
+        opt = MSIBI.load_checkpoint(file_path)
+        assert opt.n_iterations == 2
+        opt.run_optimization(n_steps=500, n_iterations=1)
+        assert opt.n_iterations == 3
+        assert len(opt.forces[0]._states[opt.states[0]]["f_fit"]) == 3
+
+    def test_run_checkpoint_with_callback(
+            self, msibi, stateX, stateY, tmp_path
+    ):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        iterations = []
+        msibi.add_callback(
+                on_iteration_end=lambda opt, iteration: iterations.append(
+                    iteration
+                )
+        )
+        file_path = os.path.join(tmp_path, "checkpoint.pkl")
+        msibi.run_optimization(
+                n_steps=500,
+                n_iterations=2,
+                checkpoint_every=1,
+                checkpoint_file=file_path
+        )
+        assert iterations == [0, 1]
+        opt = MSIBI.load_checkpoint(file_path)
+        assert opt._callbacks == {
+            "on_iteration_end": [], "on_state_simulated": []
+        }
+        opt.run_optimization(n_steps=500, n_iterations=1)
+        assert iterations == [0, 1]
+        assert opt.n_iterations == 3
+
+    def test_run_store(self, msibi, stateX, stateY, tmp_path):
+        msibi.gsd_period = 10
+        msibi.store = IterationStore(os.path.join(tmp_path, "store"))
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        msibi.run_optimization(n_steps=500, n_iterations=2)
+        assert not any(f.endswith(".txt") for f in os.listdir(stateX.dir))
+        store = IterationStore(os.path.join(tmp_path, "store"))
+        distributions = store.read("distribution", force="A-B", state="X")
+        assert distributions.shape == (2, 61, 2)
+        assert np.allclose(
+                store.read("f_fit", force="A-B", state="X"),
+                bond._states[stateX]["f_fit"]
+        )
+        assert np.allclose(
+                store.read("potential", force="A-B", iterations=1),
+                bond.potential
+        )
+        assert len(store.read("iteration_time")) == 2
+        simulations = store.read_timings("simulation", state="X")
+        assert np.array_equal(simulations["iteration"], [0, 1])
+        assert np.all(simulations["tps"] > 0)
+        assert len(store.read_timings("update", force="A-B")["wall_time"]) == 2
+
+    def test_run_timings(self, msibi, stateX, stateY, tmp_path):
+        msibi.gsd_period = 10
+        msibi.timer.jsonl_file = os.path.join(tmp_path, "timings.jsonl")
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        profile_file = os.path.join(tmp_path, "profile.prof")
+        msibi.run_optimization(
+                n_steps=500,
+                n_iterations=2,
+                profile_iteration=1,
+                profile_file=profile_file
+        )
+        assert os.path.isfile(profile_file)
+        timings = msibi.timings
+        simulations = timings[timings["phase"] == "simulation"]
+        assert len(simulations) == 4
+        assert set(simulations["state"]) == {"X", "Y"}
+        assert np.all(simulations["tps"] > 0)
+        for phase in ["iteration", "analysis", "distribution", "update"]:
+            assert phase in set(timings["phase"])
+        with open(msibi.timer.jsonl_file) as f:
+            assert len(f.readlines()) == len(timings)
+
+    def test_reweight(self, msibi, stateX):
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_force(bond)
+        assert not msibi._reweight(stateX, threshold=0.5)
+        msibi._record_frames = True
+        shutil.copy(stateX.traj_file, stateX.query_traj)
+        stateX._reference_potentials = {bond._key: np.copy(bond.potential)}
+        msibi._compute_query_distributions(stateX)
+        distribution = stateX._query_distributions[bond._key]
+        assert msibi._reweight(stateX, threshold=0.5)
+        assert np.allclose(
+                stateX._query_distributions[bond._key], distribution
+        )
+        bond.potential = bond.potential + 0.1 * np.sin(bond.x_range * 5)
+        assert msibi._reweight(stateX, threshold=0.01)
+        assert not np.allclose(
+                stateX._query_distributions[bond._key], distribution
+        )
+        bond.potential = bond.potential + 100 * np.sin(bond.x_range * 5)
+        assert not msibi._reweight(stateX, threshold=0.5)
+        reweights = msibi.timings[msibi.timings["phase"] == "reweight"]
+        assert list(reweights["reweighted"]) == [True, True, False]
+
+    def test_reweight_pairs(self, msibi, stateX):
+        pair = Pair(type1="A", type2="B", r_cut=3.0, nbins=50, optimize=True)
+        pair.set_lj(sigma=1.5, epsilon=1, r_cut=3.0, r_min=0.1)
+        msibi.add_state(stateX)
+        msibi.add_force(pair)
+        msibi._record_frames = True
+        shutil.copy(stateX.traj_file, stateX.query_traj)
+        stateX._reference_potentials = {pair._key: np.copy(pair.potential)}
+        msibi._compute_query_distributions(stateX)
+        histogram = stateX._query_histograms[pair._key]
+        assert stateX.exclude_bonded
+        assert histogram._energy_exclusions == ("bond", "angle")
+        assert msibi._reweight(stateX, threshold=0.01)
+        # Histograms without counts of the neighbor list pairs are not
+        # reweighted.
+        histogram._energy_exclusions = None
+        with pytest.warns(UserWarning):
+            assert not msibi._reweight(stateX, threshold=0.01)
+        msibi.nlist_exclusions = ["bond", "body"]
+        with pytest.raises(ValueError):
+            msibi.run_optimization(
+                    n_steps=500, n_iterations=1, reweight_threshold=0.5
+            )
+
+    def test_recompute_distribution_after_resume(self, msibi, stateX):
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_force(bond)
+        shutil.copy(stateX.traj_file, stateX.query_traj)
+        # f_fit has fewer entries than iterations, e.g. after a restored
+        # checkpoint or while the state was frozen.
+        msibi.n_iterations = 5
+        msibi._recompute_distribution(bond)
+        assert len(bond._states[stateX]["f_fit"]) == 1
+
+    def test_run_reweighting(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        msibi.run_optimization(
+                n_steps=500, n_iterations=3, reweight_threshold=0.01
+        )
+        assert msibi.n_iterations == 3
+        assert len(bond._states[stateX]["f_fit"]) == 3
+        assert "reweight" in set(msibi.timings["phase"])
+        with pytest.raises(ValueError):
+            msibi.run_optimization(
+                    n_steps=500, n_iterations=1, reweight_threshold=1.5
+            )
+
+    def test_speculation(self, msibi, stateX):
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_force(bond)
+        potential = np.copy(bond.potential)
+        predicted = msibi._predict_potentials()[bond._key]
+        assert np.allclose(predicted, potential)
+        msibi._previous_potentials = {bond._key: potential - 0.1}
+        predicted = msibi._predict_potentials()[bond._key]
+        assert np.allclose(predicted, potential + 0.1)
+        speculation = _Speculation(
+                iteration=1,
+                n_steps=500,
+                potentials={bond._key: predicted},
+                futures=dict(),
+                query_trajs=dict()
+        )
+        bond.potential = potential + 0.05
+        assert msibi._speculation_hit(speculation, tolerance=0.1)
+        bond.potential = potential + 1.0
+        assert not msibi._speculation_hit(speculation, tolerance=0.1)
+        assert msibi.speculation_hit_rate == 0.5
+        speculations = msibi.timings[msibi.timings["phase"] == "speculation"]
+        assert list(speculations["hit"]) == [True, False]
+
+    def test_run_speculate(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        msibi.run_optimization(
+                n_steps=500,
+                n_iterations=3,
+                speculate=True,
+                speculation_tolerance=1e6
+        )
+        assert msibi.n_iterations == 3
+        assert len(bond._states[stateX]["f_fit"]) == 3
+        assert msibi.speculation_hit_rate == 1.0
+        assert os.path.exists(stateX.query_traj)
+        with pytest.raises(ValueError):
+            msibi.run_optimization(
+                    n_steps=500,
+                    n_iterations=1,
+                    speculate=True,
+                    persistent_simulations=True
+            )
+
+    def test_run_speculate_freeze_converged(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        msibi._converged = lambda state, **kwargs: (
+                state is stateX or msibi.n_iterations > 1
+        )
+        msibi.run_optimization(
+                n_steps=500,
+                n_iterations=5,
+                fit_threshold=1.0,
+                freeze_converged=True,
+                speculate=True,
+                speculation_tolerance=1e6
+        )
+        # X is frozen after the first iteration, so the speculation of the
+        # third iteration only holds Y, and X is simulated as usual.
+        assert msibi.stop_reason == "converged"
+        assert msibi.n_iterations == 3
+        assert len(bond._states[stateX]["f_fit"]) == 3
+        assert os.path.exists(stateX.query_traj)
+
+    def test_run_optimization_async(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+
+        async def run():
+            return [
+                result async for result in msibi.run_optimization_async(
+                    n_steps=500, n_iterations=2
+                )
+            ]
+
+        results = asyncio.run(run())
+        assert [result["iteration"] for result in results] == [0, 1]
+        assert results[-1]["fit_scores"]["A-B"]["X"] == (
+                bond._states[stateX]["f_fit"][-1]
+        )
+        assert np.array_equal(results[-1]["potentials"]["A-B"], bond.potential)
+        assert results[-1]["timings"][-1]["phase"] == "iteration"
+        assert msibi.n_iterations == 2
+
+    def test_run_optimization_async_cancel(self, msibi, stateX):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_force(bond)
+
+        async def run():
+            task = asyncio.ensure_future(_consume(
+                msibi.run_optimization_async(n_steps=500, n_iterations=5)
+            ))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        assert msibi.n_iterations == 1
+        assert len(bond._states[stateX]["f_fit"]) == 1
+        assert len(bond.potential_history) == 2
+
+    def test_add_callback(self, msibi, stateX):
+        calls = []
+        msibi.add_callback(
+                on_iteration_end=lambda opt, iteration: calls.append(iteration),
+                on_state_simulated=lambda opt, state, sim: calls.append(state)
+        )
+        msibi.n_iterations = 1
+        msibi._iteration_end()
+        msibi._state_simulated(stateX)
+        assert calls == [0, stateX]
+        assert not msibi._stop_requested
+        msibi.request_stop()
+        assert msibi._stop_requested
+
+    def test_run_callbacks(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        simulations = []
+
+        def on_state_simulated(opt, state, sim):
+            assert sim is not None
+            simulations.append(state.name)
+
+        def on_iteration_end(opt, iteration):
+            assert bond._states[stateX]["f_fit"][-1] is not None
+            opt.n_steps = 1000
+            if iteration == 1:
+                opt.request_stop()
+
+        msibi.add_callback(
+                on_iteration_end=on_iteration_end,
+                on_state_simulated=on_state_simulated
+        )
+        msibi.run_optimization(n_steps=500, n_iterations=5)
+        assert msibi.n_iterations == 2
+        assert msibi.stop_reason == "callback"
+        assert simulations == ["X", "Y", "X", "Y"]
+        timings = msibi.timings
+        timesteps = timings[timings["phase"] == "simulation"]["timesteps"]
+        assert list(timesteps) == [500, 500, 1000, 1000]
+
+    def test_run_step_schedule(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        msibi.run_optimization(
+                n_steps=None,
+                n_iterations=2,
+                step_schedule=GeometricSchedule(start=500, factor=2.0)
+        )
+        timings = msibi.timings
+        timesteps = timings[timings["phase"] == "simulation"]["timesteps"]
+        assert list(timesteps) == [500, 500, 1000, 1000]
+        with pytest.raises(ValueError):
+            msibi.run_optimization(n_steps=None, n_iterations=1)
+
+    def test_run_adaptive_schedule(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        schedule = AdaptiveSchedule(
+                min_steps=500, chunk_steps=100, max_steps=1000, target=1e-6
+        )
+        msibi.run_optimization(
+                n_steps=None,
+                n_iterations=2,
+                in_situ_analysis=True,
+                step_schedule=schedule
+        )
+        assert msibi.n_iterations == 2
+        timings = msibi.timings
+        timesteps = timings[timings["phase"] == "simulation"]["timesteps"]
+        assert list(timesteps) == [1000, 1000, 1000, 1000]
+        with pytest.raises(ValueError):
+            msibi.run_optimization(
+                    n_steps=None, n_iterations=1, step_schedule=schedule
+            )
+
+    def test_run_imc(self, msibi, stateX, stateY):
+        msibi.gsd_period = 10
+        msibi.update_scheme = IMC(max_step=1.0)
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.set_quadratic(x_min=0.0, x_max=3.0, x0=1, k2=200, k3=0, k4=0)
+        msibi.add_state(stateX)
+        msibi.add_state(stateY)
+        msibi.add_force(bond)
+        init_bond_pot = np.copy(bond.potential)
+        msibi.run_optimization(n_steps=500, n_iterations=1)
+        assert bond._key in stateX._query_responses
+        assert stateX._query_responses[bond._key].shape == (61, 61)
+        assert np.all(np.isfinite(bond.potential))
+        assert not np.array_equal(bond.potential, init_bond_pot)
+
+    def test_force_update_scheme(self, msibi, stateX):
+        assert isinstance(msibi.update_scheme, IBI)
+        bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
+        bond.update_scheme = IMC()
+        assert msibi._update_scheme(bond) is bond.update_scheme
+
     def test_run_with_static_force(self, msibi, stateX, stateY):
         msibi.gsd_period = 10
         bond = Bond(type1="A", type2="B", optimize=True, nbins=60)
@@ -161,3 +795,7 @@ class TestMSIBI(BaseTest):
                 dt=0.003,
                 gsd_period=int(1e3),
             )
+
+
+async def _consume(results):
+    return [result async for result in results]
@@ -1,7 +1,17 @@
 import numpy as np
 import pytest
 
-from msibi.potentials import alpha_array, pair_tail_correction, pair_head_correction, mie
+from msibi.potentials import (
+    alpha_array,
+    bond_correction,
+    finite_segment,
+    ibi_update,
+    linear_head_correction_optimized,
+    mie,
+    pair_correction,
+    pair_head_correction,
+    pair_tail_correction,
+)
 
 
 def test_tail_correction():
@@ -38,3 +48,73 @@ def test_head_correction():
     assert not np.isnan(exp_V).any() and not np.isinf(exp_V).any()
     assert all(exp_V[cutoff:] == V[cutoff:])
     assert exp_V[0] > linear_V[0]
+
+
+def test_ibi_update():
+    rng = np.random.default_rng(12)
+    dr = 0.1
+    r = np.arange(dr, 2.5 + dr, dr)
+    current = rng.uniform(0.1, 1.0, size=(3, 2, len(r)))
+    target = rng.uniform(0.1, 1.0, size=(3, 2, len(r)))
+    kT = np.array([[1.0, 2.0]] * 3)
+    alpha = np.stack(
+        [alpha_array(1.0, pot_r=r, dr=dr), np.full(len(r), 0.5)]
+    )
+    alpha = np.broadcast_to(alpha, current.shape)
+    delta = ibi_update(current, target, kT, alpha)
+    assert delta.shape == (3, len(r))
+    for i in range(3):
+        expected = np.zeros(len(r))
+        for j in range(2):
+            expected += alpha[i, j] * (
+                kT[i, j] * np.log(current[i, j] / target[i, j]) / 2
+            )
+        assert np.allclose(delta[i], expected)
+        assert np.allclose(
+            ibi_update(current[i], target[i], kT[i], alpha[i]), expected
+        )
+
+
+def test_finite_segment():
+    V = np.arange(20, dtype=float)
+    V[:3] = np.inf
+    V[7] = np.nan
+    V[12:14] = np.nan
+    V[-2:] = np.nan
+    V, real_idx, head_cutoff, tail_cutoff = finite_segment(V)
+    assert V[7] == 7.0
+    assert np.array_equal(real_idx, np.arange(3, 12))
+    assert head_cutoff == 2
+    assert tail_cutoff == 12
+
+
+def test_linear_fit_correction():
+    r = np.arange(0.1, 2.0, 0.1)
+    V = 3.0 - 2.0 * r
+    V[:4] = np.inf
+    corrected = linear_head_correction_optimized(r, V, cutoff=3)
+    assert np.allclose(corrected, 3.0 - 2.0 * r)
+
+
+def test_batch_corrections():
+    dr = 0.05
+    r = np.arange(dr, 3.0 + dr, dr)
+    V = np.stack([mie(r, eps, 1, m=12, n=6) for eps in (1.0, 2.0, 3.0)])
+    V[0, :3] = np.inf
+    V[1, :5] = np.nan
+    V[2, :2] = np.inf
+    V[2, 20] = np.nan
+    for correction, form in [
+        (pair_correction, "linear"),
+        (pair_correction, "exponential"),
+        (bond_correction, "linear"),
+        (bond_correction, "linear_optimized"),
+    ]:
+        batch = correction(r, np.copy(V), form)
+        assert np.all(np.isfinite(batch[0]))
+        for i in range(len(V)):
+            single = correction(r, np.copy(V[i]), form)
+            assert np.allclose(batch[0][i], single[0])
+            assert np.array_equal(batch[1][i], single[1])
+            assert batch[2][i] == single[2]
+            assert batch[3][i] == single[3]
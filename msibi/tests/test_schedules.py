@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from msibi.analysis import BondHistogram, block_error
+from msibi.schedules import AdaptiveSchedule, GeometricSchedule
+
+
+def _histogram(frame_counts):
+    histogram = BondHistogram("A", "B", x_min=0.0, x_max=3.0, bins=10)
+    histogram.record_frames()
+    histogram._add_frame_counts(frame_counts)
+    histogram.counts = frame_counts.sum(axis=0)
+    histogram.n_frames = len(frame_counts)
+    return histogram
+
+
+def test_geometric_schedule():
+    schedule = GeometricSchedule(start=1000, factor=2.0, max_steps=5000)
+    assert [schedule.n_steps(i) for i in range(5)] == [
+        1000, 2000, 4000, 5000, 5000
+    ]
+    schedule = GeometricSchedule(start=1000, factor=1.5, multiple_of=100)
+    assert [schedule.n_steps(i) for i in range(4)] == [1000, 1500, 2300, 3400]
+    with pytest.raises(ValueError):
+        GeometricSchedule(start=0)
+    with pytest.raises(ValueError):
+        GeometricSchedule(start=1000, multiple_of=0)
+
+
+def test_adaptive_schedule():
+    rng = np.random.default_rng(5)
+    schedule = AdaptiveSchedule(
+        min_steps=1000, chunk_steps=500, max_steps=3000, target=0.5
+    )
+    assert schedule.adaptive
+    assert schedule.n_steps(4) == 1000
+    noisy = _histogram(rng.poisson(2.0, size=(10, 10)).astype(float))
+    precise = _histogram(rng.poisson(2000.0, size=(10, 10)).astype(float))
+    assert block_error(noisy) > block_error(precise)
+    histograms = {"bond": noisy}
+    assert not schedule.extend(histograms, residuals={}, steps_run=1000)
+    assert schedule.extend(histograms, residuals={"bond": 0.1}, steps_run=1000)
+    assert not schedule.extend(
+        histograms, residuals={"bond": 0.1}, steps_run=2600
+    )
+    assert not schedule.extend(
+        {"bond": precise}, residuals={"bond": 0.1}, steps_run=1000
+    )
+    with pytest.raises(ValueError):
+        AdaptiveSchedule(min_steps=1000, chunk_steps=500, max_steps=500)
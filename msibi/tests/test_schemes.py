@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from msibi.potentials import ibi_update
+from msibi.schemes import AndersonAcceleration, IBI, IMC
+
+
+def test_ibi_step():
+    rng = np.random.default_rng(3)
+    current = rng.uniform(0.1, 1.0, size=(2, 20))
+    target = rng.uniform(0.1, 1.0, size=(2, 20))
+    kT = np.array([1.0, 1.5])
+    alpha = np.ones((2, 20))
+    assert np.array_equal(
+        IBI().step(current, target, kT, alpha),
+        ibi_update(current, target, kT, alpha)
+    )
+
+
+def test_imc_step():
+    rng = np.random.default_rng(4)
+    n_bins = 15
+    samples = rng.normal(size=(2, 200, n_bins))
+    responses = -np.stack([np.cov(s.T) for s in samples])
+    current = rng.uniform(0.1, 1.0, size=(2, n_bins))
+    delta = rng.normal(size=n_bins)
+    target = current + responses @ delta
+    alpha = np.full((2, n_bins), 0.5)
+    kT = np.ones(2)
+    step = IMC(regularization=1e-10).step(
+        current, target, kT, alpha, responses
+    )
+    assert np.allclose(step, 0.5 * delta)
+    batch = IMC(regularization=1e-10).step(
+        current[None], target[None], kT[None], alpha[None], responses[None]
+    )
+    assert np.allclose(batch[0], step)
+    limited = IMC(regularization=1e-10, max_step=0.1).step(
+        current, target, kT, alpha, responses
+    )
+    assert np.isclose(np.max(np.abs(limited)), 0.1)
+
+
+def test_imc_needs_responses():
+    with pytest.raises(RuntimeError):
+        IMC().step(np.ones((1, 5)), np.ones((1, 5)), [1.0], np.ones((1, 5)))
+    with pytest.raises(ValueError):
+        IMC(regularization=-1)
+
+
+class _Force(object):
+    _key = ("Pair", "A-A")
+
+
+def test_anderson_acceleration():
+    rng = np.random.default_rng(5)
+    n = 20
+    matrix = np.diag(rng.uniform(0.05, 1.9, n))
+    solution = rng.normal(size=n)
+
+    def iterate(accelerator, n_iterations):
+        potential = np.zeros(n)
+        for i in range(n_iterations):
+            delta = matrix @ (solution - potential)
+            if accelerator is not None:
+                fit = -np.linalg.norm(delta)
+                delta = accelerator.step(_Force(), potential, delta, fit)
+            potential = potential + delta
+        return np.linalg.norm(potential - solution)
+
+    accelerator = AndersonAcceleration(history_size=5)
+    assert iterate(accelerator, 20) < 1e-2 * iterate(None, 20)
+    assert accelerator.n_accelerated > 0
+
+
+def test_anderson_safeguard():
+    accelerator = AndersonAcceleration(history_size=3)
+    force = _Force()
+    potential = np.zeros(5)
+    plain = accelerator.step(force, potential, np.ones(5), fit=0.5)
+    assert np.array_equal(plain, np.ones(5))
+    accelerator.step(force, potential + 1, np.full(5, 0.5), fit=0.6)
+    assert accelerator.n_accelerated == 1
+    step = accelerator.step(force, potential + 2, np.full(5, 0.2), fit=0.4)
+    assert accelerator.n_rejected == 1
+    # The potential returns to the one before the accelerated step,
+    # plus the plain step found from it.
+    assert np.allclose(potential + 2 + step, potential + 1 + 0.5)
+    step = accelerator.step(force, potential + 1.5, np.full(5, 0.3), fit=0.6)
+    assert np.array_equal(step, np.full(5, 0.3))
+    assert accelerator.n_accelerated == 1
+    with pytest.raises(ValueError):
+        AndersonAcceleration(history_size=0)
@@ -63,3 +63,59 @@ class TestState(BaseTest):
                 alpha_form="exponential",
                 _dir=tmp_path
             )
+
+    def test_warm_start_options(self, traj_file_path, tmp_path):
+        state = State(
+                name="X",
+                kT=1.0,
+                traj_file=traj_file_path,
+                n_frames=10,
+                warm_start=True,
+                equilibration_steps=100,
+                _dir=tmp_path
+        )
+        assert state.warm_start is True
+        assert state.equilibration_steps == 100
+        assert state._last_frame is None
+        assert state._initial_frame is state._target_frame
+
+    def test_bad_equilibration_steps(self, traj_file_path, tmp_path):
+        with pytest.raises(ValueError):
+            State(
+                name="X",
+                kT=1.0,
+                traj_file=traj_file_path,
+                n_frames=10,
+                equilibration_steps=-1,
+                _dir=tmp_path
+            )
+
+    def test_frame_slice(self, traj_file_path, tmp_path, stateX):
+        assert stateX.frame_slice == dict(start=-10, stop=-1, stride=1)
+        with pytest.raises(ValueError):
+            State(
+                name="X", kT=1.0, traj_file=traj_file_path, n_frames=10,
+                frame_stride=0, _dir=tmp_path
+            )
+        state = State(
+            name="X", kT=1.0, traj_file=traj_file_path, n_frames=10,
+            frame_stride=2, include_final_frame=True, resume=True,
+            _dir=tmp_path
+        )
+        assert state.frame_slice == dict(start=-10, stop=None, stride=2)
+
+    def test_resume(self, traj_file_path, tmp_path):
+        state = State(
+            name="X", kT=1.0, traj_file=traj_file_path, n_frames=10,
+            _dir=tmp_path
+        )
+        with pytest.raises(AssertionError):
+            State(
+                name="X", kT=1.0, traj_file=traj_file_path, n_frames=10,
+                _dir=tmp_path
+            )
+        resumed = State(
+            name="X", kT=1.0, traj_file=traj_file_path, n_frames=10,
+            resume=True, _dir=tmp_path
+        )
+        assert resumed.dir == state.dir
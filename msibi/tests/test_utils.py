@@ -1,9 +1,18 @@
+import json
+import os
+import pickle
+import time
+
 import numpy as np
 import pytest
 
+from msibi.utils.cache import DistributionCache
 from msibi.utils.error_calculation import calc_similarity
 from msibi.utils.general import find_nearest
-from msibi.utils.smoothing import savitzky_golay
+from msibi.utils.history import HistoryBuffer
+from msibi.utils.smoothing import get_smoother, savitzky_golay
+from msibi.utils.store import IterationStore
+from msibi.utils.timing import Timer
 
 
 def test_calc_similarity():
@@ -44,3 +53,228 @@ def test_savitzky_golay():
         y2 = savitzky_golay(y, 3, 3)
     with pytest.raises(TypeError):
         y2 = savitzky_golay(y, 3, 2)
+
+
+
+def test_savitzky_golay_batch():
+    x = np.arange(0, 1, 0.01)
+    y = np.stack([x ** 3.0, np.sin(4 * x), 2 * x + 1])
+    single = np.stack([savitzky_golay(row, 5, 2, exact=True) for row in y])
+    assert np.array_equal(savitzky_golay(y, 5, 2, exact=True), single)
+    assert np.array_equal(savitzky_golay(y, 5, 2), single)
+    assert np.allclose(savitzky_golay(y, 5, 2, exact=False), single)
+    assert np.allclose(savitzky_golay(y.T, 5, 2, axis=0).T, single)
+
+
+def test_savitzky_golay_matches_convolution():
+    # The default filter is identical to convolving with the coefficients.
+    x = np.arange(0, 1, 0.01)
+    y = np.sin(4 * x) + x ** 2
+    smoother = get_smoother(5, 2)
+    padded = np.concatenate((
+        y[0] - np.abs(y[1:3][::-1] - y[0]),
+        y,
+        y[-1] + np.abs(y[-3:-1][::-1] - y[-1])
+    ))
+    expected = np.convolve(smoother.coefficients[::-1], padded, mode="valid")
+    assert np.array_equal(savitzky_golay(y, 5, 2), expected)
+    assert get_smoother(5, 2).exact
+
+
+def test_shared_smoother():
+    smoother = get_smoother(5, 2)
+    assert get_smoother(5, 2) is smoother
+    assert get_smoother(7, 2) is not smoother
+    assert not smoother.coefficients.flags.writeable
+
+def test_distribution_cache(tmp_path):
+    traj = tmp_path / "traj.gsd"
+    traj.write_bytes(b"trajectory")
+    cache = DistributionCache(cache_dir=tmp_path / "cache")
+    key = cache.key(str(traj), types=["A", "B"], bins=10, x_min=0.0)
+    assert key == cache.key(str(traj), bins=10, x_min=0.0, types=["A", "B"])
+    assert key != cache.key(str(traj), types=["A", "B"], bins=11, x_min=0.0)
+    assert cache.get(key) is None
+    dist = np.random.random((10, 2))
+    cache.set(key, dist)
+    assert np.array_equal(cache.get(key), dist)
+    assert cache.hits == 1
+    assert cache.misses == 1
+    traj.write_bytes(b"new trajectory")
+    assert key != cache.key(str(traj), types=["A", "B"], bins=10, x_min=0.0)
+    cache.clear()
+    assert cache.size == 0
+
+
+def test_distribution_cache_contents_hash(tmp_path):
+    traj1 = tmp_path / "traj1.gsd"
+    traj2 = tmp_path / "traj2.gsd"
+    traj1.write_bytes(b"trajectory")
+    traj2.write_bytes(b"trajectory")
+    cache = DistributionCache(cache_dir=tmp_path, hash_contents=True)
+    assert cache.key(str(traj1), bins=10) == cache.key(str(traj2), bins=10)
+
+
+def test_distribution_cache_eviction(tmp_path):
+    traj = tmp_path / "traj.gsd"
+    traj.write_bytes(b"trajectory")
+    dist = np.zeros((100, 2))
+    cache = DistributionCache(cache_dir=tmp_path / "cache", max_size=4000)
+    keys = [cache.key(str(traj), bins=i) for i in range(3)]
+    for key in keys:
+        cache.set(key, dist)
+        time.sleep(0.01)
+    assert cache.size <= 4000
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[-1]) is not None
+    with pytest.raises(ValueError):
+        DistributionCache(cache_dir=tmp_path, max_size=0)
+
+
+def test_history_buffer():
+    history = HistoryBuffer(capacity=2)
+    rows = np.random.random((5, 10))
+    for row in rows:
+        history.append(row)
+    assert len(history) == 5
+    assert np.array_equal(history.array, rows)
+    assert np.array_equal(history[-1], rows[-1])
+    assert np.array_equal(history.get(3), rows[3])
+    with pytest.raises(ValueError):
+        history.append(np.zeros(9))
+
+
+def test_history_buffer_policy():
+    rows = np.random.random((10, 4))
+    history = HistoryBuffer(retention=3, keep_every=2)
+    for row in rows:
+        history.append(row)
+    assert history.n_appended == 10
+    assert np.array_equal(history.indices, [4, 6, 8])
+    assert np.array_equal(history.array, rows[[4, 6, 8]])
+    assert np.array_equal(history.last, rows[-1])
+    assert history.get(2) is None
+    assert np.array_equal(history[0], rows[4])
+    assert np.array_equal(history[-1], rows[8])
+    assert np.array_equal(history.get(6), rows[6])
+    assert np.array_equal(list(history), rows[[4, 6, 8]])
+    with pytest.raises(IndexError):
+        history[3]
+    with pytest.raises(ValueError):
+        HistoryBuffer(keep_every=0)
+
+
+def test_history_buffer_ring(tmp_path):
+    rows = np.random.random((7, 4))
+    path = os.path.join(tmp_path, "history.npy")
+    for history in (
+            HistoryBuffer(retention=3),
+            HistoryBuffer(retention=3, spill_path=path)
+    ):
+        for row in rows:
+            history.append(row)
+        assert len(history) == 3
+        assert np.array_equal(history.array, rows[4:])
+        assert np.array_equal(history.indices, [4, 5, 6])
+        history = pickle.loads(pickle.dumps(history))
+        assert np.array_equal(history.array, rows[4:])
+        history.append(rows[0])
+        assert np.array_equal(history.array, np.vstack((rows[5:], rows[:1])))
+
+
+def test_history_buffer_spill(tmp_path):
+    x = np.linspace(0, 1, 6)
+    path = os.path.join(tmp_path, "history.npy")
+    history = HistoryBuffer(x=x, spill_path=path, capacity=1)
+    rows = np.random.random((3, 6))
+    for row in rows:
+        history.append(row)
+    assert isinstance(history.array, np.memmap)
+    assert np.array_equal(history[1], np.column_stack((x, rows[1])))
+    assert np.asarray(history).shape == (3, 6, 2)
+    history = pickle.loads(pickle.dumps(history))
+    assert np.array_equal(history.array, rows)
+    history = HistoryBuffer.open(path, 3)
+    history.append(rows[0])
+    assert np.array_equal(history.array, np.vstack((rows, rows[:1])))
+
+
+def test_iteration_store(tmp_path):
+    store = IterationStore(tmp_path, flush_every=2)
+    distributions = np.random.random((4, 11, 2))
+    for i, distribution in enumerate(distributions):
+        store.append("distribution", distribution, i, force="A-B", state="X")
+        store.append("f_fit", i / 4, i, force="A-B", state="X")
+    assert np.array_equal(
+        store.read("distribution", force="A-B", state="X"), distributions
+    )
+    assert np.array_equal(
+        store.read("distribution", force="A-B", state="X", iterations=2),
+        distributions[2]
+    )
+    assert np.array_equal(
+        store.read(
+            "distribution", force="A-B", state="X", iterations=slice(1, None, 2)
+        ),
+        distributions[[1, 3]]
+    )
+    assert np.array_equal(
+        store.read("f_fit", force="A-B", state="X", iterations=[0, 3]),
+        [0, 0.75]
+    )
+    assert ("f_fit", "A-B", "X") in store.series()
+    store.append_timing({
+        "phase": "simulation",
+        "iteration": 0,
+        "state": "X",
+        "force": None,
+        "wall_time": 1.5,
+        "timesteps": 500
+    })
+    timings = store.read_timings("simulation", state="X")
+    assert np.array_equal(timings["iteration"], [0])
+    assert np.array_equal(timings["wall_time"], [1.5])
+    assert np.array_equal(timings["timesteps"], [500])
+    assert np.isnan(timings["tps"][0])
+    with pytest.raises(KeyError):
+        store.read("potential", force="A-B")
+    store.append("distribution", np.ones(3), 4, force="A-B", state="X")
+    with pytest.raises(ValueError):
+        store.flush()
+    store.close()
+
+    reopened = IterationStore(tmp_path)
+    assert np.array_equal(
+        reopened.iterations("f_fit", force="A-B", state="X"), range(4)
+    )
+    assert isinstance(
+        reopened._array(reopened._info("f_fit", "A-B", "X")), np.memmap
+    )
+    reopened.append("f_fit", 1.0, 4, force="A-B", state="X")
+    assert np.array_equal(
+        reopened.read("f_fit", force="A-B", state="X"), [0, 0.25, 0.5, 0.75, 1]
+    )
+    reopened = pickle.loads(pickle.dumps(reopened))
+    assert len(reopened.read("f_fit", force="A-B", state="X")) == 5
+
+
+def test_timer(tmp_path):
+    jsonl_file = os.path.join(tmp_path, "timings.jsonl")
+    timer = Timer(jsonl_file=jsonl_file)
+    with timer.phase("simulation", iteration=0, state="X") as record:
+        time.sleep(0.01)
+        record["tps"] = np.float64(100.0)
+    with pytest.raises(RuntimeError):
+        with timer.phase("update", iteration=0, force="A-B"):
+            raise RuntimeError
+    assert len(timer.records) == 2
+    assert timer.records[0]["wall_time"] >= 0.01
+    assert timer.records[0]["peak_rss"] > 0
+    timer.add({"phase": "simulation", "iteration": 1, "state": "Y"})
+    df = timer.to_dataframe()
+    assert list(df["phase"]) == ["simulation", "update", "simulation"]
+    with open(jsonl_file) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 3
+    assert lines[0]["state"] == "X"
+    assert lines[0]["tps"] == 100.0
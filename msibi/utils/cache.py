@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Changes whenever the way distributions are calculated changes,
+# so distributions cached by earlier versions are not used.
+DISTRIBUTION_VERSION = 2
+
+
+class DistributionCache(object):
+    """
+    On-disk cache of target distributions.
+
+    Target distributions are stored as `.npy` files in cache_dir, named by a
+    hash of the target trajectory and every parameter that changes the
+    distribution. Repeat runs and parameter sweeps that use the same
+    trajectory and histogram settings load the distribution from the cache
+    instead of recalculating it.
+
+    Parameters
+    ----------
+    cache_dir : str, required
+        Directory where the cached distributions are stored.
+        It is created if it does not exist.
+    max_size : int, optional, default 1e9
+        Maximum total size of the cache in bytes. When it is exceeded,
+        the least recently used distributions are removed.
+    hash_contents : bool, optional, default False
+        If True, trajectory files are identified by a digest of their
+        contents. Otherwise they are identified by their path, size and
+        modification time, which is much faster for large files.
+
+    Attributes
+    ----------
+    hits : int
+        Number of distributions loaded from the cache.
+    misses : int
+        Number of distributions not found in the cache.
+
+    """
+
+    def __init__(
+            self,
+            cache_dir: str,
+            max_size: int=int(1e9),
+            hash_contents: bool=False
+    ):
+        if max_size <= 0:
+            raise ValueError("max_size must be a positive number of bytes.")
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return (
+                f"{self.__class__}; "
+                + f"Directory: {self.cache_dir}; "
+                + f"Max size: {self.max_size}"
+        )
+
+    @property
+    def size(self) -> int:
+        """Total size of the cached distributions in bytes."""
+        return sum(os.path.getsize(f) for f in self._files())
+
+    def key(self, traj_file: str, **params) -> str:
+        """Create the cache key of a distribution.
+
+        Parameters
+        ----------
+        traj_file : str, required
+            Path to the trajectory the distribution is calculated from.
+        **params
+            Every setting that changes the distribution, for example the
+            type names, bin range, number of bins and number of frames.
+
+        """
+        identity = {
+            "version": DISTRIBUTION_VERSION,
+            "trajectory": self._file_identity(traj_file),
+            "params": params
+        }
+        text = json.dumps(identity, sort_keys=True, default=_to_builtin)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key: str) -> np.ndarray:
+        """Load a cached distribution, or return None if it is not cached."""
+        path = self._path(key)
+        try:
+            array = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return array
+
+    def set(self, key: str, array: np.ndarray) -> None:
+        """Store a distribution, then evict old ones if the cache is full."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(array))
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def clear(self) -> None:
+        """Remove every cached distribution."""
+        for f in self._files():
+            os.remove(f)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def _files(self) -> list:
+        return [
+            os.path.join(self.cache_dir, f)
+            for f in os.listdir(self.cache_dir) if f.endswith(".npy")
+        ]
+
+    def _evict(self) -> None:
+        """Remove the least recently used distributions beyond max_size."""
+        files = sorted(self._files(), key=os.path.getmtime)
+        sizes = [os.path.getsize(f) for f in files]
+        total = sum(sizes)
+        for f, size in zip(files, sizes):
+            if total <= self.max_size:
+                break
+            os.remove(f)
+            total -= size
+
+    def _file_identity(self, traj_file: str) -> dict:
+        """Values identifying the contents of a trajectory file."""
+        stat = os.stat(traj_file)
+        if not self.hash_contents:
+            return {
+                "path": os.path.abspath(traj_file),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns
+            }
+        digest = hashlib.sha256()
+        with open(traj_file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return {"size": stat.st_size, "sha256": digest.hexdigest()}
+
+
+def _to_builtin(value):
+    """Convert numpy scalars and arrays so they can be written to JSON."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value)} can not be used in a cache key.")
@@ -0,0 +1,284 @@
+import os
+
+import numpy as np
+
+
+class HistoryBuffer(object):
+    """
+    Array-backed history of equal length arrays, one row per entry.
+
+    Rows are stored in a preallocated array that grows as entries are
+    appended, instead of a list of separate arrays. Once the retention
+    window is full, the array is used as a ring buffer, so each new entry
+    overwrites the oldest one in place. Distribution histories store their
+    shared x values once, and only the y values of each entry.
+
+    Parameters
+    ----------
+    x : np.ndarray, optional, default None
+        The x values shared by every entry.
+        If given, entries are returned as (width, 2) arrays of x and y.
+    retention : int, optional, default None
+        If given, only the last retention kept entries are stored.
+    keep_every : int, optional, default 1
+        Only every keep_every-th appended entry is stored,
+        starting with the first one.
+    spill_path : str, optional, default None
+        Path of a `.npy` file used as memory-mapped storage,
+        so the history is kept on disk instead of in memory.
+    dtype : np.dtype, optional, default float
+        Data type of the stored entries.
+    capacity : int, optional, default 16
+        Number of rows allocated before the buffer first grows.
+
+    Attributes
+    ----------
+    n_appended : int
+        The number of entries appended, including those not kept.
+    last : np.ndarray
+        The last entry appended, even if it was not kept.
+
+    """
+
+    def __init__(
+            self,
+            x: np.ndarray=None,
+            retention: int=None,
+            keep_every: int=1,
+            spill_path: str=None,
+            dtype=float,
+            capacity: int=16
+    ):
+        if retention is not None and (
+                not isinstance(retention, int) or retention <= 0
+        ):
+            raise ValueError("retention must be a positive integer.")
+        if not isinstance(keep_every, int) or keep_every <= 0:
+            raise ValueError("keep_every must be a positive integer.")
+        self.x = x
+        self.retention = retention
+        self.keep_every = keep_every
+        self.spill_path = spill_path
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity if retention is None else min(
+            capacity, retention
+        )
+        self.n_appended = 0
+        self.last = None
+        self._data = None
+        self._indices = None
+        self._size = 0
+        self._head = 0
+
+    def __repr__(self):
+        return (
+                f"{self.__class__}; "
+                + f"Entries: {len(self)}; "
+                + f"Retention: {self.retention}; "
+                + f"Keep every: {self.keep_every}"
+        )
+
+    def __getstate__(self):
+        # A memory-mapped buffer is reopened from its file when unpickled.
+        state = self.__dict__.copy()
+        if self.spill_path and self._data is not None:
+            self._data.flush()
+            state["_data"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.spill_path and self._indices is not None:
+            self._data = np.load(self.spill_path, mmap_mode="r+")
+
+    @classmethod
+    def open(cls, spill_path: str, size: int, x: np.ndarray=None):
+        """Reopen a history spilled to disk, to read or append entries.
+
+        Parameters
+        ----------
+        spill_path : str, required
+            Path of the `.npy` file of the history.
+        size : int, required
+            The number of entries stored in the file.
+        x : np.ndarray, optional, default None
+            The x values shared by every entry.
+
+        """
+        data = np.load(spill_path, mmap_mode="r+")
+        if size > len(data):
+            raise ValueError(
+                f"{spill_path} holds {len(data)} entries, not {size}."
+            )
+        buffer = cls(x=x, spill_path=spill_path, dtype=data.dtype)
+        buffer._data = data
+        buffer._indices = np.arange(len(data))
+        buffer._size = buffer.n_appended = size
+        buffer._head = 0
+        if size:
+            buffer.last = np.copy(data[size - 1])
+        return buffer
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield self[i]
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if not isinstance(index, (int, np.integer)):
+            return self._entry(self.array[index])
+        if not -self._size <= index < self._size:
+            raise IndexError(
+                f"Index {index} is out of range for {self._size} entries."
+            )
+        return self._entry(self._data[self._position(index % self._size)])
+
+    def __array__(self, dtype=None, copy=None):
+        if self.x is None:
+            array = self.array
+        elif self._size == 0:
+            array = np.empty((0, len(self.x), 2), dtype=self.dtype)
+        else:
+            x = np.broadcast_to(self.x, self.array.shape)
+            array = np.stack((x, self.array), axis=-1)
+        return np.array(array, dtype=dtype)
+
+    @property
+    def width(self) -> int:
+        """The length of each entry, or None before the first entry."""
+        return None if self._data is None else self._data.shape[1]
+
+    @property
+    def array(self) -> np.ndarray:
+        """The kept entries as a (n_entries, width) array,
+        in the order appended.
+
+        This is a view of the buffer, unless the retention window has
+        wrapped around, in which case the entries are copied in order.
+        """
+        if self._data is None:
+            return np.empty((0, 0), dtype=self.dtype)
+        return self._ordered(self._data)
+
+    @property
+    def indices(self) -> np.ndarray:
+        """The entry number of each kept entry, in the order appended."""
+        if self._indices is None:
+            return np.empty(0, dtype=int)
+        return self._ordered(self._indices)
+
+    def append(self, row: np.ndarray) -> None:
+        """Add an entry to the history.
+
+        Parameters
+        ----------
+        row : np.ndarray, required
+            The entry. Every entry must have the same length.
+
+        """
+        row = np.asarray(row, dtype=self.dtype)
+        if row.ndim != 1:
+            raise ValueError("History entries must be 1D arrays.")
+        if self._data is None:
+            self._allocate(self.capacity, len(row))
+        elif len(row) != self.width:
+            raise ValueError(
+                f"History entries have length {self.width}, "
+                f"but this entry has length {len(row)}."
+            )
+        entry = self.n_appended
+        self.n_appended += 1
+        self.last = np.copy(row)
+        if entry % self.keep_every:
+            return
+        if self._size == self.retention:
+            # Overwrite the oldest entry, which is at the head of the ring.
+            self._data[self._head] = row
+            self._indices[self._head] = entry
+            self._head = (self._head + 1) % self._size
+            return
+        if self._size == len(self._data):
+            self._grow()
+        self._data[self._size] = row
+        self._indices[self._size] = entry
+        self._size += 1
+
+    def get(self, entry: int) -> np.ndarray:
+        """The entry with the given entry number, or None if not kept."""
+        position = np.searchsorted(self.indices, entry)
+        if position == self._size or self.indices[position] != entry:
+            return None
+        return self[position]
+
+    def save(self, file_path: str) -> None:
+        """Save the kept entries to a `.npy` file."""
+        np.save(file_path, self.array)
+
+    def flush(self) -> None:
+        """Write a memory-mapped buffer to its file."""
+        if self.spill_path and self._data is not None:
+            self._data.flush()
+
+    def _position(self, index: int) -> int:
+        """The row of the buffer holding the index-th kept entry."""
+        if self._head == 0:
+            return index
+        return (self._head + index) % self._size
+
+    def _ordered(self, data: np.ndarray) -> np.ndarray:
+        """The kept rows of data, from the oldest to the newest."""
+        if self._head == 0:
+            return data[:self._size]
+        return np.concatenate(
+                (data[self._head:self._size], data[:self._head])
+        )
+
+    def _entry(self, row: np.ndarray) -> np.ndarray:
+        if self.x is None:
+            return np.copy(row)
+        return np.column_stack((self.x, row))
+
+    def _allocate(self, n_rows: int, width: int) -> None:
+        self._indices = np.zeros(n_rows, dtype=int)
+        if self.spill_path:
+            os.makedirs(
+                os.path.dirname(os.path.abspath(self.spill_path)),
+                exist_ok=True
+            )
+            self._data = np.lib.format.open_memmap(
+                self.spill_path,
+                mode="w+",
+                dtype=self.dtype,
+                shape=(n_rows, width)
+            )
+        else:
+            self._data = np.empty((n_rows, width), dtype=self.dtype)
+
+    def _grow(self) -> None:
+        """Double the number of rows, up to the retention window."""
+        n_rows = len(self._data) * 2
+        if self.retention is not None:
+            n_rows = min(n_rows, self.retention)
+        indices = np.zeros(n_rows, dtype=int)
+        indices[:self._size] = self._indices[:self._size]
+        if self.spill_path:
+            tmp_path = f"{self.spill_path}.tmp.npy"
+            data = np.lib.format.open_memmap(
+                tmp_path,
+                mode="w+",
+                dtype=self.dtype,
+                shape=(n_rows, self.width)
+            )
+            data[:self._size] = self._data[:self._size]
+            data.flush()
+            del data
+            self._data = None
+            os.replace(tmp_path, self.spill_path)
+            self._data = np.load(self.spill_path, mmap_mode="r+")
+        else:
+            data = np.empty((n_rows, self.width), dtype=self.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+        self._indices = indices
@@ -1,27 +1,155 @@
+from functools import lru_cache
 from math import factorial
 
 import numpy as np
 
 
-def savitzky_golay(y, window_size, order, deriv=0, rate=1):
+def savitzky_golay(y, window_size, order, deriv=0, rate=1, axis=-1, exact=True):
     """Smoothing filter used on distributions and potentials
 
     Parameters
     ----------
-    y: 1D array-like, required
-        The data sequence to be smoothed
+    y: array-like, required
+        The data sequence to be smoothed. Every 1D series of a
+        multi-dimensional array along axis is smoothed.
     window_size : int, required
         The size of the smoothing window to use; must be an odd number
     order: int, required
         The polynomial order used by the smoothing filter
-    deriv:
-    rate:
+    deriv: int, optional, default 0
+        The order of the derivative to compute.
+    rate: float, optional, default 1
+        Scales the derivative by rate ** deriv.
+    axis: int, optional, default -1
+        The axis of y along which the series are smoothed.
+    exact: bool, optional, default True
+        If True, each series is convolved separately, giving results
+        identical to the original one dimensional filter. If False, all
+        series are filtered in a single matrix product, which is faster
+        for many series but can differ in the last digits.
 
     Returns
     -------
-    1D array-like
+    array-like
         Smoothed array of y after passing through the filter
 
+    """
+    return get_smoother(
+        window_size=window_size,
+        order=order,
+        deriv=deriv,
+        rate=rate,
+        exact=exact
+    ).smooth(y, axis=axis)
+
+
+@lru_cache(maxsize=None)
+def get_smoother(window_size, order, deriv=0, rate=1, exact=True):
+    """Get the shared Smoother using the given filter parameters.
+
+    Smoothers are created once for each set of parameters and reused,
+    so their filter coefficients are only calculated once.
+
+    """
+    return Smoother(
+        window_size=window_size,
+        order=order,
+        deriv=deriv,
+        rate=rate,
+        exact=exact
+    )
+
+
+class Smoother(object):
+    """
+    Savitzky Golay filter used to smooth one or more series.
+
+    Parameters
+    ----------
+    window_size : int, required
+        The size of the smoothing window to use; must be an odd number
+    order: int, required
+        The polynomial order used by the smoothing filter
+    deriv: int, optional, default 0
+        The order of the derivative to compute.
+    rate: float, optional, default 1
+        Scales the derivative by rate ** deriv.
+    exact: bool, optional, default True
+        If True, each series is convolved separately, giving results
+        identical to the original one dimensional filter. Otherwise all
+        series are filtered in a single matrix product, which is faster
+        for many series but can differ in the last digits.
+
+    """
+
+    def __init__(self, window_size, order, deriv=0, rate=1, exact=True):
+        self.window_size = window_size
+        self.order = order
+        self.deriv = deriv
+        self.rate = rate
+        self.exact = exact
+        self.coefficients = _coefficients(window_size, order, deriv, rate)
+
+    def __repr__(self):
+        return (
+                f"{self.__class__}; "
+                + f"Window size: {self.window_size}; "
+                + f"Order: {self.order}"
+        )
+
+    @property
+    def half_window(self) -> int:
+        """Number of points padded at each end of a series."""
+        return (self.window_size - 1) // 2
+
+    def smooth(self, y, axis=-1) -> np.ndarray:
+        """Smooth every series of y along axis.
+
+        Parameters
+        ----------
+        y: array-like, required
+            The data to be smoothed.
+        axis: int, optional, default -1
+            The axis of y along which the series are smoothed.
+
+        Returns
+        -------
+        np.ndarray
+            The smoothed data, with the same shape as y.
+
+        """
+        y = np.moveaxis(np.asarray(y), axis, -1)
+        padded = self.pad(y)
+        if self.exact:
+            m = self.coefficients[::-1]
+            rows = padded.reshape(-1, padded.shape[-1])
+            smoothed = np.stack(
+                [np.convolve(m, row, mode="valid") for row in rows]
+            ).reshape(y.shape)
+        else:
+            windows = np.lib.stride_tricks.sliding_window_view(
+                padded, self.window_size, axis=-1
+            )
+            smoothed = windows @ self.coefficients
+        return np.moveaxis(smoothed, -1, axis)
+
+    def pad(self, y) -> np.ndarray:
+        """Extend the last axis of y at both ends by reflecting the first and
+        last values of each series about the end points.
+        """
+        half_window = self.half_window
+        first = y[..., :1]
+        last = y[..., -1:]
+        firstvals = first - np.abs(y[..., 1:half_window + 1][..., ::-1] - first)
+        lastvals = last + np.abs(y[..., -half_window - 1:-1][..., ::-1] - last)
+        return np.concatenate((firstvals, y, lastvals), axis=-1)
+
+
+@lru_cache(maxsize=None)
+def _coefficients(window_size, order, deriv, rate):
+    """Filter coefficients of a Savitzky Golay filter.
+
+    The returned array is read-only, since it is shared by every caller.
     """
     if not (isinstance(window_size, int) and isinstance(order, int)):
         raise ValueError("window_size and order must be of type int")
@@ -32,14 +160,12 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
 
     order_range = range(order + 1)
     half_window = (window_size - 1) // 2
-    b = np.mat(
+    b = np.array(
         [
             [k ** i for i in order_range]
             for k in range(-half_window, half_window + 1)
         ]
     )
-    m = np.linalg.pinv(b).A[deriv] * rate ** deriv * factorial(deriv)
-    firstvals = y[0] - np.abs(y[1 : half_window + 1][::-1] - y[0])
-    lastvals = y[-1] + np.abs(y[-half_window - 1 : -1][::-1] - y[-1])
-    y = np.concatenate((firstvals, y, lastvals))
-    return np.convolve(m[::-1], y, mode="valid")
+    m = np.linalg.pinv(b)[deriv] * rate ** deriv * factorial(deriv)
+    m.flags.writeable = False
+    return m
@@ -0,0 +1,339 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+
+import numpy as np
+
+from msibi.utils.history import HistoryBuffer
+
+# The values of a timing record kept in the store, in the order stored.
+TIMING_FIELDS = (
+    "wall_time",
+    "bytes_read",
+    "bytes_written",
+    "peak_rss",
+    "timesteps",
+    "tps"
+)
+
+
+class IterationStore(object):
+    """
+    Append-only binary store of the data written each optimization iteration.
+
+    Every series of entries, for example the distributions of one force at
+    one state, is kept in a single memory-mapped `.npy` file in store_dir,
+    with one row per iteration. An `index.json` file records the iteration
+    number and shape of the entries of each series. This replaces the text
+    file written for every force, state and iteration.
+
+    Appended entries are copied and written by a background thread,
+    so the optimization does not wait on the disk. The index is written
+    every flush_every entries, and when the store is flushed or closed.
+
+    Opening an existing store_dir continues the store, so entries can be
+    appended after resuming an optimization, or read for analysis.
+
+    Parameters
+    ----------
+    store_dir : str, required
+        Directory where the store is kept.
+        It is created if it does not exist.
+    flush_every : int, optional, default 100
+        The number of entries appended between writes of the index.
+
+    """
+
+    def __init__(self, store_dir: str, flush_every: int=100):
+        if not isinstance(flush_every, int) or flush_every < 1:
+            raise ValueError("flush_every must be a positive integer.")
+        self.store_dir = os.path.abspath(store_dir)
+        self.flush_every = flush_every
+        os.makedirs(self.store_dir, exist_ok=True)
+        self._series = dict()
+        self._buffers = dict()
+        self._executor = None
+        self._pending = []
+        self._n_unindexed = 0
+        if os.path.isfile(self._index_path):
+            with open(self._index_path) as f:
+                index = json.load(f)
+            for info in index:
+                self._series[_series_name(
+                    info["kind"], info["force"], info["state"]
+                )] = info
+
+    def __repr__(self):
+        return (
+                f"{self.__class__}; "
+                + f"Directory: {self.store_dir}; "
+                + f"Series: {len(self._series)}"
+        )
+
+    def __getstate__(self):
+        # Pending writes are finished before the store is pickled,
+        # and the background thread is restarted on the next append.
+        self.flush()
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_pending"] = []
+        return state
+
+    def append(
+            self,
+            kind: str,
+            data: np.ndarray,
+            iteration: int,
+            force: str=None,
+            state: str=None
+    ) -> None:
+        """Add the entry of one iteration to a series.
+
+        Parameters
+        ----------
+        kind : str, required
+            The kind of data, for example "distribution" or "f_fit".
+        data : np.ndarray, required
+            The entry. Entries of the same series must have the same shape.
+        iteration : int, required
+            The iteration the entry belongs to.
+        force : str, optional, default None
+            Name of the force the entry belongs to.
+        state : str, optional, default None
+            Name of the state the entry belongs to.
+
+        """
+        data = np.array(data, dtype=float)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        pending = []
+        for future in self._pending:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self._pending = pending
+        self._pending.append(
+            self._executor.submit(
+                self._write, kind, data, int(iteration), force, state
+            )
+        )
+
+    def append_timing(self, record: dict) -> None:
+        """Add a timing record of msibi.utils.timing.Timer.
+
+        The record is stored in the series of kind "timing_{phase}", of
+        its force and state, at its iteration. The values listed in
+        msibi.utils.store.TIMING_FIELDS are stored, with NaN for any the
+        record does not have.
+
+        Parameters
+        ----------
+        record : dict, required
+            The timing record.
+
+        """
+        self.append(
+                f"timing_{record['phase']}",
+                [
+                    np.nan if record.get(field) is None else record[field]
+                    for field in TIMING_FIELDS
+                ],
+                iteration=record["iteration"] or 0,
+                force=record.get("force"),
+                state=record.get("state")
+        )
+
+    def read_timings(
+            self,
+            phase: str,
+            force: str=None,
+            state: str=None
+    ) -> dict:
+        """Read the stored timing records of a phase.
+
+        Returns
+        -------
+        dict of np.ndarray
+            The "iteration" of each record, and each value of
+            msibi.utils.store.TIMING_FIELDS.
+
+        """
+        kind = f"timing_{phase}"
+        rows = self.read(kind, force=force, state=state)
+        timings = {"iteration": self.iterations(kind, force, state)}
+        for i, field in enumerate(TIMING_FIELDS):
+            timings[field] = rows[:, i]
+        return timings
+
+    def read(
+            self,
+            kind: str,
+            force: str=None,
+            state: str=None,
+            iterations=None
+    ) -> np.ndarray:
+        """Read entries of a series.
+
+        Only the selected entries are read from disk.
+
+        Parameters
+        ----------
+        kind : str, required
+            The kind of data.
+        force : str, optional, default None
+            Name of the force.
+        state : str, optional, default None
+            Name of the state.
+        iterations : int, slice or list of int, optional, default None
+            The iterations to read. A single iteration returns one entry.
+            Otherwise an array with one row per stored iteration is
+            returned. By default every iteration is read.
+
+        """
+        self._wait()
+        info = self._info(kind, force, state)
+        data = self._array(info)
+        stored = np.asarray(info["iterations"])
+        if iterations is None:
+            rows = data[:len(stored)]
+        elif isinstance(iterations, slice):
+            start, stop, step = (
+                iterations.start, iterations.stop, iterations.step
+            )
+            mask = np.ones(len(stored), dtype=bool)
+            if start is not None:
+                mask &= stored >= start
+            if stop is not None:
+                mask &= stored < stop
+            if step is not None:
+                mask &= (stored - (start or 0)) % step == 0
+            rows = data[np.flatnonzero(mask)]
+        elif np.ndim(iterations) == 0:
+            position = np.flatnonzero(stored == iterations)
+            if len(position) == 0:
+                raise KeyError(
+                    f"Iteration {iterations} is not stored for {kind}."
+                )
+            return np.array(data[position[-1]]).reshape(info["shape"])
+        else:
+            rows = data[np.flatnonzero(np.isin(stored, iterations))]
+        return np.array(rows).reshape((-1, *info["shape"]))
+
+    def iterations(
+            self,
+            kind: str,
+            force: str=None,
+            state: str=None
+    ) -> np.ndarray:
+        """The iterations stored in a series, in the order appended."""
+        self._wait()
+        return np.asarray(self._info(kind, force, state)["iterations"])
+
+    def series(self) -> list:
+        """The (kind, force, state) of every series in the store."""
+        self._wait()
+        return [
+            (info["kind"], info["force"], info["state"])
+            for info in self._series.values()
+        ]
+
+    def flush(self) -> None:
+        """Finish pending writes and write the data and index to disk."""
+        self._wait()
+        for buffer in self._buffers.values():
+            buffer.flush()
+        self._write_index()
+
+    def close(self) -> None:
+        """Flush the store and stop its background thread."""
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.store_dir, "index.json")
+
+    def _wait(self) -> None:
+        """Wait for pending writes, raising the first error found."""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def _info(self, kind: str, force: str, state: str) -> dict:
+        name = _series_name(kind, force, state)
+        if name not in self._series:
+            raise KeyError(
+                f"No {kind} entries are stored for "
+                f"force {force} and state {state}."
+            )
+        return self._series[name]
+
+    def _array(self, info: dict) -> np.ndarray:
+        """The rows of a series, memory-mapped instead of loaded."""
+        name = _series_name(info["kind"], info["force"], info["state"])
+        if name in self._buffers:
+            return self._buffers[name].array
+        return np.load(
+            os.path.join(self.store_dir, info["file"]), mmap_mode="r"
+        )
+
+    def _write(
+            self,
+            kind: str,
+            data: np.ndarray,
+            iteration: int,
+            force: str,
+            state: str
+    ) -> None:
+        """Append an entry to its series. Runs in the background thread."""
+        name = _series_name(kind, force, state)
+        info = self._series.get(name)
+        if info is None:
+            info = {
+                "kind": kind,
+                "force": force,
+                "state": state,
+                "file": f"{name}.npy",
+                "shape": list(data.shape),
+                "iterations": []
+            }
+            self._series[name] = info
+        elif list(data.shape) != info["shape"]:
+            raise ValueError(
+                f"Entries of {name} have shape {tuple(info['shape'])}, "
+                f"but this entry has shape {data.shape}."
+            )
+        if name not in self._buffers:
+            path = os.path.join(self.store_dir, info["file"])
+            if info["iterations"]:
+                buffer = HistoryBuffer.open(path, len(info["iterations"]))
+            else:
+                buffer = HistoryBuffer(spill_path=path)
+            self._buffers[name] = buffer
+        self._buffers[name].append(data.ravel())
+        info["iterations"].append(iteration)
+        self._n_unindexed += 1
+        if self._n_unindexed >= self.flush_every:
+            for buffer in self._buffers.values():
+                buffer.flush()
+            self._write_index()
+
+    def _write_index(self) -> None:
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(list(self._series.values()), f)
+        os.replace(tmp_path, self._index_path)
+        self._n_unindexed = 0
+
+
+def _series_name(kind: str, force: str=None, state: str=None) -> str:
+    """The name of a series, used as its file name."""
+    name = kind
+    if force is not None:
+        name += f"-force_{force}"
+    if state is not None:
+        name += f"-state_{state}"
+    return name
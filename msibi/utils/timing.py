@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+
+class Timer(object):
+    """
+    Records the wall time and resource use of the phases of an optimization.
+
+    Each phase, for example one state's query simulation or the potential
+    update of an iteration, adds one record holding the phase name, the
+    iteration, state and force it belongs to, its wall time, the bytes read
+    and written by the process, and the peak resident set size of the
+    process at the end of the phase. Phases may add their own values,
+    such as the hoomd timesteps per second of a simulation.
+
+    Bytes read and written are only recorded on Linux, and the peak
+    resident set size is not recorded on Windows.
+
+    Parameters
+    ----------
+    jsonl_file : str, optional, default None
+        If given, every record is appended to this file as a line of JSON.
+
+    Attributes
+    ----------
+    records : list of dict
+        Every record, in the order the phases finished.
+
+    """
+
+    def __init__(self, jsonl_file: str=None):
+        self.jsonl_file = jsonl_file
+        self.records = []
+
+    def __repr__(self):
+        return f"{self.__class__}; Records: {len(self.records)}"
+
+    @contextmanager
+    def phase(
+            self,
+            name: str,
+            iteration: int=None,
+            state: str=None,
+            force: str=None
+    ):
+        """Time the code run inside a with block as one phase.
+
+        The record is yielded, so values found during the phase can be
+        added to it.
+
+        Parameters
+        ----------
+        name : str, required
+            Name of the phase.
+        iteration : int, optional, default None
+            The iteration the phase belongs to.
+        state : str, optional, default None
+            Name of the state the phase belongs to.
+        force : str, optional, default None
+            Name of the force the phase belongs to.
+
+        """
+        record = {
+            "phase": name,
+            "iteration": iteration,
+            "state": state,
+            "force": force
+        }
+        io_start = _io_counters()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_time"] = time.perf_counter() - start
+            io_end = _io_counters()
+            if io_start and io_end:
+                record["bytes_read"] = io_end[0] - io_start[0]
+                record["bytes_written"] = io_end[1] - io_start[1]
+            record["peak_rss"] = _peak_rss()
+            self.add(record)
+
+    def add(self, record: dict) -> None:
+        """Add a record, for example one made in another process."""
+        self.records.append(record)
+        if self.jsonl_file:
+            with open(self.jsonl_file, "a") as f:
+                f.write(json.dumps(record, default=_to_builtin) + "\n")
+
+    def to_dataframe(self):
+        """The records as a pandas DataFrame, one row per phase."""
+        import pandas as pd
+
+        return pd.DataFrame(self.records)
+
+
+def _io_counters() -> tuple:
+    """Bytes read and written by this process, or None if not available."""
+    try:
+        with open(f"/proc/{os.getpid()}/io") as f:
+            counters = dict(line.split(":") for line in f)
+    except OSError:
+        return None
+    return int(counters["rchar"]), int(counters["wchar"])
+
+
+def _peak_rss() -> int:
+    """The peak resident set size of this process in bytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _to_builtin(value):
+    """Convert numpy scalars so they can be written to JSON."""
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"{type(value)} can not be written to JSON.")